@@ -0,0 +1,62 @@
+"""
+Annotation loading throughput, in features per second, and the vertex
+counts and napari build times of each level of detail of tissue outlines.
+"""
+
+import pytest
+from conftest import PYRAMID_DOWNSAMPLES, record_rate, tissue_rings
+
+from popidd_io._anno import load_geojson, load_parquet
+from popidd_io._lod import lod_tolerances, simplify_shapes, vertex_count
+
+
+def bench_load_geojson(benchmark, cells_geojson, n_cells):
+    benchmark(load_geojson, cells_geojson)
+    record_rate(benchmark, "features_per_second", n_cells)
+
+
+def bench_load_parquet_centroids(benchmark, cells_parquet, n_cells):
+    benchmark(load_parquet, cells_parquet)
+    record_rate(benchmark, "features_per_second", n_cells)
+
+
+def bench_load_parquet_shapes(benchmark, cells_parquet, n_cells):
+    benchmark(load_parquet, cells_parquet, as_shapes=True)
+    record_rate(benchmark, "features_per_second", n_cells)
+
+
+@pytest.fixture(
+    scope="module", params=range(len(PYRAMID_DOWNSAMPLES)), ids="lod{}".format
+)
+def tissue_lod(request):
+    rings = tissue_rings()
+    tolerance = lod_tolerances(PYRAMID_DOWNSAMPLES)[request.param]
+    return rings, simplify_shapes(rings, ["polygon"] * len(rings), tolerance)
+
+
+def bench_simplify_tissue_outlines(benchmark):
+    rings = tissue_rings()
+    tolerances = lod_tolerances(PYRAMID_DOWNSAMPLES)[1:]
+    benchmark(
+        lambda: [
+            simplify_shapes(rings, ["polygon"] * len(rings), tolerance)
+            for tolerance in tolerances
+        ]
+    )
+    benchmark.extra_info["vertices"] = vertex_count(rings)
+
+
+def bench_render_tissue_outlines(benchmark, tissue_lod, report_vertices):
+    # napari triangulates every outline when a Shapes layer is built
+    import napari.layers
+
+    rings, simplified = tissue_lod
+    benchmark.pedantic(
+        napari.layers.Shapes,
+        args=(simplified,),
+        kwargs={"shape_type": "polygon"},
+        rounds=3,
+    )
+    benchmark.extra_info["vertices"] = vertex_count(simplified)
+    benchmark.extra_info["full_vertices"] = vertex_count(rings)
+    report_vertices(vertex_count(simplified))
@@ -0,0 +1,87 @@
+"""
+Image loading hot paths: time to first layer, metadata reads, tile read
+throughput and peak memory.
+"""
+
+import subprocess
+import sys
+import textwrap
+
+import numpy
+import pytest
+import tifffile
+from conftest import record_rate
+
+from popidd_io._image import _get_mdIF, load_img, open_img, read_img, read_md
+
+
+def first_layer(path, modality=None):
+    # What napari draws first: the smallest level of the first layer
+    layers = load_img(path, modality, use_cache=False, use_transcoded=False)
+    return numpy.asarray(layers[0][0][-1])
+
+
+def bench_load_img_bf(benchmark, bf_slide):
+    benchmark(first_layer, bf_slide)
+
+
+def bench_load_img_if(benchmark, if_slide):
+    benchmark(first_layer, if_slide, "IF")
+
+
+def bench_read_img(benchmark, bf_slide):
+    benchmark(read_img, bf_slide, False)
+
+
+def bench_read_md(benchmark, if_slide):
+    benchmark(read_md, if_slide, "IF")
+
+
+def bench_get_mdIF(benchmark, if_slide):
+    with tifffile.TiffFile(if_slide) as tif:
+        benchmark(_get_mdIF, tif)
+
+
+@pytest.mark.parametrize("decode_workers", [0, 4])
+def bench_tile_throughput(benchmark, bf_slide, decode_workers):
+    level = open_img(bf_slide, True, decode_workers=decode_workers)[0]
+    benchmark(level.__getitem__, Ellipsis)
+    n_tiles = numpy.prod(level.nchunks)
+    record_rate(benchmark, "tiles_per_second", n_tiles)
+
+
+def bench_peak_rss(benchmark, bf_slide):
+    pytest.importorskip("resource")
+    script = textwrap.dedent(f"""
+        import resource
+        from popidd_io._image import load_img
+        import numpy
+
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        layers = load_img(
+            {str(bf_slide)!r}, use_cache=False, use_transcoded=False
+        )
+        numpy.asarray(layers[0][0][-1])
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(before, after)
+        """)
+
+    def run():
+        out = subprocess.run(
+            [sys.executable, "-c", script],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return [int(value) for value in out.split("\n")[-2].split()]
+
+    before, after = benchmark.pedantic(run, rounds=1, iterations=1)
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    unit = 1 if sys.platform == "darwin" else 1024
+    growth = (after - before) * unit
+    benchmark.extra_info["peak_rss_mb"] = after * unit / 2**20
+    benchmark.extra_info["load_rss_growth_mb"] = growth / 2**20
+
+    with tifffile.TiffFile(bf_slide) as tif:
+        full_resolution = tif.series[0].levels[0].nbytes
+    assert growth < full_resolution, "opening a slide decoded all of it"
@@ -0,0 +1,91 @@
+"""
+Tile decoding throughput with a shared file handle vs per-worker handles.
+
+Writes a synthetic JPEG-compressed pyramidal TIFF and reads its full
+resolution level through `open_img`, once with the single shared tifffile
+store and once per worker count with `ParallelTiffStore`, reporting tiles
+per second. Run with
+
+    python benchmarks/bench_tile_decode.py [--size 8192] [--executor thread]
+"""
+
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy
+import tifffile
+
+from popidd_io._image import open_img
+
+TILE = 256
+
+
+def write_jpeg_pyramid(path, size, levels=3):
+    """Write a `size` x `size` RGB JPEG-compressed tiled pyramidal TIFF."""
+    rng = numpy.random.default_rng(0)
+    # Smooth noise compresses (and decodes) like tissue, not like static
+    small = rng.integers(
+        0, 255, (size // 16, size // 16, 3), dtype=numpy.uint8
+    )
+    data = numpy.repeat(numpy.repeat(small, 16, axis=0), 16, axis=1)
+    options = {
+        "tile": (TILE, TILE),
+        "compression": "jpeg",
+        "photometric": "rgb",
+    }
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(data, subifds=levels - 1, **options)
+        for level in range(1, levels):
+            factor = 2**level
+            tif.write(data[::factor, ::factor], subfiletype=1, **options)
+    return path
+
+
+def tiles_per_second(path, decode_workers, executor="thread", repeats=3):
+    """Best-of-`repeats` throughput reading the full resolution level."""
+    best = 0.0
+    for _ in range(repeats):
+        level = open_img(
+            path,
+            load_mem=True,
+            decode_workers=decode_workers,
+            decode_executor=executor,
+        )[0]
+        n_tiles = numpy.prod(level.nchunks)
+        start = time.perf_counter()
+        level[:]
+        best = max(best, n_tiles / (time.perf_counter() - start))
+        level.store.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, default=8192)
+    parser.add_argument(
+        "--executor", choices=("thread", "process"), default="thread"
+    )
+    args = parser.parse_args()
+
+    workers, count = [], 1
+    while count <= (os.cpu_count() or 1):
+        workers.append(count)
+        count *= 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_jpeg_pyramid(pathlib.Path(tmp) / "slide.tif", args.size)
+        shared = tiles_per_second(path, 0)
+        print(f"shared handle      : {shared:10.1f} tiles/s")
+        for n_workers in workers:
+            rate = tiles_per_second(path, n_workers, args.executor)
+            print(
+                f"{n_workers:3d} {args.executor} workers: {rate:10.1f} tiles/s"
+                f"  (x{rate / shared:.2f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Synthetic slides and annotations for the benchmark suite.
+
+Files are written once per session into a temporary directory. Sizes scale
+with POPIDD_BENCH_SIZE (the full resolution edge, 4096 by default), so the
+same suite runs quickly on a laptop and on realistic slides on a
+workstation.
+"""
+
+import json
+import os
+
+import numpy
+import pytest
+import tifffile
+
+TILE = 256
+BENCH_SIZE = int(os.environ.get("POPIDD_BENCH_SIZE", 4096))
+IF_CHANNELS = (
+    ("DAPI", "0,0,255"),
+    ("Opal 520", "0,255,0"),
+    ("Opal 570", "255,255,0"),
+    ("Opal 690", "255,0,0"),
+)
+
+
+def smooth_noise(shape, dtype, high, seed=0):
+    """Blocky noise, which compresses and decodes like tissue."""
+    rng = numpy.random.default_rng(seed)
+    coarse = [
+        max(1, size // 16) if i < 2 else size for i, size in enumerate(shape)
+    ]
+    small = rng.integers(0, high, coarse, dtype=dtype)
+    data = numpy.repeat(numpy.repeat(small, 16, axis=0), 16, axis=1)
+    return data[: shape[0], : shape[1]]
+
+
+def write_bf(path, size, compression=None, levels=4):
+    """Write an RGB pyramidal TIFF with SubIFDs, like a scanner would."""
+    data = smooth_noise((size, size, 3), numpy.uint8, 256)
+    options = {
+        "tile": (TILE, TILE),
+        "photometric": "rgb",
+        "compression": compression,
+    }
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(
+            data,
+            subifds=levels - 1,
+            resolution=(2e4, 2e4),
+            resolutionunit="CENTIMETER",
+            **options,
+        )
+        for level in range(1, levels):
+            factor = 2**level
+            tif.write(data[::factor, ::factor], subfiletype=1, **options)
+    return path
+
+
+def write_if(path, size, dtype, compression=None, levels=4):
+    """
+    Write a multi-channel pyramidal TIFF, one page per channel carrying a
+    PerkinElmer QPI description, like a .qptiff.
+    """
+    high = min(numpy.iinfo(dtype).max, 4096)
+    options = {
+        "tile": (TILE, TILE),
+        "photometric": "minisblack",
+        "compression": compression,
+        "metadata": None,
+    }
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for index, (name, color) in enumerate(IF_CHANNELS):
+            # Mostly dark with bright structures, as fluorescence is
+            data = smooth_noise((size, size), dtype, high, seed=index)
+            data[data < high * 0.9] //= 64
+            description = (
+                '<?xml version="1.0" encoding="utf-16"?>'
+                "<PerkinElmer-QPI-ImageDescription>"
+                f"<Responsivity><Filter><Name>{name}</Name></Filter>"
+                f"</Responsivity><Color>{color}</Color>"
+                "</PerkinElmer-QPI-ImageDescription>"
+            )
+            tif.write(
+                data,
+                subifds=levels - 1,
+                description=description,
+                resolution=(2e4, 2e4),
+                resolutionunit="CENTIMETER",
+                **options,
+            )
+            for level in range(1, levels):
+                factor = 2**level
+                tif.write(data[::factor, ::factor], subfiletype=1, **options)
+    return path
+
+
+CELL_CLASSES = ("Tumor", "Stroma", "Immune cells")
+PYRAMID_DOWNSAMPLES = (1, 4, 16, 64)
+
+
+def cell_rings(n_cells, seed=0):
+    """Closed 12-gon outlines of `n_cells` cells scattered over a slide."""
+    rng = numpy.random.default_rng(seed)
+    centers = rng.uniform(0, BENCH_SIZE, (n_cells, 1, 2))
+    angles = numpy.linspace(0, 2 * numpy.pi, 13)
+    ring = numpy.stack([numpy.cos(angles), numpy.sin(angles)], axis=1) * 5
+    rings = (centers + ring).round(2)
+    rings[:, -1] = rings[:, 0]
+    return rings
+
+
+def tissue_rings(n_rings=4, n_vertices=1000, seed=0):
+    """Hand-traced like tissue outlines, wiggling by a few pixels."""
+    rng = numpy.random.default_rng(seed)
+    angles = numpy.linspace(0, 2 * numpy.pi, n_vertices, endpoint=False)
+    radius = BENCH_SIZE / 8
+    rings = []
+    for center in rng.uniform(radius, BENCH_SIZE - radius, (n_rings, 2)):
+        wiggle = radius + rng.uniform(-2, 2, n_vertices)
+        rings.append(
+            center
+            + numpy.stack([numpy.cos(angles), numpy.sin(angles)], 1)
+            * wiggle[:, None]
+        )
+    return rings
+
+
+def write_cells_geojson(path, n_cells):
+    """Write `n_cells` QuPath-like cell detections as GeoJSON."""
+    features = [
+        {
+            "type": "Feature",
+            "id": f"cell-{i}",
+            "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]},
+            "properties": {
+                "objectType": "detection",
+                "classification": {
+                    "name": CELL_CLASSES[i % 3],
+                    "color": [255 * (i % 2), 0, 255],
+                },
+            },
+        }
+        for i, ring in enumerate(cell_rings(n_cells))
+    ]
+    with open(path, "w") as fh:
+        json.dump({"type": "FeatureCollection", "features": features}, fh)
+    return path
+
+
+def write_cells_parquet(path, n_cells):
+    """Write `n_cells` cell detections as GeoParquet with a bbox covering."""
+    import geopandas
+    import shapely
+
+    rings = cell_rings(n_cells)
+    cells = geopandas.GeoDataFrame(
+        {
+            "classification": [CELL_CLASSES[i % 3] for i in range(n_cells)],
+            "Area": numpy.full(n_cells, 78.5),
+        },
+        geometry=shapely.polygons(rings),
+    )
+    cells.to_parquet(path, write_covering_bbox=True)
+    return path
+
+
+def record_rate(benchmark, key, count):
+    """Store `count` per second of the median run, if the runs were timed."""
+    # No stats with --benchmark-disable
+    if benchmark.stats:
+        benchmark.extra_info[key] = count / benchmark.stats.stats.median
+
+
+VERTEX_COUNTS = {}  # benchmark name -> vertices of the shapes it built
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not VERTEX_COUNTS:
+        return
+    terminalreporter.section("vertices")
+    for name, vertices in VERTEX_COUNTS.items():
+        terminalreporter.write_line(f"{name:<48}{vertices:>12}")
+
+
+@pytest.fixture
+def report_vertices(request):
+    """Record the vertex count of a benchmark, shown after the timings."""
+
+    def report(vertices):
+        VERTEX_COUNTS[request.node.name] = vertices
+
+    return report
+
+
+@pytest.fixture(scope="session")
+def bench_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("popidd-bench")
+
+
+@pytest.fixture(autouse=True)
+def cold_caches(bench_dir, monkeypatch):
+    # Every round measures a cold open, not the profile or tile caches
+    monkeypatch.setenv("POPIDD_CACHE_DIR", str(bench_dir / "cache"))
+
+
+@pytest.fixture(scope="session", params=[None, "jpeg"], ids=["raw", "jpeg"])
+def bf_slide(request, bench_dir):
+    path = bench_dir / f"bf-{request.param}.tif"
+    if not path.exists():
+        write_bf(path, BENCH_SIZE, request.param)
+    return path
+
+
+@pytest.fixture(
+    scope="session", params=[numpy.uint8, numpy.uint16], ids=["8bit", "16bit"]
+)
+def if_slide(request, bench_dir):
+    path = bench_dir / f"if-{request.param.__name__}.tif"
+    if not path.exists():
+        write_if(path, BENCH_SIZE, request.param, "zlib")
+    return path
+
+
+@pytest.fixture(scope="session", params=[1_000, 20_000], ids=["1k", "20k"])
+def n_cells(request):
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def cells_geojson(bench_dir, n_cells):
+    path = bench_dir / f"cells-{n_cells}.geojson"
+    if not path.exists():
+        write_cells_geojson(path, n_cells)
+    return path
+
+
+@pytest.fixture(scope="session")
+def cells_parquet(bench_dir, n_cells):
+    path = bench_dir / f"cells-{n_cells}.parquet"
+    if not path.exists():
+        write_cells_parquet(path, n_cells)
+    return path
@@ -1,6 +1,49 @@
 __version__ = "0.0.1"
 
-from ._reader import get_anno_reader, get_image_reader
-from ._widget import wLoadAnno, wLoadImage
+import importlib
 
-__all__ = ("get_image_reader", "get_anno_reader", "wLoadImage", "wLoadAnno")
+# Submodules pull in napari, dask, zarr, tifffile and geopandas, so they are
+# only imported when one of their names is first used. napari imports this
+# package during plugin discovery.
+_exports = {
+    "get_image_reader": "._reader",
+    "get_anno_reader": "._reader",
+    "wLoadImage": "._widget",
+    "wLoadAnno": "._widget",
+    "SlideProfileCache": "._profile",
+    "get_profile_cache": "._profile",
+    "TileCache": "._tiles",
+    "get_tile_cache": "._tiles",
+    "enable_profiling": "._instrument",
+    "disable_profiling": "._instrument",
+    "get_profiler": "._instrument",
+    "iter_tiles": "._tiling",
+    "TileIterator": "._tiling",
+    "get_tissue_mask": "._tissue",
+    "TissueMask": "._tissue",
+    "CulledShapes": "._culling",
+    "add_culled_shapes": "._culling",
+    "load_cell_labels": "._labels",
+    "TilePrefetcher": "._prefetch",
+    "add_prefetcher": "._prefetch",
+    "SlideMetadata": "._metadata",
+    "load_channel_stack": "._stack",
+    "SlideLibrary": "._library",
+    "scan_library": "._library",
+    "wSlideLibrary": "._widget",
+    "VirtualTileStore": "._virtual",
+}
+
+__all__ = tuple(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted((*globals(), *__all__))
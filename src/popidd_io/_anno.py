@@ -1,9 +1,27 @@
+import codecs
+import json
 import pathlib
+from collections.abc import Sequence
+from typing import Optional
 
-import geopandas
+import numpy
 import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
+import shapely
 from napari.types import LayerDataTuple
 
+from ._instrument import span
+
+POINT, LINES, POLYGON = 0, (1, 2), 3
+MULTI = (4, 5, 6, 7)  # MultiPoint, MultiLineString, MultiPolygon, collections
+PARQUET_BATCH_SIZE = 65536
+LOADER_KEYS = ("id", "part", "ring")  # where a shape comes from
+GEOJSON_BATCH_SIZE = 10000  # features parsed and converted at a time
+GEOJSON_READ_SIZE = 1 << 20  # bytes read from the file at a time
+GEOJSON_MAX_BYTES = 2 << 30  # vertices and features streamed, at most
+
 # Add here the geojson  and parquet reading and writing support for qupath compatibility
 
 # geojson to shapes and shapes to geojson
@@ -15,6 +33,14 @@ def load_geojson(path: str | pathlib.Path) -> list[LayerDataTuple]:
     """
     Load a GeoJSON file and convert it to a list of shape layers.
 
+    Features are grouped into one layer per class (or name, for
+    unclassified features), with one shape per polygon ring or line and
+    the feature properties attached as layer features. Vertices are given
+    as (row, column) image pixel coordinates, so the layers only need the
+    scale of the image they annotate. The file is parsed in batches (see
+    `iter_geojson`), so only the geometries are ever held in full; use
+    `stream_geojson` to get the layers batch by batch.
+
     Parameters:
     path (str | pathlib.Path): The path to the GeoJSON file.
 
@@ -22,85 +48,569 @@ def load_geojson(path: str | pathlib.Path) -> list[LayerDataTuple]:
     list[LayerDataTuple]: A list of LayerDataTuple containing the shape layer information.
     """
 
-    if isinstance(path, str):
-        print("PATH IS A STRINGG!!!!!")
-        path = pathlib.Path(path)
-
-    geo_anno = geopandas.read_file(path)
-    shape_layer_data = []
-    for anno, _ in enumerate(geo_anno["name"]):
-        print(anno, _)
-        nap_anno = []
-        if geo_anno["geometry"][anno].type == "Polygon":
-            nap_anno.append(geo_anno["geometry"][anno].exterior.coords[:])
-        elif geo_anno["geometry"][anno].type == "MultiPolygon":
-            for poly in geo_anno["geometry"][anno].geoms:
-                nap_anno.append(poly.exterior.coords[:])
-        else:
-            print(geo_anno["geometry"][anno].type)
-            raise NotImplementedError(print(geo_anno["geometry"][anno].type))
-
-        shape_layer_data.append(
-            (
-                nap_anno,
-                {
-                    "name": _,
-                    "shape_type": "polygon",
-                    "rotate": -90,
-                    "scale": [
-                        -1,
-                        1,
-                    ],  # Needs to be set to img layer scale, with *-1,*1
-                    "metadata": {"from_geoJSON": True},
-                },
-                "shapes",
+    path = pathlib.Path(path)
+
+    geoms, properties = [], []
+    with span("read", slide=path.name):
+        for batch_geoms, batch, _ in iter_geojson(path):
+            geoms.append(batch_geoms)
+            properties.append(batch)
+        geoms = numpy.concatenate(geoms) if geoms else numpy.empty(0, object)
+        properties = (
+            pandas.concat(properties, ignore_index=True)
+            if properties
+            else pandas.DataFrame()
+        )
+    with span("geometry", slide=path.name, features=len(geoms)):
+        return geoms_to_layers(
+            geoms,
+            properties,
+            metadata={"from_geoJSON": True, "path": path},
+        )
+
+
+def stream_geojson(
+    path: str | pathlib.Path,
+    batch_size: int = GEOJSON_BATCH_SIZE,
+    max_bytes: Optional[int] = GEOJSON_MAX_BYTES,
+):
+    """
+    Stream the layers of a GeoJSON file, batch by batch.
+
+    Each batch of features is converted to layers as `load_geojson` does;
+    a class spread over several batches gets a layer from each of them,
+    meant to be appended to one another (see `_widget.anno_reader`).
+
+    Parameters:
+    path (str | pathlib.Path): The path to the GeoJSON file.
+    batch_size (int): Number of features converted at a time.
+    max_bytes (Optional[int]): Maximum size of the vertex arrays and features streamed in total. A MemoryError is raised by the batch exceeding it, the batches before it stay usable. Unbounded if None.
+
+    Yields:
+    tuple[list[LayerDataTuple], int]: The layers of a batch, and the number of bytes of the file read so far.
+    """
+    path = pathlib.Path(path)
+    metadata = {"from_geoJSON": True, "path": path}
+    streamed = 0
+    for geoms, properties, bytes_read in iter_geojson(path, batch_size):
+        with span("geometry", slide=path.name, features=len(geoms)):
+            layer_data = geoms_to_layers(geoms, properties, metadata)
+        streamed += sum(_layer_bytes(*layer) for layer in layer_data)
+        if max_bytes is not None and streamed > max_bytes:
+            raise MemoryError(
+                f"{path.name}: annotations exceed "
+                f"{max_bytes / 2**20:.0f} MB after {bytes_read} bytes "
+                f"of {path.stat().st_size} were read"
             )
+        yield layer_data, bytes_read
+
+
+def iter_geojson(
+    path: str | pathlib.Path,
+    batch_size: int = GEOJSON_BATCH_SIZE,
+    read_size: int = GEOJSON_READ_SIZE,
+):
+    """
+    Stream the geometries and properties of a GeoJSON file in batches.
+
+    The file is read `read_size` bytes at a time and features are decoded
+    one by one out of the "features" array of a FeatureCollection (or a
+    bare array of features, or a single Feature), so memory stays bounded
+    by one batch rather than by the file. The geometries of a batch are
+    then built by GEOS in bulk, from the text of the features.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the GeoJSON file.
+    batch_size (int): Number of features per batch.
+    read_size (int): Number of bytes read at a time.
+
+    Yields:
+    tuple[numpy.ndarray, pandas.DataFrame, int]: The shapely geometries of a batch, their "id" and properties, and the number of bytes of the file read so far.
+    """
+    with open(path, "rb") as fh:
+        reader = _JSONReader(fh, read_size)
+        texts, records = [], []
+        for feature, text in _features(reader):
+            properties = feature.get("properties") or {}
+            # Features without ID are numbered across batches
+            fid = feature.get("id", reader.n_values)
+            records.append({"id": fid, **properties})
+            texts.append(text)
+            if len(texts) == batch_size:
+                yield *_geojson_batch(texts, records), reader.bytes_read
+                texts, records = [], []
+        if texts:
+            yield *_geojson_batch(texts, records), reader.bytes_read
+
+
+def _geojson_batch(texts, records):
+    # GEOS reads the geometry of each Feature text, in C
+    geoms = shapely.from_geojson(numpy.array(texts, dtype=object))
+    return geoms, pandas.DataFrame.from_records(records)
+
+
+def _features(reader):
+    # (feature, text) pairs of a FeatureCollection, array or single Feature
+    char = reader.peek()
+    if char == "[":
+        yield from reader.array()
+        return
+    if char != "{":
+        raise ValueError(f"Not a GeoJSON object: {char!r}")
+    reader.pos += 1
+    members = {}
+    while (char := reader.peek()) != "}":
+        if char == ",":
+            reader.pos += 1
+            continue
+        key, _ = reader.value()
+        reader.expect(":")
+        if key == "features" and reader.peek() == "[":
+            yield from reader.array()
+            return
+        members[key], _ = reader.value()
+    if members.get("type") == "Feature":
+        yield members, json.dumps(members)
+
+
+def _layer_bytes(data, kwargs, layer_type):
+    # Memory held by a layer once added: its vertices and features
+    if layer_type == "shapes":
+        size = sum(vertices.nbytes for vertices in data)
+    else:
+        size = data.nbytes
+    features = kwargs.get("features")
+    if features is not None:
+        size += int(features.memory_usage(index=False, deep=True).sum())
+    return size
+
+
+class _JSONReader:
+    """
+    Incremental reader of JSON values from a binary file.
+
+    Parameters:
+    fh (BinaryIO): The file, read `read_size` bytes at a time.
+    read_size (int): Number of bytes read at a time. More is read when a value does not fit in the buffer.
+    """
+
+    def __init__(self, fh, read_size: int = GEOJSON_READ_SIZE):
+        self.fh = fh
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self.n_values = 0  # values returned by array
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character, "" at the end."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in (
+                " \t\n\r"
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, char: str) -> None:
+        """Consume `char`, the next non whitespace character."""
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                f"Expected {char!r} but found {found!r} after "
+                f"{self.bytes_read} bytes"
+            )
+        self.pos += 1
+
+    def value(self) -> tuple:
+        """Decode the next value, returning it and its text."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill(len(self.buffer)):
+                    raise
+                continue
+            # A number may go on in the bytes not read yet
+            if end < len(self.buffer) or not self._fill():
+                break
+        text = self.buffer[self.pos : end]
+        self.pos = end
+        return value, text
+
+    def array(self):
+        """Yield the (value, text) pairs of the next array."""
+        self.expect("[")
+        while (char := self.peek()) != "]":
+            if not char:
+                raise ValueError("Unterminated array")
+            if char == ",":
+                self.pos += 1
+                continue
+            yield self.value()
+            self.n_values += 1
+        self.pos += 1
+
+    def _fill(self, size: int = 0) -> bool:
+        # Reads at least read_size (or size) more bytes, False at the end
+        if self.eof:
+            return False
+        data = self.fh.read(max(self.read_size, size))
+        self.bytes_read += len(data)
+        self.eof = not data
+        # Consumed text is dropped, keeping the buffer to one value or so
+        self.buffer = self.buffer[self.pos :] + self._text.decode(
+            data, final=self.eof
         )
-    return shape_layer_data
-
-
-def load_parquet(path: str | pathlib.Path) -> list[LayerDataTuple]:
-
-    if isinstance(path, str):
-        print("PATH IS A STRINGG!!!!!")
-        path = pathlib.Path(path)
-
-    df = pandas.read_parquet(path)
-    print("Experiental")
-    print(df)
-
-
-# def save_geojson
-
-# def wAnno(
-#         viewer: "napari.Viewer",
-#         imgAnno: "napari.layers.Image",
-#         shapeAnno: "napari.layers.Shapes",
-#         annoDir = pathlib.Path("")
-#         ):
-
-#     features = []
-#     for layer in shapeAnno:
-#         geoms = []
-#         for shape in layer.data:
-#             if layer.metadata.get("nap_generated"):
-#                 shape = numpy.dot(shape, [[0, 1], [1, 0]]) # QUpath rotates and flips images. WIP to make it standard for our workflow too
-#             geoms.append(Polygon(shape))
-#         mpoly = MultiPolygon(geoms)
-#         feature = {
-#             "type": "Feature",
-#             "properties": {
-#                 "objectType":"annotation",
-#                 "name":layer.name},
-#                 "geometry": mpoly.__geo_interface__
-#         }
-#         features.append(feature)
-#     feature_collection = {
-#         "type":"FeatureCollection",
-#         "features": features
-#     }
-
-#     gdf = geopandas.GeoDataFrame.from_features(feature_collection)
-#     gdf.to_file(filename= annoDir / f"{imgAnno.name}.geojson", driver="GeoJSON")
-
-# def save_parquet():
+        self.pos = 0
+        return not self.eof
+
+
+def geoms_to_layers(
+    geoms: numpy.ndarray,
+    properties: pandas.DataFrame,
+    metadata: Optional[dict] = None,
+) -> list[LayerDataTuple]:
+    """
+    Convert an array of shapely geometries into shape (and point) layers,
+    one per class.
+
+    Parameters:
+    geoms (numpy.ndarray): The shapely geometries, in QuPath (x, y) pixel coordinates.
+    properties (pandas.DataFrame): One row of properties per geometry.
+    metadata (Optional[dict]): Metadata attached to every layer.
+
+    Returns:
+    list[LayerDataTuple]: Shapes layers holding the polygons and lines of each class, and Points layers holding its points.
+    """
+    properties = properties.reset_index(drop=True)
+    groups, colors = feature_classes(properties)
+    if "id" not in properties:
+        properties.insert(0, "id", numpy.arange(len(properties)))
+    if "classification" in properties:
+        properties["classification"] = [
+            class_name(value) for value in properties["classification"]
+        ]
+
+    shapes = geoms_to_shapes(geoms)
+    points = shapes.pop("points")
+
+    layer_data = []
+    for group, selected in _split_groups(groups[shapes["source"]]):
+        features = properties.iloc[shapes["source"][selected]]
+        features = features.reset_index(drop=True).assign(
+            part=shapes["part"][selected], ring=shapes["ring"][selected]
+        )
+        kwargs = {
+            "name": group,
+            "shape_type": shapes["shape_type"][selected].tolist(),
+            "features": features,
+            "feature_defaults": feature_defaults(features),
+            "metadata": dict(metadata or {}),
+        }
+        if group in colors:
+            kwargs["edge_color"] = colors[group]
+        layer_data.append(
+            ([shapes["data"][i] for i in selected], kwargs, "shapes")
+        )
+
+    for group, selected in _split_groups(groups[points["source"]]):
+        features = properties.iloc[points["source"][selected]]
+        features = features.reset_index(drop=True)
+        kwargs = {
+            "name": f"{group} points",
+            "features": features,
+            "feature_defaults": feature_defaults(features),
+            "metadata": dict(metadata or {}),
+        }
+        if group in colors:
+            kwargs["face_color"] = colors[group]
+        layer_data.append((points["data"][selected], kwargs, "points"))
+
+    return layer_data
+
+
+def feature_defaults(features: pandas.DataFrame) -> dict:
+    """
+    Return the features napari gives to shapes drawn into a loaded layer.
+
+    napari copies those of the last row; its "id", "part" and "ring" are
+    left out, as they would make the writers add the drawn shape to the
+    feature of that row.
+
+    Parameters:
+    features (pandas.DataFrame): The features of the layer.
+
+    Returns:
+    dict: A default value for every column.
+    """
+    defaults = features.iloc[-1].to_dict() if len(features) else {}
+    defaults.update({key: None for key in LOADER_KEYS if key in features})
+    return {column: defaults.get(column) for column in features.columns}
+
+
+def geoms_to_shapes(geoms: numpy.ndarray) -> dict:
+    """
+    Convert shapely geometries to napari vertex arrays in bulk.
+
+    Multi-part geometries and GeometryCollections are exploded, every
+    polygon ring (exterior and holes) and line becomes one shape, and
+    points are kept apart. QuPath (x, y) coordinates are swapped to napari
+    (row, column) in one step for all vertices.
+
+    Parameters:
+    geoms (numpy.ndarray): The shapely geometries.
+
+    Returns:
+    dict: "data" (list of (N, 2) vertex arrays), "shape_type" ("polygon" or "path"), "source" (index of the geometry each shape comes from), "part" (index of the part within that geometry) and "ring" (0 for exteriors and lines, 1.. for holes), plus "points" with the "data" and "source" of point parts.
+    """
+    parts, source = explode_geoms(numpy.asarray(geoms, dtype=object))
+    part = _rank(source)
+    types = shapely.get_type_id(parts)
+
+    polygons = numpy.flatnonzero(types == POLYGON)
+    rings, ring_polygon = shapely.get_rings(parts[polygons], return_index=True)
+    lines = numpy.flatnonzero(numpy.isin(types, LINES))
+    points = numpy.flatnonzero(types == POINT)
+
+    outlines = numpy.concatenate([rings, parts[lines]])
+    coords, outline = shapely.get_coordinates(outlines, return_index=True)
+    counts = numpy.bincount(outline, minlength=len(outlines))
+    ends = numpy.cumsum(counts)
+    # Rings repeat their first vertex at the end, napari closes polygons
+    coords = numpy.delete(coords, ends[: len(rings)] - 1, axis=0)
+    counts[: len(rings)] -= 1
+    coords = coords[:, ::-1]  # (x, y) -> (row, column)
+
+    polygon_of_outline = polygons[ring_polygon]
+    part_of_outline = numpy.concatenate([polygon_of_outline, lines])
+    return {
+        "data": numpy.split(coords, numpy.cumsum(counts)[:-1]),
+        "shape_type": numpy.array(
+            ["polygon"] * len(rings) + ["path"] * len(lines)
+        ),
+        "source": source[part_of_outline],
+        "part": part[part_of_outline],
+        "ring": numpy.concatenate(
+            [_rank(ring_polygon), numpy.zeros(len(lines), dtype=int)]
+        ),
+        "points": {
+            "data": shapely.get_coordinates(parts[points])[:, ::-1],
+            "source": source[points],
+        },
+    }
+
+
+def explode_geoms(geoms: numpy.ndarray) -> tuple:
+    """
+    Flatten (nested) multi-part geometries into their non-empty parts.
+
+    Returns:
+    tuple[numpy.ndarray, numpy.ndarray]: The parts, and the index in `geoms` of the geometry each one comes from.
+    """
+    source = numpy.arange(len(geoms))
+    while numpy.isin(shapely.get_type_id(geoms), MULTI).any():
+        geoms, index = shapely.get_parts(geoms, return_index=True)
+        source = source[index]
+    keep = ~shapely.is_empty(geoms) & ~shapely.is_missing(geoms)
+    return geoms[keep], source[keep]
+
+
+def _rank(index):
+    # Position of each element within its run of equal (sorted) indices
+    if len(index) == 0:
+        return numpy.zeros(0, dtype=int)
+    return numpy.arange(len(index)) - numpy.searchsorted(index, index)
+
+
+def _split_groups(keys):
+    # Positions of each distinct key, in order of first appearance, from
+    # one sort rather than a mask per key
+    order = numpy.argsort(keys, kind="stable")
+    unique, first = numpy.unique(keys[order], return_index=True)
+    runs = numpy.split(order, first[1:])
+    return [(unique[i], runs[i]) for i in numpy.argsort(order[first])]
+
+
+def feature_classes(properties: pandas.DataFrame) -> tuple:
+    """
+    Return the class of each feature, i.e. the layer it goes to: its
+    QuPath "classification", else its "name", else "Unclassified".
+
+    Returns:
+    tuple[numpy.ndarray, dict]: The class of each row of `properties`, and the RGB colour (0 to 1) of the classes that come with one.
+    """
+    groups = numpy.full(len(properties), "Unclassified", dtype=object)
+    colors = {}
+    if "name" in properties:
+        named = properties["name"].notna().to_numpy()
+        groups[named] = properties["name"][named].astype(str)
+    if "classification" in properties:
+        for row, value in enumerate(properties["classification"]):
+            if isinstance(value, str) and value.startswith("{"):
+                value = json.loads(value)
+            name = class_name(value)
+            if name is None:
+                continue
+            groups[row] = name
+            if isinstance(value, dict) and "color" in value:
+                colors[name] = numpy.asarray(value["color"][:3]) / 255
+    return groups, colors
+
+
+def class_name(value) -> Optional[str]:
+    """
+    Return the name of a QuPath "classification" value (a dict, its JSON
+    text or the name itself), None if there is none.
+    """
+    if isinstance(value, str) and value.startswith("{"):
+        value = json.loads(value)
+    if isinstance(value, dict):
+        return value.get("name")
+    if isinstance(value, str):
+        return value
+    return None
+
+
+def load_parquet(
+    path: str | pathlib.Path,
+    as_shapes: bool = False,
+    classes: Optional[Sequence[str]] = None,
+    bbox: Optional[Sequence[float]] = None,
+    measurements: Optional[Sequence[str]] = None,
+    batch_size: int = PARQUET_BATCH_SIZE,
+) -> list[LayerDataTuple]:
+    """
+    Load cell detections from a GeoParquet (or QuPath parquet) file.
+
+    The file is streamed in record batches, reading only the geometry,
+    classification and requested measurement columns; geometries are
+    decoded from WKB in bulk per batch. Class and bounding box filters are
+    pushed down to the parquet reader (row groups are skipped using the
+    GeoParquet bbox covering column when there is one), so peak memory
+    stays bounded by the selected cells.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the parquet file.
+    as_shapes (bool): Load cell outlines as a Shapes layer per class instead of centroids as a Points layer.
+    classes (Optional[Sequence[str]]): Only load cells of these classes.
+    bbox (Optional[Sequence[float]]): Only load cells intersecting this (xmin, ymin, xmax, ymax) box, in QuPath pixel coordinates.
+    measurements (Optional[Sequence[str]]): Measurement columns attached as layer features. All of them if None.
+    batch_size (int): Number of rows decoded at a time.
+
+    Returns:
+    list[LayerDataTuple]: A list of LayerDataTuple containing the point or shape layer information.
+    """
+
+    path = pathlib.Path(path)
+
+    geoms, tables = [], []
+    with span("read", slide=path.name):
+        for batch_geoms, batch in iter_parquet(
+            path, classes, bbox, measurements, batch_size
+        ):
+            if not as_shapes:
+                batch_geoms = shapely.centroid(batch_geoms)
+            geoms.append(batch_geoms)
+            tables.append(batch)
+        geoms = numpy.concatenate(geoms) if geoms else numpy.empty(0, object)
+        properties = (
+            pyarrow.Table.from_batches(tables).to_pandas()
+            if tables
+            else pandas.DataFrame()
+        )
+    metadata = {"from_parquet": True, "path": path}
+
+    if as_shapes:
+        with span("geometry", slide=path.name, features=len(geoms)):
+            return geoms_to_layers(geoms, properties, metadata=metadata)
+
+    if "classification" in properties:
+        properties["classification"] = [
+            class_name(value) for value in properties["classification"]
+        ]
+    kwargs = {
+        "name": path.stem,
+        "features": properties,
+        "feature_defaults": feature_defaults(properties),
+        "size": 10,
+        "metadata": metadata,
+    }
+    if "classification" in properties:
+        kwargs["face_color"] = "classification"
+    return [(shapely.get_coordinates(geoms)[:, ::-1], kwargs, "points")]
+
+
+def iter_parquet(
+    path: str | pathlib.Path,
+    classes: Optional[Sequence[str]] = None,
+    bbox: Optional[Sequence[float]] = None,
+    measurements: Optional[Sequence[str]] = None,
+    batch_size: int = PARQUET_BATCH_SIZE,
+):
+    """
+    Stream the geometries and properties of a (Geo)Parquet file in batches.
+
+    See `load_parquet` for the parameters.
+
+    Yields:
+    tuple[numpy.ndarray, pyarrow.RecordBatch]: The decoded shapely geometries of a batch and its other selected columns.
+    """
+    dataset = pyarrow.dataset.dataset(path, format="parquet")
+    schema = dataset.schema
+    geo = json.loads((schema.metadata or {}).get(b"geo", b"{}"))
+    geom_column = geo.get("primary_column", "geometry")
+    covering = geo.get("columns", {}).get(geom_column, {}).get("covering", {})
+    covering_columns = {path[0] for path in covering.get("bbox", {}).values()}
+
+    if measurements is None:
+        measurements = [
+            name
+            for name in schema.names
+            if name not in (geom_column, "classification")
+            and name not in covering_columns
+        ]
+    columns = [geom_column, *measurements]
+    if "classification" in schema.names:
+        columns.insert(1, "classification")
+
+    expression = None
+    if classes is not None:
+        expression = _class_field(schema).isin(list(classes))
+    if bbox is not None and "bbox" in covering:
+        xmin, ymin, xmax, ymax = bbox
+        fields = {
+            key: pyarrow.compute.field(tuple(value))
+            for key, value in covering["bbox"].items()
+        }
+        in_box = (
+            (fields["xmax"] >= xmin)
+            & (fields["xmin"] <= xmax)
+            & (fields["ymax"] >= ymin)
+            & (fields["ymin"] <= ymax)
+        )
+        expression = in_box if expression is None else expression & in_box
+
+    for batch in dataset.to_batches(
+        columns=columns, filter=expression, batch_size=batch_size
+    ):
+        geoms = shapely.from_wkb(
+            batch.column(geom_column).to_numpy(zero_copy_only=False)
+        )
+        if bbox is not None:
+            # Exact test, the covering only prunes by bounding boxes
+            keep = shapely.intersects(geoms, shapely.box(*bbox))
+            geoms = geoms[keep]
+            batch = batch.filter(pyarrow.array(keep))
+        yield geoms, batch.drop_columns([geom_column])
+
+
+def _class_field(schema):
+    # QuPath classifications are either plain names or {name, color} structs
+    if pyarrow.types.is_struct(schema.field("classification").type):
+        return pyarrow.compute.field(("classification", "name"))
+    return pyarrow.compute.field("classification")
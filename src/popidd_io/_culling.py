@@ -0,0 +1,452 @@
+"""
+Viewport-culled annotation display.
+
+napari triangulates and draws every shape of a Shapes layer, so layers of
+tens of thousands of annotations make panning unusable. `CulledShapes`
+keeps all shapes of a layer in memory with an STRtree over their bounding
+boxes, and feeds the layer only the shapes around the current view (at
+most `max_shapes` of them), refreshing on camera changes. Edits made to
+the displayed shapes are written back before they leave the view, so the
+full set stays queryable by feature ID and is what the writers save.
+
+Given the downsamples of the image pyramid, outlines are also shown
+simplified to the zoom level (see `_lod`), and in full while editing.
+"""
+
+import logging
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy
+import pandas
+import shapely
+
+from ._anno import feature_defaults
+from ._lod import lod_level, lod_tolerances, simplify_shapes, vertex_count
+
+logger = logging.getLogger(__name__)
+
+MAX_VISIBLE_SHAPES = 5000
+INDEX = "_index"  # position of a displayed shape in the full set
+EDIT_MODES = ("select", "direct", "vertex_insert", "vertex_remove")
+
+_controllers = {}  # kept alive until their layer is removed
+
+
+class CulledShapes:
+    """
+    Shapes layer showing only the annotations in view.
+
+    Parameters:
+    viewer (napari.Viewer): The viewer whose camera drives the culling.
+    data (list[numpy.ndarray]): All vertex arrays, in (row, column) data coordinates, e.g. from `geoms_to_layers`.
+    kwargs (dict): The Shapes layer keyword arguments that came with `data`. "shape_type" and "features" hold one entry per shape.
+    max_shapes (int): Maximum number of shapes displayed at once. The largest ones are kept when more are in view.
+    margin (float): Extra fraction of the view fetched around it, so small pans need no refresh.
+    downsamples (Optional[Sequence[float]]): Downsample of each level of the annotated image pyramid. A simplified version of the outlines is precomputed for each level and shown when napari would show that level. Outlines are never simplified if None.
+    """
+
+    def __init__(
+        self,
+        viewer,
+        data: list,
+        kwargs: dict,
+        max_shapes: int = MAX_VISIBLE_SHAPES,
+        margin: float = 0.5,
+        downsamples: Optional[Sequence[float]] = None,
+    ):
+        import napari.layers
+        from napari.utils.colormaps.standardize_color import transform_color
+
+        kwargs = dict(kwargs)
+        self.viewer = viewer
+        self.max_shapes = max_shapes
+        self.margin = margin
+        self._data = [numpy.asarray(vertices) for vertices in data]
+        shape_type = kwargs.pop("shape_type", "polygon")
+        if isinstance(shape_type, str):
+            shape_type = [shape_type] * len(self._data)
+        self._shape_type = list(shape_type)
+        features = pandas.DataFrame(kwargs.pop("features", None))
+        kwargs.pop("feature_defaults", None)  # set with the shapes shown
+        if not len(features.columns):
+            features = pandas.DataFrame(index=range(len(self._data)))
+        self._features = features.reset_index(drop=True)
+        self._deleted = numpy.zeros(len(self._data), dtype=bool)
+        self._build_tree()
+        self.downsamples = list(downsamples or [1])
+        # Level 0 is the full resolution outlines, self._data itself
+        self._lods = [self._data] + [
+            simplify_shapes(self._data, self._shape_type, tolerance)
+            for tolerance in lod_tolerances(self.downsamples)[1:]
+        ]
+        self.lod = 0
+        self._displayed = {}
+
+        self.visible = numpy.empty(0, dtype=numpy.int64)
+        self._fetched = None
+        self._updating = False
+        self._edited = False
+        self.layer = napari.layers.Shapes(ndim=2, **kwargs)
+        self._colors = numpy.tile(
+            transform_color(self.layer.current_edge_color),
+            (len(self._data), 1),
+        )
+        self.layer.metadata["culled_shapes"] = id(self)
+        _controllers[id(self)] = self
+        for event in ("data", "features", "edge_color"):
+            getattr(self.layer.events, event).connect(self._on_edit)
+        self.layer.events.mode.connect(self.refresh)
+        viewer_camera(viewer).events.center.connect(self.refresh)
+        viewer_camera(viewer).events.zoom.connect(self.refresh)
+        viewer.layers.events.removed.connect(self._on_removed)
+
+    def __len__(self):
+        return int((~self._deleted).sum())
+
+    def view_box(self) -> tuple:
+        """
+        Return the (row_min, col_min, row_max, col_max) box of the view in
+        data coordinates of the layer, without margin.
+        """
+        return view_box(self.viewer, self.layer)
+
+    def vertex_counts(self) -> list[int]:
+        """Return the total number of vertices of each level of detail."""
+        return [vertex_count(lod) for lod in self._lods]
+
+    def select_lod(self) -> int:
+        """
+        Return the level of detail matching the zoom, 0 (full resolution)
+        while the layer is in an editing mode.
+        """
+        if self.layer.mode in EDIT_MODES or len(self._lods) == 1:
+            return 0
+        zoom = viewer_camera(self.viewer).zoom * float(self.layer.scale[-1])
+        return lod_level(self.downsamples, 1 / zoom)
+
+    def refresh(self, event=None, box: Optional[tuple] = None) -> None:
+        """
+        Show the shapes intersecting the view (or `box`), if it moved out
+        of the region fetched last time, zoomed or needs another level of
+        detail.
+        """
+        box = self.view_box() if box is None else box
+        height, width = box[2] - box[0], box[3] - box[1]
+        lod = self.select_lod()
+        if (
+            lod == self.lod
+            and self._fetched is not None
+            and _contains(self._fetched, box)
+        ):
+            fetched_height = self._fetched[2] - self._fetched[0]
+            # Zooming in far enough warrants a smaller fetch
+            if fetched_height <= height * (1 + 2 * self.margin) * 1.5:
+                return
+        fetched = (
+            box[0] - height * self.margin,
+            box[1] - width * self.margin,
+            box[2] + height * self.margin,
+            box[3] + width * self.margin,
+        )
+        hits = self._tree.query(shapely.box(*fetched))
+        hits = hits[~self._deleted[hits]]
+        if len(hits) > self.max_shapes:
+            hits = hits[numpy.argsort(-self._areas[hits])[: self.max_shapes]]
+            # A crowded view changes with every pan, fetch it again then
+            fetched = box
+        hits = numpy.sort(hits)
+        self._fetched = fetched
+        if lod == self.lod and numpy.array_equal(hits, self.visible):
+            return
+        self._show(hits, lod)
+
+    def sync(self) -> None:
+        """Write the edits made to the displayed shapes back."""
+        if not self._edited:
+            return
+        layer = self.layer
+        features = layer.features
+        shown = (
+            numpy.array(features[INDEX], dtype=numpy.int64)
+            if INDEX in features
+            else numpy.full(layer.nshapes, -1)
+        )
+        features = features.drop(columns=INDEX, errors="ignore")
+        for column in features.columns:
+            if column not in self._features:
+                self._features[column] = None
+        n_known = len(self._data)
+        for row, index in enumerate(shown):
+            vertices = numpy.asarray(layer.data[row])[:, -2:]
+            if index < 0:
+                # Drawn by the user: appended to the full set
+                index = len(self._data)
+                self._shape_type.append(None)
+                self._features.loc[index] = None
+                for lod in self._lods:
+                    lod.append(vertices)
+            elif not numpy.array_equal(vertices, self._displayed[index]):
+                # Edited outlines are shown in full from now on
+                for lod in self._lods:
+                    lod[index] = vertices
+            self._shape_type[index] = layer.shape_type[row]
+            self._displayed[index] = self._lods[self.lod][index]
+            for column in features.columns:
+                self._features.at[index, column] = features[column].iloc[row]
+        added = len(self._data) - n_known
+        self._deleted = numpy.append(self._deleted, numpy.zeros(added, bool))
+        self._colors = numpy.concatenate(
+            [self._colors, numpy.zeros((added, 4))]
+        )
+        shown[shown < 0] = numpy.arange(n_known, len(self._data))
+        self._colors[shown] = layer.edge_color
+        self._deleted[numpy.setdiff1d(self.visible, shown)] = True
+        self._build_tree()
+        self._updating = True
+        try:
+            layer.features = layer.features.assign(**{INDEX: shown})
+        finally:
+            self._updating = False
+        self.visible = numpy.sort(shown)
+        self._edited = False
+
+    @property
+    def data(self) -> list:
+        """All vertex arrays, including edits and shapes out of view."""
+        self.sync()
+        return [
+            vertices
+            for vertices, deleted in zip(self._data, self._deleted)
+            if not deleted
+        ]
+
+    @property
+    def shape_type(self) -> list:
+        """The shape type of each entry of `data`."""
+        self.sync()
+        return [
+            shape_type
+            for shape_type, deleted in zip(self._shape_type, self._deleted)
+            if not deleted
+        ]
+
+    @property
+    def features(self) -> pandas.DataFrame:
+        """The features of each entry of `data`."""
+        self.sync()
+        return self._features[~self._deleted].reset_index(drop=True)
+
+    @property
+    def edge_color(self) -> numpy.ndarray:
+        """The RGBA edge colour of each entry of `data`."""
+        self.sync()
+        return self._colors[~self._deleted]
+
+    def layer_data(self) -> tuple:
+        """
+        Return the full layer as a (data, meta, layer_type) tuple, as the
+        writers expect.
+        """
+        meta = self.layer.as_layer_data_tuple()[1]
+        meta.update(
+            shape_type=self.shape_type,
+            features=self.features,
+            edge_color=self.edge_color,
+        )
+        return self.data, meta, "shapes"
+
+    def feature(self, fid) -> pandas.DataFrame:
+        """Return the rows of `features` (one per ring or part) of a feature ID."""
+        features = self.features
+        return features[features["id"] == fid]
+
+    def _show(self, hits, lod=0):
+        self.sync()
+        layer = self.layer
+        self._updating = True
+        try:
+            if layer.nshapes:
+                layer.selected_data = set(range(layer.nshapes))
+                layer.remove_selected()
+            self._displayed = {i: self._lods[lod][i] for i in hits}
+            if len(hits):
+                layer.add(
+                    list(self._displayed.values()),
+                    shape_type=[self._shape_type[i] for i in hits],
+                )
+                layer.edge_color = self._colors[hits]
+                layer.features = (
+                    self._features.iloc[hits]
+                    .assign(**{INDEX: hits})
+                    .reset_index(drop=True)
+                )
+                # Shapes drawn by the user get no index, nor the feature
+                # ID, part and ring of the last shape
+                layer.feature_defaults = {
+                    **feature_defaults(layer.features),
+                    INDEX: -1,
+                }
+        finally:
+            self._updating = False
+        self.visible = hits
+        self.lod = lod
+        logger.debug(
+            "%s: showing %d of %d shapes at level of detail %d",
+            layer.name,
+            len(hits),
+            len(self),
+            lod,
+        )
+
+    def extend(self, data: list, kwargs: dict) -> None:
+        """
+        Append shapes to the full set, e.g. the later batches of a layer
+        streamed by `stream_geojson`, and refresh the view.
+
+        Parameters:
+        data (list[numpy.ndarray]): The vertex arrays to append, in (row, column) data coordinates.
+        kwargs (dict): The layer keyword arguments that came with `data`. Only "shape_type", "features" and "edge_color" are used.
+        """
+        from napari.utils.colormaps.standardize_color import transform_color
+
+        self.sync()
+        start = len(self._data)
+        data = [numpy.asarray(vertices) for vertices in data]
+        shape_type = kwargs.get("shape_type", "polygon")
+        if isinstance(shape_type, str):
+            shape_type = [shape_type] * len(data)
+        features = pandas.DataFrame(kwargs.get("features"))
+        if not len(features.columns):
+            features = pandas.DataFrame(index=range(len(data)))
+        color = kwargs.get("edge_color", self.layer.current_edge_color)
+
+        self._data.extend(data)  # also level of detail 0
+        self._shape_type.extend(shape_type)
+        self._features = pandas.concat(
+            [self._features, features], ignore_index=True
+        )
+        self._deleted = numpy.append(
+            self._deleted, numpy.zeros(len(data), dtype=bool)
+        )
+        self._colors = numpy.concatenate(
+            [self._colors, numpy.tile(transform_color(color), (len(data), 1))]
+        )
+        for lod, tolerance in zip(
+            self._lods[1:], lod_tolerances(self.downsamples)[1:]
+        ):
+            lod.extend(simplify_shapes(data, shape_type, tolerance))
+        self._build_tree(start)
+        self._fetched = None  # the new shapes may be in view
+        self.refresh()
+
+    def close(self) -> None:
+        """Stop following the viewer and release the full set of shapes."""
+        camera = viewer_camera(self.viewer)
+        camera.events.center.disconnect(self.refresh)
+        camera.events.zoom.disconnect(self.refresh)
+        self.viewer.layers.events.removed.disconnect(self._on_removed)
+        _controllers.pop(self.layer.metadata.get("culled_shapes"), None)
+
+    def _on_removed(self, event):
+        if event.value is self.layer:
+            self.close()
+
+    def _on_edit(self, event=None):
+        if not self._updating:
+            self._edited = True
+
+    def _build_tree(self, start: int = 0):
+        # Bounds of the shapes before `start` are kept from the last build
+        bounds = numpy.array(
+            [
+                (*vertices.min(axis=0), *vertices.max(axis=0))
+                for vertices in self._data[start:]
+            ]
+        ).reshape(-1, 4)
+        if start:
+            bounds = numpy.concatenate([self._bounds[:start], bounds])
+        self._bounds = bounds
+        self._tree = shapely.STRtree(shapely.box(*bounds.T))
+        self._areas = (bounds[:, 2] - bounds[:, 0]) * (
+            bounds[:, 3] - bounds[:, 1]
+        )
+
+
+def add_culled_shapes(
+    viewer,
+    layer_data: list,
+    max_shapes: int = MAX_VISIBLE_SHAPES,
+    downsamples: Optional[Sequence[float]] = None,
+) -> list:
+    """
+    Add annotation layers to a viewer, culling the Shapes layers to the
+    view.
+
+    Parameters:
+    viewer (napari.Viewer): The viewer.
+    layer_data (list[LayerDataTuple]): Layers from `load_geojson` or `load_parquet`. Points layers are added as they are.
+    max_shapes (int): Maximum number of shapes displayed at once per layer.
+    downsamples (Optional[Sequence[float]]): Downsample of each level of the annotated image pyramid, to simplify outlines with.
+
+    Returns:
+    list[CulledShapes]: The controllers of the Shapes layers.
+    """
+    import napari.layers
+
+    controllers = []
+    for data, kwargs, layer_type in layer_data:
+        if layer_type != "shapes":
+            viewer.add_layer(
+                napari.layers.Layer.create(data, kwargs, layer_type)
+            )
+            continue
+        controller = CulledShapes(
+            viewer, data, kwargs, max_shapes, downsamples=downsamples
+        )
+        viewer.add_layer(controller.layer)
+        controller.refresh()
+        controllers.append(controller)
+    return controllers
+
+
+def culled_shapes(layer_metadata: dict) -> Optional[CulledShapes]:
+    """Return the controller of a culled layer from its metadata, if any."""
+    key = (layer_metadata or {}).get("culled_shapes")
+    return None if key is None else _controllers.get(key)
+
+
+def view_box(viewer, layer, center: Optional[Sequence[float]] = None):
+    """
+    Return the (row_min, col_min, row_max, col_max) box of the view of a
+    viewer in data coordinates of a layer, around `center` (in world
+    coordinates) if given rather than the camera center.
+    """
+    camera = viewer_camera(viewer)
+    if center is None:
+        center = camera.center[-2:]
+    center = numpy.asarray(center, dtype=float)
+    canvas = getattr(viewer, "canvas", None)
+    # Canvas size is (height, width), as the (row, column) center
+    size = numpy.asarray(getattr(canvas, "size", (800, 800)), float)
+    half = size / 2 / camera.zoom
+    scale = numpy.asarray(layer.scale[-2:], dtype=float)
+    translate = numpy.asarray(layer.translate[-2:], dtype=float)
+    low = (center - half - translate) / scale
+    high = (center + half - translate) / scale
+    return (*low, *high)
+
+
+def viewer_camera(viewer):
+    """Return the camera of a viewer, which napari 0.9 moved to the scene."""
+    scene = getattr(viewer, "scene", None)
+    return viewer.camera if scene is None else scene.camera
+
+
+def _contains(outer, inner):
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and outer[2] >= inner[2]
+        and outer[3] >= inner[3]
+    )
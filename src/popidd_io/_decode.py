@@ -0,0 +1,184 @@
+"""
+Concurrent tile decoding.
+
+All reads of a slide used to go through a single tifffile `aszarr` store,
+whose file handle is serialised by a lock, so neighbouring tiles could not
+be read in parallel. `ParallelTiffStore` gives every worker its own store
+(and thus its own file handle) on the slide. Chunks are decoded in the
+calling thread, or in a bounded thread or process pool when zarr asks for
+several chunks at once; the process pool also serves single chunks, for
+codecs that hold the GIL. Pools are created on first use and shared by all
+stores with the same executor and number of workers, so opening slides
+does not leave pools behind.
+"""
+
+import atexit
+import multiprocessing
+import os
+import pathlib
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import tifffile
+
+from ._tiles import METADATA_KEYS, ReadOnlyStore
+
+EXECUTORS = ("thread", "process")
+PROCESS_STORES = 8  # slides kept open by each decoding process
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ParallelTiffStore(ReadOnlyStore):
+    """
+    Read-only zarr store decoding TIFF tiles with per-worker file handles.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the TIFF file.
+    n_workers (Optional[int]): Size of the decoding pool. Defaults to the number of CPUs.
+    executor (str): "thread" to decode in threads, each with its own file handle, or "process" to move reads and codec work to a process pool.
+    """
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        n_workers: Optional[int] = None,
+        executor: str = "thread",
+    ):
+        if executor not in EXECUTORS:
+            raise ValueError(
+                f"Unknown executor {executor!r}, expected one of {EXECUTORS}"
+            )
+        self.path = str(path)
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.executor = executor
+        # Processes reopen the slide if it changed since they last read it
+        self._source = (self.path, os.stat(self.path).st_mtime_ns)
+        super().__init__(tifffile.imread(self.path, aszarr=True))
+        self._local = threading.local()
+        self._stores = []
+        self._lock = threading.Lock()
+        # Handles are closed with the store, or once it is garbage collected
+        self._finalizer = weakref.finalize(
+            self, _close_stores, self.store, self._stores, self._lock
+        )
+
+    @property
+    def _pool(self):
+        return get_pool(self.executor, self.n_workers)
+
+    def __getitem__(self, key):
+        if key.endswith(METADATA_KEYS):
+            return self.store[key]
+        if self.executor == "process":
+            chunk = self._pool.submit(
+                _process_read, self._source, key
+            ).result()
+            if chunk is None:
+                raise KeyError(key)
+            return chunk
+        return self._thread_store()[key]
+
+    def getitems(self, keys, *, contexts=None):
+        """Decode several chunks concurrently, skipping missing ones."""
+        keys = list(keys)
+        if self.executor == "process":
+            chunks = self._pool.map(
+                _process_read, [self._source] * len(keys), keys
+            )
+        elif len(keys) == 1:
+            # Not worth a hop to the pool, e.g. the tiles of `iter_tiles`
+            chunks = [self._thread_read(keys[0])]
+        else:
+            chunks = self._pool.map(self._thread_read, keys)
+        return {
+            key: chunk for key, chunk in zip(keys, chunks) if chunk is not None
+        }
+
+    def close(self):
+        """Close the file handles of the store; the shared pool is kept."""
+        self._finalizer()
+
+    def _thread_store(self):
+        # One store, and file handle, per thread
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = tifffile.imread(self.path, aszarr=True)
+            self._local.store = store
+            with self._lock:
+                self._stores.append(store)
+        return store
+
+    def _thread_read(self, key):
+        try:
+            return self._thread_store()[key]
+        except KeyError:
+            return None
+
+
+def get_pool(executor: str = "thread", n_workers: Optional[int] = None):
+    """
+    Return the decoding pool shared by the stores with these settings.
+
+    Process pools start their workers with "spawn", as forking the
+    threaded napari process can deadlock.
+
+    Parameters:
+    executor (str): "thread" or "process".
+    n_workers (Optional[int]): Size of the pool. Defaults to the number of CPUs.
+
+    Returns:
+    concurrent.futures.Executor: The pool, created on first use.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    with _pools_lock:
+        pool = _pools.get((executor, n_workers))
+        if pool is None:
+            if executor == "process":
+                pool = ProcessPoolExecutor(
+                    n_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                pool = ThreadPoolExecutor(
+                    n_workers, thread_name_prefix="popidd-decode"
+                )
+            _pools[(executor, n_workers)] = pool
+    return pool
+
+
+@atexit.register
+def shutdown_pools() -> None:
+    """Shut the shared decoding pools down, e.g. at exit."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _pools.clear()
+
+
+def _close_stores(store, stores, lock):
+    with lock:
+        for thread_store in stores:
+            thread_store.close()
+        stores.clear()
+    store.close()
+
+
+# Stores of the slides read by a decoding process, least recently used first
+_process_stores = OrderedDict()
+
+
+def _process_read(source, key):
+    store = _process_stores.pop(source, None)
+    if store is None:
+        store = tifffile.imread(source[0], aszarr=True)
+        if len(_process_stores) >= PROCESS_STORES:
+            _process_stores.popitem(last=False)[1].close()
+    _process_stores[source] = store
+    try:
+        return store[key]
+    except KeyError:
+        return None
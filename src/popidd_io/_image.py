@@ -1,3 +1,5 @@
+import enum
+import logging
 import pathlib
 import warnings
 from typing import Optional
@@ -10,6 +12,24 @@ from dask import array as darray
 from napari.utils import Colormap
 from napari.utils.notifications import WarningNotification
 
+from ._decode import ParallelTiffStore
+from ._infer import (
+    CONTRAST_PERCENTILES,
+    SAMPLE_PIXEL_BUDGET,
+    channel_limits,
+    infer_intensity,
+    sample_level,
+)
+from ._instrument import InstrumentedStore, get_profiler, span
+from ._metadata import SlideMetadata, xml_fields
+from ._profile import cache_disabled, get_profile_cache
+from ._pyramid import complete_pyramid, find_pyramid, save_pyramid
+from ._tiles import CachedTileStore, file_namespace
+from ._transcode import find_transcoded, open_transcoded
+from ._virtual import VIRTUAL_TILE, VirtualTileStore
+
+logger = logging.getLogger(__name__)
+
 # from typing import TYPE_CHECKING
 # if TYPE_CHECKING:
 #     import napari
@@ -19,6 +39,14 @@ def load_img(
     path: str | pathlib.Path,
     modality: Optional[str] = None,
     load_mem: bool = False,
+    use_cache: bool = True,
+    tile_cache: bool = False,
+    decode_workers: int = 0,
+    decode_executor: str = "thread",
+    use_transcoded: bool = True,
+    pyramid: Optional[str] = "mean",
+    persist_pyramid: bool = False,
+    contrast_percentiles: Optional[tuple[float, float]] = CONTRAST_PERCENTILES,
 ) -> list["napari.typesLayerDataTuple"]:
     """
     Load an image file and convert it to a list of image layers for use in napari.
@@ -27,53 +55,121 @@ def load_img(
     path (str | pathlib.Path): The path to the image file.
     modality (Optional[str]): The modality of the image (e.g., "BF" for Brightfield, "IF" for Immunofluorescence). If None, the modality will be inferred.
     load_mem (bool): Whether to load the image into memory.
+    use_cache (bool): Whether to reuse (and store) the slide profile from the on-disk profile cache, skipping the intensity reduction and metadata parsing on warm reopens. Also turned off by the POPIDD_NO_CACHE environment variable.
+    tile_cache (bool): Whether to serve decoded tiles through the process-wide tile cache, shared by all layers and channels of the slide.
+    decode_workers (int): Number of workers decoding tiles concurrently, each with its own file handle. 0 reads through a single shared handle.
+    decode_executor (str): "thread" or "process", the pool used by the decoding workers.
+    use_transcoded (bool): Whether to open the transcoded Zarr store of the slide (see `transcode`) instead of the slide, if there is one newer than the slide.
+    pyramid (Optional[str]): How levels missing below the smallest level of the slide are generated lazily, "mean" or "nearest". None keeps the levels of the slide as they are.
+    persist_pyramid (bool): Whether to compute the generated levels once and save them to the cache, so that later opens are instant.
+    contrast_percentiles (Optional[tuple[float, float]]): Percentiles of the smallest level used as contrast limits of each fluorescence channel, kept in the slide profile. None gives every channel [0, int_scale].
 
     Returns:
     list[napari.types.LayerDataTuple]: A list of LayerDataTuple containing the image layer information.
     """
 
-    if isinstance(path, str):
-        print("PATH IS A STRINGG!!!!!")
-        path = pathlib.Path(path)
+    path = pathlib.Path(path)
+
+    # One parse of the slide serves the levels, the inference and the tags
+    with span("open", slide=path.name):
+        transcoded = find_transcoded(path) if use_transcoded else None
+        if transcoded is not None:
+            # The store holds the full profile, nothing to infer or parse
+            cache = tif = None
+            zarray, profile = open_transcoded(transcoded, load_mem)
+        else:
+            use_cache = use_cache and not cache_disabled()
+            cache = get_profile_cache() if use_cache else None
+            profile = cache.get(path) if cache is not None else None
+            tif = tifffile.TiffFile(path)
+            zarray = open_img(
+                path,
+                load_mem,
+                tile_cache,
+                decode_workers,
+                decode_executor,
+                tif=tif,
+            )
+    # Inferred from the levels of the slide, which are sampled tile by
+    # tile, not from generated levels that are computed from all of them
+    if profile is None:
+        with span("profile_reduction", slide=path.name):
+            profile = infer_img(path, zarray, tif=tif)
+    md = _profile_md(
+        path, zarray, profile, modality, cache, contrast_percentiles, tif
+    )
+    if transcoded is None and pyramid is not None:
+        with span("pyramid", slide=path.name):
+            zarray = _complete_levels(
+                path, zarray, pyramid, persist_pyramid, load_mem
+            )
+    if tif is not None and decode_workers:
+        # The decoding workers have their own handles
+        tif.close()
+
+    with span("layers", slide=path.name):
+        return _layer_data(path, zarray, md, md.modality)
 
-    zarray, int_scale, _ = read_img(path, load_mem)  # return modality
+
+def _profile_md(path, zarray, profile, modality, cache, percentiles, tif):
+    # Completes the profile with what it lacks, saves it and wraps it
+    _ = profile["modality"]
     if modality is None:
         modality = _
-    else:
-        print(modality)
-        print(_)
-        if modality == _:
-            print("Selected modality matches expectations")
-        else:
-            print("Something is off!")
-    md = read_md(path, modality)
-    md["int_scale"] = int_scale
+    elif modality != _:
+        logger.warning(
+            "Selected modality %s of %s does not match the inferred %s",
+            modality,
+            path.name,
+            _,
+        )
+
+    updated = False
+    if "res_scale" not in profile or (
+        modality == "IF" and "colmap_channels" not in profile
+    ):
+        with span("tag_parse", slide=path.name):
+            profile.update(profile_from_md(read_md(path, modality, tif)))
+        updated = True
+    if (
+        modality == "IF"
+        and percentiles is not None
+        and profile.get("contrast_percentiles") != list(percentiles)
+    ):
+        with span("contrast_limits", slide=path.name):
+            profile["channel_limits"] = channel_limits(
+                sample_level(zarray[-1]), percentiles
+            )
+        profile["contrast_percentiles"] = list(percentiles)
+        updated = True
+    if updated and cache is not None:
+        cache.put(path, profile)
+    return _md_from_profile(
+        path, profile, modality, limits=percentiles is not None
+    )
 
-    print("Image was initiliased")
 
+def _layer_data(path, zarray, md, modality):
+    logger.debug("Building %s layers of %s", modality, path.name)
     if modality == "BF":
-        print("Brightfield")
         img_layer_data = [
             (
                 zarray,
                 {
                     "name": path.stem,
-                    "scale": md["res_scale"],
-                    "metadata": md,
-                    "contrast_limits": [0, md["int_scale"]],
+                    "scale": md.res_scale,
+                    "metadata": md.view(),
+                    "contrast_limits": [0, md.int_scale],
                 },
                 "image",
             )
         ]
     else:
-        print("Fluorescence")
         img_layer_data = []
-        for index, (target, col) in enumerate(md["colmap_channels"].items()):
-            md["dye"] = target
-            layer = md["dye"]
-            if md["new_format"] == True:
-                md["biomarker"] = md["fluor_to_marker"][target]
-                layer = md["biomarker"]
+        for index, (target, col) in enumerate(md.colmap_channels.items()):
+            # Each layer gets its own view of the shared slide metadata
+            channel = md.channel(index)
+            layer = channel.biomarker or target
             cmap = Colormap(
                 colors=numpy.array([(0, 0, 0, 1), col + (1,)]), name=target
             )
@@ -85,11 +181,15 @@ def load_img(
                     channel_zarray,
                     {
                         "name": f"{layer}_{path.stem}",
-                        "scale": md["res_scale"],
+                        "scale": md.res_scale,
                         "colormap": cmap,
                         "blending": "additive",
-                        "metadata": md,
-                        "contrast_limits": [0, md["int_scale"]],
+                        "metadata": channel,
+                        "contrast_limits": (
+                            md.channel_limits[index]
+                            if md.channel_limits is not None
+                            else [0, md.int_scale]
+                        ),
                     },
                     "image",
                 )
@@ -98,105 +198,183 @@ def load_img(
     return img_layer_data
 
 
-def read_img(img, load_mem):  # img is pathlib path
-    # Loading Image data
-    image = tifffile.imread(img, aszarr=True)
+def open_img(
+    img,
+    load_mem,
+    tile_cache=False,
+    decode_workers=0,
+    decode_executor="thread",
+    tif=None,
+    virtual_tile=VIRTUAL_TILE,
+):  # img is pathlib path
+    """
+    Open the pyramid levels of an image without decoding any pixels.
+
+    Returns a list of dask arrays, or of zarr arrays if `load_mem` is set.
+    With `tile_cache`, decoded tiles are kept in the process-wide tile cache.
+    With `decode_workers`, tiles are decoded by a pool of workers with their
+    own file handles (see `ParallelTiffStore`). Otherwise an already opened
+    `tifffile.TiffFile` of the image can be passed as `tif` to avoid
+    parsing the file again; the levels then read through it, so it must
+    stay open. Levels whose strips or tiles exceed `virtual_tile` pixels
+    get chunks of that size (see `VirtualTileStore`), 0 keeps the TIFF
+    chunking.
+    """
+    zarray = _open_levels(
+        img, tile_cache, decode_workers, decode_executor, tif, virtual_tile
+    )
+    if not load_mem:
+        zarray = [darray.from_zarr(array) for array in zarray]
+    return zarray
+
+
+def _complete_levels(path, zarray, method, persist, load_mem):
+    saved = find_pyramid(path, load_mem)
+    if saved is None and persist:
+        save_pyramid(path, zarray, method)
+        saved = find_pyramid(path, load_mem)
+    if saved is not None:
+        return zarray + saved
+    return complete_pyramid(zarray, method)
+
+
+def _open_levels(
+    img,
+    tile_cache=False,
+    decode_workers=0,
+    decode_executor="thread",
+    tif=None,
+    virtual_tile=VIRTUAL_TILE,
+):
+    if decode_workers:
+        image = ParallelTiffStore(img, decode_workers, decode_executor)
+    elif tif is not None:
+        image = tif.aszarr()
+    else:
+        image = tifffile.imread(img, aszarr=True)
+    if get_profiler() is not None:
+        image = InstrumentedStore(image, pathlib.Path(img).name)
+    if virtual_tile:
+        image = _virtual_levels(image, img, virtual_tile, tif)
+    if tile_cache:
+        image = CachedTileStore(image, file_namespace(img))
     image = zarr.open(image, "r")
     if isinstance(image, zarr.hierarchy.Group):
-        zarray = [array for _, array in image.arrays()]
-    else:
-        zarray = [image]
-
-    print(len(zarray), zarray[0], zarray[0].shape)
-
-    dask_array = darray.from_zarr(
-        zarray[-1]
-    )  # Convert zarr array to Dask array
-    max_val, mean_val = darray.compute(dask_array.max(), dask_array.mean())
-    # need to add here test for image modality
-    print(dask_array.shape, dask_array)
-    print(mean_val)
-    modality = "BF"
-    if mean_val < 100:
-        modality = "IF"
-    if 1 < max_val <= 255:  # Image in 8bit col
-        print("8bit!")
-        int_scale = 255
-    elif (
-        255 < max_val <= 4095
-    ):  # Image is 12bit colour, not 16! -> Checking actual values since Bits entry in XML lies and says 12bits for the Luca 8bit image
-        print("12bit!")
-        int_scale = 4095
-        # int_scale = 255
-    elif 4095 < max_val <= 65535:  # image in 16bit colour
-        print("16 bit!")
-        int_scale = 65535
-        # int_scale = 255
+        return [array for _, array in image.arrays()]
+    return [image]
+
+
+def _virtual_levels(image, img, tile, tif):
+    # Re-chunks striped and huge-tile levels, memory mapping them if they
+    # are uncompressed; other slides keep their store
+    virtual = VirtualTileStore(image, file_namespace(img), tile)
+    if not virtual.virtual:
+        return image
+    if tif is None:
+        with tifffile.TiffFile(img) as tif:
+            return VirtualTileStore(image, file_namespace(img), tile, tif)
+    return VirtualTileStore(image, file_namespace(img), tile, tif)
+
+
+def read_img(
+    img, load_mem, strategy="auto", pixel_budget=SAMPLE_PIXEL_BUDGET
+):  # img is pathlib path
+    # Loading Image data
+    zarray = open_img(img, load_mem)
+    inferred = infer_img(img, zarray, strategy, pixel_budget)
+    return zarray, inferred["int_scale"], inferred["modality"]
+
+
+def infer_img(
+    img, zarray, strategy="auto", pixel_budget=SAMPLE_PIXEL_BUDGET, tif=None
+):
+    """
+    Infer the intensity range and modality of an opened image.
+
+    Parameters:
+    img (pathlib.Path): The path to the image file, whose tags are checked first.
+    zarray (list): The pyramid levels returned by `open_img`.
+    strategy (str): "auto", "tags", "sample" or "full", see `infer_intensity`.
+    pixel_budget (int): Maximum number of pixels decoded when sampling.
+    tif (Optional[tifffile.TiffFile]): The image, if already opened.
+
+    Returns:
+    dict: The "int_scale" and "modality" of the image, and which strategy decided each ("decided_by").
+    """
+    if strategy == "full":
+        inferred = infer_intensity(zarray, strategy=strategy)
+    elif tif is not None:
+        inferred = infer_intensity(zarray, tif, strategy, pixel_budget)
     else:
-        raise NotImplementedError
+        with tifffile.TiffFile(img) as tif:
+            inferred = infer_intensity(zarray, tif, strategy, pixel_budget)
+    logger.debug("Inferred %s for %s", inferred, pathlib.Path(img).name)
+    return {
+        "int_scale": inferred["int_scale"],
+        "modality": inferred["modality"],
+        "decided_by": inferred["decided_by"],
+    }
 
-    del dask_array
-    if not load_mem:
-        zarray = [darray.from_zarr(array) for array in zarray]
 
-    return zarray, int_scale, modality  # returns list of zarr arrays
+def read_md(img, modality, tif=None) -> SlideMetadata:
+    """
+    Read the metadata of an image from its tags.
 
+    Only the first page is read for the resolution, and for fluorescence
+    images the channel name and colour of each channel page. The other tags
+    of the first page are converted when first looked up.
 
-def read_md(img, modality):
-    # Loading Image metadata
-    res_scale = (1, 1)
-    with tifffile.TiffFile(img) as src:
-        full_res_tags = {
-            tag.name: tag.value
-            for tag in src.series[0].pages[0].tags.values()
-            if tag.name
-            not in [
-                "StripOffsets",
-                "StripByteCounts",
-                "TileOffsets",
-                "TileByteCounts",
-            ]
-            and not isinstance(tag.value, numpy.ndarray)
-        }
-        full_res_tags["ImagePath"] = img
-        try:
-            if str(full_res_tags["ResolutionUnit"]) in [
-                "RESUNIT.CENTIMETER",
-                "3",
-            ]:
-                xres = full_res_tags["XResolution"]
-                yres = full_res_tags["YResolution"]
-                x_scale = xres[1] / xres[0]
-                y_scale = yres[1] / yres[0]
-                res_scale = (x_scale, y_scale)
-            elif str(full_res_tags["ResolutionUnit"]) in ["RESUNIT.INCH", "2"]:
-                xres = full_res_tags["XResolution"]
-                yres = full_res_tags["YResolution"]
-                x_scale = (xres[1] / xres[0]) * 2.54
-                y_scale = (yres[1] / yres[0]) * 2.54
-                res_scale = (x_scale, y_scale)
-            else:
-                print(str(full_res_tags["ResolutionUnit"]))
-                raise NotImplementedError(
-                    "Scaling supports only images in centimeters or inches"
-                )
-        except Exception as e:
-            warning_noMD = warnings.warn(
-                f"Could not detect resolution metadata for image \n {img.stem}. \n Exception: {e}"
-            )
-            WarningNotification(warning_noMD)
+    Parameters:
+    img (pathlib.Path): The path to the image file.
+    modality (Optional[str]): "IF" also reads the channels.
+    tif (Optional[tifffile.TiffFile]): The image, if already opened.
 
-        md = full_res_tags
-        md["path"] = img
-        md["modality"] = modality
-        md["res_scale"] = res_scale
+    Returns:
+    SlideMetadata: The metadata, (1, 1) as resolution if it is missing.
+    """
+    img = pathlib.Path(img)
+    if tif is None:
+        with tifffile.TiffFile(img) as tif:
+            return read_md(img, modality, tif)
 
-        if modality == "IF":
-            md["fluor_to_marker"], md["colmap_channels"], md["new_format"] = (
-                _get_mdIF(src)
+    tags = tif.series[0].pages[0].tags
+    res_scale = (1, 1)
+    try:
+        unit = str(tags["ResolutionUnit"].value)
+        if unit in ["RESUNIT.CENTIMETER", "3"]:
+            factor = 1
+        elif unit in ["RESUNIT.INCH", "2"]:
+            factor = 2.54
+        else:
+            raise NotImplementedError(
+                "Scaling supports only images in centimeters or inches"
             )
+        xres = tags["XResolution"].value
+        yres = tags["YResolution"].value
+        res_scale = (
+            (xres[1] / xres[0]) * factor,
+            (yres[1] / yres[0]) * factor,
+        )
+    except Exception as e:
+        warning_noMD = warnings.warn(
+            f"Could not detect resolution metadata for image \n {img.stem}. \n Exception: {e}"
+        )
+        WarningNotification(warning_noMD)
+
+    fluor_to_marker = colmap_channels = new_format = None
+    if modality == "IF":
+        with span("xml_parse"):
+            fluor_to_marker, colmap_channels, new_format = _get_mdIF(tif)
 
-    return md
+    return SlideMetadata(
+        img,
+        modality,
+        res_scale,
+        fluor_to_marker=fluor_to_marker,
+        colmap_channels=colmap_channels,
+        new_format=new_format,
+        tags=tags,
+    )
 
 
 def _get_mdIF(TiffFile):
@@ -218,23 +396,24 @@ def _get_mdIF(TiffFile):
                 if "fluor" in item and "marker" in item
             }
 
+    name = (
+        ".//Responsivity/Band/Name"
+        if new_format
+        else ".//Responsivity/Filter/Name"
+    )
     colmap_channels = {}
     for page in TiffFile.series[0].pages:
         try:
-            xml = ElementTree.fromstring(page.tags["ImageDescription"].value)
-            if new_format == True:
-                colmap_channels[xml.find(".//Responsivity/Band/Name").text] = (
-                    tuple(
-                        float(x) for x in xml.find(".//Color").text.split(",")
-                    )
-                )
-            else:
-                colmap_channels[
-                    xml.find(".//Responsivity/Filter/Name").text
-                ] = tuple(
-                    float(x) for x in xml.find(".//Color").text.split(",")
-                )
-        except:  # attribute error on the else above and keyerror on the imagedescription
+            # Only the two elements needed, without building the whole tree
+            fields = xml_fields(
+                page.tags["ImageDescription"].value, name, ".//Color"
+            )
+            if fields[name] is None:
+                raise AttributeError(name)
+            colmap_channels[fields[name]] = tuple(
+                float(x) for x in fields[".//Color"].split(",")
+            )
+        except:  # attribute error on a missing element and keyerror on the imagedescription
             single_page_md = True
 
     # EXPERIMENTAL, to be worked upon
@@ -246,23 +425,84 @@ def _get_mdIF(TiffFile):
         for channel in channels.findall("channel"):
             channel_id = channel.get("id")
             channel_name = channel.get("name")
-            print(channel_name)
             rgb_value = int(channel.get("rgb"))
             # Convert the RGB integer to a tuple of (R, G, B)
             r = (rgb_value >> 16) & 0xFF
             g = (rgb_value >> 8) & 0xFF
             b = rgb_value & 0xFF
             colmap_channels[channel_name] = (r, g, b)
-        print(channels)
-        print(channels.text)
-        print(channels.text.split(","))
 
-    print(colmap_channels)
     colmap_channels = {
         key: tuple(
             v / 255 if max(colmap_channels[key]) > 1 else v for v in val
         )
         for key, val in colmap_channels.items()
     }
-    print(colmap_channels)
+    logger.debug("Channel colours %s", colmap_channels)
     return fluor_to_marker, colmap_channels, new_format
+
+
+def profile_from_md(md) -> dict:
+    """
+    Return the parts of the slide metadata from `read_md` that are kept in
+    a slide profile, in JSON-safe form.
+    """
+    profile = {
+        "res_scale": list(md.res_scale),
+        "tags": {
+            name: value
+            for name, value in (
+                (name, _jsonable(value)) for name, value in md.tags.items()
+            )
+            if value is not None
+        },
+    }
+    if md.colmap_channels is not None:
+        profile["fluor_to_marker"] = md.fluor_to_marker
+        profile["colmap_channels"] = {
+            key: list(val) for key, val in md.colmap_channels.items()
+        }
+        profile["new_format"] = md.new_format
+    return profile
+
+
+def _md_from_profile(img, profile, modality, limits=True):
+    # Rebuilds the metadata read_md would have produced, with the
+    # inferred intensity and, if `limits`, the channel contrast limits
+    fields = {}
+    if modality == "IF":
+        fields = {
+            "fluor_to_marker": profile["fluor_to_marker"],
+            "colmap_channels": {
+                key: tuple(val)
+                for key, val in profile["colmap_channels"].items()
+            },
+            "new_format": profile["new_format"],
+        }
+        if limits:
+            fields["channel_limits"] = profile.get("channel_limits")
+    return SlideMetadata(
+        img,
+        modality,
+        profile["res_scale"],
+        int_scale=profile["int_scale"],
+        tags=profile["tags"],
+        **fields,
+    )
+
+
+def _jsonable(value):
+    # Tag values come as enums, tuples, bytes, dicts...; None if not storable
+    if isinstance(value, enum.Enum):
+        return value.value if isinstance(value.value, int) else value.name
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (numpy.integer, numpy.floating)):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        items = [_jsonable(item) for item in value]
+        return None if None in items else items
+    if isinstance(value, dict):
+        items = {str(key): _jsonable(item) for key, item in value.items()}
+        return None if None in items.values() else items
+    return None
@@ -0,0 +1,280 @@
+"""
+Bit depth and modality inference for slides.
+
+`read_img` used to decide both from a full max/mean reduction over the
+lowest pyramid level, which decodes the entire level before the first frame
+is shown. `infer_intensity` tries cheaper strategies first:
+
+- "tags": BitsPerSample, SMaxSampleValue, SampleFormat, photometric
+  interpretation and OME-XML SignificantBits of the first page.
+- "sample": max/mean over a stratified sample of native tiles of the lowest
+  level, bounded by a pixel budget.
+- "full": the full reduction over the lowest level, only used on request
+  (or when the level already fits in the pixel budget, or when every
+  sampled tile is blank).
+"""
+
+import math
+from xml.etree import ElementTree
+
+import numpy
+from dask import array as darray
+
+STRATEGIES = ("auto", "tags", "sample", "full")
+CONTRAST_PERCENTILES = (0.5, 99.5)
+SAMPLE_PIXEL_BUDGET = 4 * 1024 * 1024
+IF_MEAN_THRESHOLD = 100  # darker slides are taken to be fluorescence
+
+
+def int_scale_from_max(max_val) -> int:
+    """
+    Map the maximum intensity of a slide to its intensity range.
+
+    The actual values are checked rather than the container dtype since
+    12bit images are stored as 16bit (and the Bits entry in some vendor XML
+    lies and says 12bits for 8bit images).
+    """
+    if 1 < max_val <= 255:  # Image in 8bit col
+        return 255
+    elif 255 < max_val <= 4095:  # Image is 12bit colour, not 16!
+        return 4095
+    elif 4095 < max_val <= 65535:  # image in 16bit colour
+        return 65535
+    raise NotImplementedError(f"Unsupported maximum intensity {max_val}")
+
+
+def modality_from_mean(mean_val) -> str:
+    """Brightfield slides are mostly bright glass, fluorescence mostly dark."""
+    return "IF" if mean_val < IF_MEAN_THRESHOLD else "BF"
+
+
+def infer_intensity(
+    levels: list,
+    tif=None,
+    strategy: str = "auto",
+    pixel_budget: int = SAMPLE_PIXEL_BUDGET,
+) -> dict:
+    """
+    Infer the intensity range and modality of a slide.
+
+    Parameters:
+    levels (list): The pyramid levels (zarr or dask arrays), full resolution first.
+    tif (Optional[tifffile.TiffFile]): Open TIFF of the slide, used by the "tags" strategy.
+    strategy (str): One of "auto" (tags, then sampling), "tags" (tags, falling back to sampling for anything the tags leave open), "sample" or "full".
+    pixel_budget (int): Maximum number of pixels decoded by the "sample" strategy.
+
+    Returns:
+    dict: "int_scale", "modality", the sampled "max" and "mean" (None if never computed) and "decided_by", mapping "int_scale" and "modality" to the strategy that decided each.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown strategy {strategy!r}, expected one of {STRATEGIES}"
+        )
+
+    result = {
+        "int_scale": None,
+        "modality": None,
+        "max": None,
+        "mean": None,
+        "decided_by": {},
+    }
+    if strategy != "full" and tif is not None:
+        for key, value in _from_tags(tif).items():
+            result[key] = value
+            result["decided_by"][key] = "tags"
+
+    if result["int_scale"] is None or result["modality"] is None:
+        if strategy == "full":
+            max_val, mean_val = _full_reduction(levels[-1])
+            decided_by = "full"
+        else:
+            max_val, mean_val, decided_by = _sample_reduction(
+                levels[-1], pixel_budget
+            )
+            if max_val <= 1 and decided_by == "sample":
+                # Every sampled tile of a mostly empty slide may be blank
+                max_val, mean_val = _full_reduction(levels[-1])
+                decided_by = "full"
+        result["max"], result["mean"] = max_val, mean_val
+        if result["int_scale"] is None:
+            result["int_scale"] = int_scale_from_max(max_val)
+            result["decided_by"]["int_scale"] = decided_by
+        if result["modality"] is None:
+            result["modality"] = modality_from_mean(mean_val)
+            result["decided_by"]["modality"] = decided_by
+
+    return result
+
+
+def channel_limits(level, percentiles=CONTRAST_PERCENTILES) -> list:
+    """
+    Robust per-channel contrast limits of a channels-first level.
+
+    Integer levels are reduced in a single pass: every channel is offset
+    into its own range of bins and counted by one `numpy.bincount`, and the
+    percentiles of all channels are read off the cumulative histograms at
+    once. Float levels fall back to `numpy.percentile`.
+
+    Parameters:
+    level: A CYX (or YX) level, small enough to hold in memory, usually the smallest.
+    percentiles (tuple[float, float]): Lower and upper percentiles.
+
+    Returns:
+    list[list[float]]: The [low, high] limits of each channel.
+    """
+    data = numpy.asarray(level)
+    channels = data.reshape(
+        -1 if data.ndim > 2 else 1, data.shape[-2] * data.shape[-1]
+    )
+    quantiles = numpy.asarray(percentiles, dtype=numpy.float64) / 100
+
+    if (
+        numpy.issubdtype(channels.dtype, numpy.integer)
+        and channels.dtype.itemsize <= 2
+    ):
+        low = int(channels.min())
+        n_bins = int(channels.max()) - low + 1
+        offsets = numpy.arange(len(channels))[:, None] * n_bins - low
+        histograms = numpy.bincount(
+            (channels + offsets).ravel(), minlength=n_bins * len(channels)
+        ).reshape(len(channels), n_bins)
+        cumulative = histograms.cumsum(axis=1)
+        targets = quantiles[None, :] * cumulative[:, -1:]
+        # First bin whose cumulative count reaches each target
+        limits = (cumulative[:, :, None] < targets[:, None, :]).sum(
+            axis=1
+        ) + low
+    else:
+        limits = numpy.percentile(channels, percentiles, axis=1).T
+
+    limits = limits.astype(numpy.float64)
+    limits[:, 1] = numpy.maximum(limits[:, 1], limits[:, 0] + 1)
+    return limits.tolist()
+
+
+def _from_tags(tif) -> dict:
+    # Only answers what the tags settle unambiguously
+    decided = {}
+    page = tif.series[0].pages[0]
+    tags = page.tags
+
+    if page.sampleformat not in (1, 2):  # floats and complex are not scaled
+        return decided
+
+    if "SMaxSampleValue" in tags:
+        smax = tags["SMaxSampleValue"].value
+        decided["int_scale"] = int_scale_from_max(numpy.max(smax))
+    elif page.bitspersample == 8:
+        decided["int_scale"] = 255
+    else:
+        significant_bits = _ome_significant_bits(page.description)
+        if significant_bits in (8, 12, 16):
+            decided["int_scale"] = 2**significant_bits - 1
+
+    if page.photometric in (2, 6) and page.samplesperpixel >= 3:
+        decided["modality"] = "BF"  # RGB or YCbCr
+    elif page.photometric in (0, 1) and "C" in tif.series[0].axes:
+        decided["modality"] = "IF"  # stack of grayscale channels
+
+    return decided
+
+
+def _ome_significant_bits(description):
+    if not description or not description.lstrip().startswith("<"):
+        return None
+    try:
+        xml = ElementTree.fromstring(description)
+    except ElementTree.ParseError:
+        return None
+    for element in xml.iter():
+        if element.tag.rsplit("}", 1)[-1] == "Pixels":
+            bits = element.get("SignificantBits")
+            return int(bits) if bits and bits.isdigit() else None
+    return None
+
+
+def _full_reduction(level):
+    dask_array = (
+        level if isinstance(level, darray.Array) else darray.from_zarr(level)
+    )
+    max_val, mean_val = darray.compute(dask_array.max(), dask_array.mean())
+    return max_val, mean_val
+
+
+def _sample_reduction(level, pixel_budget):
+    """
+    Max/mean over a stratified sample of the native tiles of `level`.
+
+    The YX tile grid is split into as many strata as tiles fit in the
+    budget and the central tile of each stratum is decoded, so the sample
+    covers the whole slide evenly. Levels within the budget are reduced in
+    full.
+    """
+    yx_axes = get_yx_axes(level.shape)
+    pixels = math.prod(level.shape[axis] for axis in yx_axes)
+    if pixels <= pixel_budget:
+        return (*_full_reduction(level), "full")
+
+    max_val, total, count = 0, 0.0, 0
+    for tile in _sample_tiles(level, pixel_budget):
+        max_val = max(max_val, tile.max())
+        total += tile.sum(dtype=numpy.float64)
+        count += tile.size
+    return max_val, total / count, "sample"
+
+
+def sample_level(level, pixel_budget: int = SAMPLE_PIXEL_BUDGET):
+    """
+    A stratified sample of the pixels of a channels-first level, as
+    `_sample_reduction` takes it, e.g. for `channel_limits`.
+
+    Parameters:
+    level: A CYX (or YX) level.
+    pixel_budget (int): Maximum number of pixels per channel decoded.
+
+    Returns:
+    numpy.ndarray: The level itself if it fits in the budget, otherwise its sampled tiles side by side, of shape (C, 1, N) (or (1, N)).
+    """
+    yx_axes = get_yx_axes(level.shape)
+    if math.prod(level.shape[axis] for axis in yx_axes) <= pixel_budget:
+        return numpy.asarray(level)
+    tiles = [
+        tile.reshape(*tile.shape[:-2], 1, -1)
+        for tile in _sample_tiles(level, pixel_budget)
+    ]
+    return numpy.concatenate(tiles, axis=-1)
+
+
+def _sample_tiles(level, pixel_budget):
+    # The central native tile of each stratum of the YX tile grid
+    yx_axes = get_yx_axes(level.shape)
+    chunks = getattr(level, "chunks", level.shape)
+    if isinstance(level, darray.Array):
+        chunks = tuple(max(c) for c in chunks)
+    tile_y, tile_x = (min(chunks[axis], 1024) for axis in yx_axes)
+    n_y = math.ceil(level.shape[yx_axes[0]] / tile_y)
+    n_x = math.ceil(level.shape[yx_axes[1]] / tile_x)
+    n_tiles = max(1, pixel_budget // (tile_y * tile_x))
+
+    # Strata grid with roughly the aspect ratio of the tile grid
+    strata_y = max(1, min(n_y, round(math.sqrt(n_tiles * n_y / n_x))))
+    strata_x = max(1, min(n_x, n_tiles // strata_y))
+    rows = ((numpy.arange(strata_y) + 0.5) * n_y / strata_y).astype(int)
+    cols = ((numpy.arange(strata_x) + 0.5) * n_x / strata_x).astype(int)
+
+    for row in rows:
+        for col in cols:
+            index = [slice(None)] * level.ndim
+            index[yx_axes[0]] = slice(row * tile_y, (row + 1) * tile_y)
+            index[yx_axes[1]] = slice(col * tile_x, (col + 1) * tile_x)
+            yield numpy.asarray(level[tuple(index)])
+
+
+def get_yx_axes(shape: tuple) -> tuple[int, int]:
+    """
+    Return the Y and X axes of a pyramid level of the given shape. Levels
+    are YX, YXS (RGB) or CYX (channels first).
+    """
+    if len(shape) == 3 and shape[-1] in (3, 4):
+        return (0, 1)
+    return (len(shape) - 2, len(shape) - 1)
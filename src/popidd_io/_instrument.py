@@ -0,0 +1,271 @@
+"""
+Timing and I/O instrumentation.
+
+Loading functions wrap their stages (opening a slide, reducing its
+intensities, parsing tags and XML, building layers, converting geometries)
+in `span`s, and slide stores count the tiles and bytes they decode. Nothing
+is recorded unless profiling is enabled, either with `enable_profiling` or
+by setting the POPIDD_PROFILE environment variable before import (to "1",
+or to a path where a Chrome trace is written at exit). Disabled, a span is
+a shared no-op context manager.
+
+Spans are logged to the "popidd_io.profile" logger at DEBUG level as they
+close, and collected by the active `Profiler`, which builds per-slide
+reports and Chrome trace files (chrome://tracing, ui.perfetto.dev).
+"""
+
+import atexit
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+from typing import Optional
+
+from ._tiles import METADATA_KEYS, ReadOnlyStore
+
+logger = logging.getLogger("popidd_io.profile")
+
+_NULL_SPAN = contextlib.nullcontext()
+_local = threading.local()
+_profiler = None
+
+
+class Profiler:
+    """Collects spans and I/O counters while profiling is enabled."""
+
+    def __init__(self):
+        self.spans = []
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    def record(self, name, slide, start, end, args):
+        """Store a finished span, times in perf_counter nanoseconds."""
+        with self._lock:
+            self.spans.append(
+                {
+                    "name": name,
+                    "slide": slide,
+                    "start": start - self._origin,
+                    "duration": end - start,
+                    "thread": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def count(self, slide, name, value=1):
+        """Add `value` to the `name` counter of a slide."""
+        with self._lock:
+            self.counters[slide][name] += value
+
+    def report(self) -> dict:
+        """
+        Summarise the recorded spans per slide.
+
+        Returns:
+        dict: For every slide, the total "seconds" and number of "calls" of each stage, and its I/O "counters".
+        """
+        with self._lock:
+            spans = list(self.spans)
+            counters = {
+                slide: dict(values) for slide, values in self.counters.items()
+            }
+        report = {}
+        for span in spans:
+            slide = report.setdefault(
+                span["slide"], {"stages": {}, "counters": {}}
+            )
+            stage = slide["stages"].setdefault(
+                span["name"], {"seconds": 0.0, "calls": 0}
+            )
+            stage["seconds"] += span["duration"] / 1e9
+            stage["calls"] += 1
+        for slide, values in counters.items():
+            report.setdefault(slide, {"stages": {}, "counters": {}})
+            report[slide]["counters"] = values
+        return report
+
+    def format_report(self) -> str:
+        """Render `report` as a plain text table."""
+        lines = []
+        for slide, summary in self.report().items():
+            lines.append(str(slide))
+            for name, stage in summary["stages"].items():
+                lines.append(
+                    f"  {name:<24}{stage['seconds'] * 1e3:10.1f} ms"
+                    f"  x{stage['calls']}"
+                )
+            for name, value in summary["counters"].items():
+                lines.append(f"  {name:<24}{value:>13}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str | pathlib.Path) -> None:
+        """Write the spans as a Chrome trace event file."""
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {
+                "name": span["name"],
+                "cat": str(span["slide"]),
+                "ph": "X",
+                "ts": span["start"] / 1e3,
+                "dur": span["duration"] / 1e3,
+                "pid": os.getpid(),
+                "tid": span["thread"],
+                "args": {"slide": str(span["slide"]), **span["args"]},
+            }
+            for span in spans
+        ]
+        with open(path, "w") as fh:
+            json.dump(
+                {"traceEvents": events, "otherData": self.report()},
+                fh,
+                default=str,
+            )
+
+
+class _Span:
+    __slots__ = ("name", "slide", "args", "start")
+
+    def __init__(self, name, slide, args):
+        self.name = name
+        self.slide = slide
+        self.args = args
+
+    def __enter__(self):
+        stack = _stack()
+        if self.slide is None:
+            # Stages of a slide inherit it from the enclosing span
+            self.slide = stack[-1].slide if stack else None
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        _stack().pop()
+        profiler = _profiler
+        if profiler is not None:
+            profiler.record(self.name, self.slide, self.start, end, self.args)
+        logger.debug(
+            "%s %s %.1f ms", self.slide, self.name, (end - self.start) / 1e6
+        )
+        return False
+
+
+def span(name: str, slide=None, **args):
+    """
+    Time a stage of loading.
+
+    Parameters:
+    name (str): The stage, e.g. "open" or "xml_parse".
+    slide: The slide (or annotation file) being loaded. Inherited from the enclosing span if None.
+    **args: Extra values shown with the span in traces.
+
+    Returns:
+    A context manager, a no-op one if profiling is disabled.
+    """
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(name, None if slide is None else str(slide), args)
+
+
+def count(slide, name: str, value: int = 1) -> None:
+    """Add to an I/O counter of a slide if profiling is enabled."""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(str(slide), name, value)
+
+
+def enable_profiling(trace_path: Optional[str | pathlib.Path] = None):
+    """
+    Start recording spans and counters.
+
+    Parameters:
+    trace_path (Optional[str | pathlib.Path]): Where to write a Chrome trace when the interpreter exits.
+
+    Returns:
+    Profiler: The profiler collecting them.
+    """
+    global _profiler
+    _profiler = Profiler()
+    if trace_path is not None:
+        atexit.register(_write_at_exit, _profiler, trace_path)
+    return _profiler
+
+
+def disable_profiling() -> Optional[Profiler]:
+    """Stop recording, returning the profiler that was active, if any."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler() -> Optional[Profiler]:
+    """Return the active profiler, None if profiling is disabled."""
+    return _profiler
+
+
+class InstrumentedStore(ReadOnlyStore):
+    """
+    Read-only zarr store counting the chunks and bytes it decodes.
+
+    Only used while profiling is enabled.
+
+    Parameters:
+    store (MutableMapping): The store to wrap.
+    slide: The slide the counters are attributed to.
+    """
+
+    def __init__(self, store: MutableMapping, slide):
+        super().__init__(store)
+        self.slide = slide
+
+    def __getitem__(self, key):
+        chunk = self.store[key]
+        if not key.endswith(METADATA_KEYS):
+            self._count(chunk)
+        return chunk
+
+    def getitems(self, keys, *, contexts=None):
+        chunks = self._read_many(keys, contexts)
+        for key, chunk in chunks.items():
+            if not key.endswith(METADATA_KEYS):
+                self._count(chunk)
+        return chunks
+
+    def _count(self, chunk):
+        count(self.slide, "tiles_decoded")
+        count(
+            self.slide,
+            "bytes_decoded",
+            getattr(chunk, "nbytes", None) or len(chunk),
+        )
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _write_at_exit(profiler, path):
+    profiler.write_trace(path)
+    logger.info("Profile written to %s", path)
+
+
+def _from_environment():
+    value = os.environ.get("POPIDD_PROFILE", "")
+    if value.lower() in ("", "0", "false", "no"):
+        return
+    trace_path = None if value.lower() in ("1", "true", "yes") else value
+    enable_profiling(trace_path)
+
+
+_from_environment()
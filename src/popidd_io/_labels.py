@@ -0,0 +1,293 @@
+"""
+Cell detections as a lazily rasterized multiscale Labels layer.
+
+Millions of cell outlines are far too many shapes for napari, but drawn
+into a labels image they render at image speed. `CellRaster` indexes the
+outlines once in an STRtree and rasterizes a window of any pyramid level on
+demand from only the cells intersecting it; `load_cell_labels` wraps its
+levels in dask arrays chunked like the companion image, and decoded chunks
+go through the process-wide tile cache (see `TileCache`).
+"""
+
+import logging
+import pathlib
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy
+import pandas
+import shapely
+from dask import array as darray
+from napari.types import LayerDataTuple
+from skimage.draw import polygon as draw_polygon
+
+from ._anno import (
+    POLYGON,
+    class_name,
+    feature_classes,
+    explode_geoms,
+    iter_geojson,
+    iter_parquet,
+)
+from ._infer import get_yx_axes
+from ._instrument import span
+from ._tiles import file_namespace, get_tile_cache
+
+logger = logging.getLogger(__name__)
+
+LABELS_CHUNK = 512
+COLOR_BY = ("class", "cell")
+CELL_PROPERTIES = ("id", "name", "classification")
+
+
+class CellRaster:
+    """
+    Rasterizer of cell outlines into label windows.
+
+    Parameters:
+    geoms (numpy.ndarray): Shapely polygons of the cells, in QuPath (x, y) full resolution pixel coordinates.
+    values (numpy.ndarray): The label drawn for each cell, 0 being background.
+    namespace (str): Identifies the cells in the tile cache.
+    """
+
+    def __init__(self, geoms: numpy.ndarray, values: numpy.ndarray, namespace):
+        parts, source = explode_geoms(numpy.asarray(geoms, dtype=object))
+        polygons = shapely.get_type_id(parts) == POLYGON
+        parts, source = parts[polygons], source[polygons]
+        self.values = numpy.asarray(values, dtype=numpy.uint32)[source]
+        self.exteriors = shapely.get_exterior_ring(parts)
+        self.bounds = shapely.bounds(parts)
+        self.centroids = shapely.get_coordinates(shapely.centroid(parts))
+        self.tree = shapely.STRtree(parts)
+        self.namespace = namespace
+
+    def __len__(self):
+        return len(self.values)
+
+    def window(
+        self,
+        downsample: tuple[float, float],
+        start: tuple[int, int],
+        shape: tuple[int, int],
+    ) -> numpy.ndarray:
+        """
+        Rasterize a window of a pyramid level, through the tile cache.
+
+        Parameters:
+        downsample (tuple[float, float]): The (y, x) downsample of the level.
+        start (tuple[int, int]): The (row, column) of the top left pixel of the window, in pixels of the level.
+        shape (tuple[int, int]): The (rows, columns) of the window.
+
+        Returns:
+        numpy.ndarray: The uint32 labels of the window.
+        """
+        key = (self.namespace, *downsample, *start, *shape)
+        cache = get_tile_cache()
+        labels = cache.get(key)
+        if labels is None:
+            labels = self._rasterize(downsample, start, shape)
+            cache.put(key, labels)
+        return labels
+
+    def _rasterize(self, downsample, start, shape):
+        dy, dx = downsample
+        y0, x0 = start
+        labels = numpy.zeros(shape, dtype=numpy.uint32)
+        window = shapely.box(
+            x0 * dx, y0 * dy, (x0 + shape[1]) * dx, (y0 + shape[0]) * dy
+        )
+        hits = numpy.sort(self.tree.query(window))
+        if not len(hits):
+            return labels
+        bounds = self.bounds[hits]
+        # Cells smaller than a pixel of the level are drawn as one pixel
+        small = (bounds[:, 2] - bounds[:, 0] < dx) & (
+            bounds[:, 3] - bounds[:, 1] < dy
+        )
+        centroids = self.centroids[hits[small]]
+        rows = numpy.floor(centroids[:, 1] / dy).astype(numpy.int64) - y0
+        cols = numpy.floor(centroids[:, 0] / dx).astype(numpy.int64) - x0
+        inside = (
+            (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        )
+        labels[rows[inside], cols[inside]] = self.values[hits[small]][inside]
+
+        large = hits[~small]
+        coords, index = shapely.get_coordinates(
+            self.exteriors[large], return_index=True
+        )
+        # Pixel centers: the pixel (r, c) of the level covers r * dy..(r+1) * dy
+        rows = coords[:, 1] / dy - y0 - 0.5
+        cols = coords[:, 0] / dx - x0 - 0.5
+        bounds = numpy.searchsorted(index, numpy.arange(len(large) + 1))
+        for value, begin, end in zip(
+            self.values[large], bounds[:-1], bounds[1:]
+        ):
+            rr, cc = draw_polygon(rows[begin:end], cols[begin:end], shape)
+            labels[rr, cc] = value
+        return labels
+
+
+class _LabelLevel:
+    # Array-like level handed to dask.array.from_array
+    def __init__(self, raster, downsample, shape):
+        self.raster = raster
+        self.downsample = downsample
+        self.shape = shape
+        self.dtype = numpy.dtype(numpy.uint32)
+        self.ndim = 2
+
+    def __getitem__(self, window):
+        start = tuple(item.start or 0 for item in window)
+        stop = tuple(
+            size if item.stop is None else item.stop
+            for item, size in zip(window, self.shape)
+        )
+        return self.raster.window(
+            self.downsample,
+            start,
+            tuple(b - a for a, b in zip(start, stop)),
+        )
+
+
+def load_cell_labels(
+    path: str | pathlib.Path,
+    image_path: str | pathlib.Path,
+    classes: Optional[Sequence[str]] = None,
+    color_by: str = "class",
+    scale: Optional[Sequence[float]] = None,
+) -> list[LayerDataTuple]:
+    """
+    Load cell detections as a multiscale Labels layer matching an image.
+
+    The labels have the pyramid levels of the image (completed down to
+    `PYRAMID_MIN_SIZE` like `load_img` does) and its chunking, up to
+    `LABELS_CHUNK`; every chunk is rasterized when napari first draws it.
+
+    Parameters:
+    path (str | pathlib.Path): The GeoJSON or (Geo)Parquet cell detections, in image pixel coordinates.
+    image_path (str | pathlib.Path): The slide the cells were detected on.
+    classes (Optional[Sequence[str]]): Only load cells of these classes.
+    color_by (str): "class" labels every cell with its class, coloured like in QuPath; "cell" gives every cell its own label.
+    scale (Optional[Sequence[float]]): The scale of the image layer, read from the slide metadata if None.
+
+    Returns:
+    list[LayerDataTuple]: A Labels layer with one row of features per label.
+    """
+    from napari.utils.colormaps import DirectLabelColormap
+
+    from ._image import open_img, read_md
+    from ._pyramid import complete_pyramid
+
+    if color_by not in COLOR_BY:
+        raise ValueError(
+            f"color_by must be one of {COLOR_BY}, not {color_by!r}"
+        )
+    path = pathlib.Path(path)
+
+    with span("read", slide=path.name):
+        geoms, properties = _read_cells(path, classes)
+    groups, colors = feature_classes(properties)
+    names, class_index = numpy.unique(groups.astype(str), return_inverse=True)
+    with span("geometry", slide=path.name, features=len(geoms)):
+        if color_by == "class":
+            values = class_index + 1
+            features = pandas.DataFrame(
+                {
+                    "index": numpy.arange(len(names) + 1),
+                    "class": [None, *names],
+                }
+            )
+        else:
+            values = numpy.arange(1, len(geoms) + 1)
+            features = pandas.DataFrame(
+                {
+                    "index": numpy.arange(len(geoms) + 1),
+                    "id": [None, *properties.get("id", values - 1)],
+                    "class": [None, *groups],
+                }
+            )
+        raster = CellRaster(geoms, values, f"labels:{file_namespace(path)}")
+
+    levels = complete_pyramid(open_img(image_path, True), "nearest")
+    yx_axes = get_yx_axes(levels[0].shape)
+    full = numpy.array([levels[0].shape[axis] for axis in yx_axes])
+    labels = []
+    for level in levels:
+        shape = tuple(level.shape[axis] for axis in yx_axes)
+        chunks = tuple(
+            min(getattr(level, "chunksize", level.chunks)[axis], LABELS_CHUNK)
+            for axis in yx_axes
+        )
+        downsample = tuple(float(d) for d in full / shape)
+        labels.append(
+            darray.from_array(
+                _LabelLevel(raster, downsample, shape),
+                chunks=chunks,
+                asarray=False,
+                fancy=False,
+                meta=numpy.empty((0, 0), dtype=numpy.uint32),
+            )
+        )
+    logger.debug(
+        "%s: %d cells over %d label levels",
+        path.name,
+        len(raster),
+        len(labels),
+    )
+
+    if scale is None:
+        scale = read_md(pathlib.Path(image_path), None)["res_scale"]
+    kwargs = {
+        "name": f"{path.stem} labels",
+        "scale": scale,
+        "multiscale": True,
+        "features": features,
+        "metadata": {"path": path, "image_path": image_path},
+    }
+    if color_by == "class" and colors:
+        kwargs["colormap"] = DirectLabelColormap(
+            color_dict={
+                None: (0, 0, 0, 0),
+                0: (0, 0, 0, 0),
+                **{
+                    value: (*colors[name], 1)
+                    for value, name in enumerate(names, start=1)
+                    if name in colors
+                },
+            }
+        )
+    return [(labels, kwargs, "labels")]
+
+
+def _read_cells(path, classes):
+    if path.suffix.lower() == ".parquet":
+        batches = (
+            (batch_geoms, batch.to_pandas())
+            for batch_geoms, batch in iter_parquet(
+                path, classes, measurements=[]
+            )
+        )
+    else:
+        batches = _geojson_cells(path, classes)
+    geoms, tables = [], []
+    for batch_geoms, batch in batches:
+        geoms.append(batch_geoms)
+        tables.append(batch)
+    if not geoms:
+        return numpy.empty(0, dtype=object), pandas.DataFrame()
+    return numpy.concatenate(geoms), pandas.concat(tables, ignore_index=True)
+
+
+def _geojson_cells(path, classes):
+    # Batches of GeoJSON cells of the selected classes, keeping only the
+    # properties the labels are built from
+    for geoms, properties, _ in iter_geojson(path):
+        properties = properties.filter(CELL_PROPERTIES)
+        if classes is not None and "classification" in properties:
+            keep = numpy.isin(
+                [class_name(value) for value in properties["classification"]],
+                list(classes),
+            )
+            geoms, properties = geoms[keep], properties[keep]
+        yield geoms, properties.reset_index(drop=True)
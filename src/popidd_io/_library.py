@@ -0,0 +1,426 @@
+"""
+Index of a slide library.
+
+Opening every slide of a folder through `load_img` only to see what it is
+does not scale to thousands of slides. `SlideLibrary.scan` walks a
+directory tree and reads, in a process pool, what `read_md` knows about
+each slide (modality, resolution, channels), its dimensions and a small
+thumbnail made from its smallest pyramid level. Rows go into a local
+SQLite index; a rescan only reads the slides whose size or mtime changed
+and drops those that disappeared, and queries never touch the slides.
+
+Command line usage:
+
+    popidd-library /data/slides [/data/more ...] [--index lib.sqlite] [--workers 8]
+"""
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+from xml.etree import ElementTree
+
+import imagecodecs
+import numpy
+import tifffile
+
+from ._infer import CONTRAST_PERCENTILES, get_yx_axes, channel_limits
+from ._profile import default_cache_dir
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_SUFFIXES = (".tiff", ".tif", ".qptiff", ".svs", ".ndpi")
+THUMBNAIL_SIZE = 256
+THUMBNAIL_WINDOW = 4096  # pixels read at most along Y and X for a thumbnail
+# What unreadable or unsupported slides raise, indexed with the error
+SCAN_ERRORS = (
+    tifffile.TiffFileError,
+    OSError,
+    ValueError,
+    KeyError,
+    NotImplementedError,
+    ElementTree.ParseError,
+)
+COMMIT_EVERY = 100  # rows written per transaction while scanning
+COLUMNS = (
+    "path",
+    "name",
+    "size",
+    "mtime_ns",
+    "modality",
+    "width",
+    "height",
+    "n_levels",
+    "dtype",
+    "res_x",
+    "res_y",
+    "channels",
+    "thumbnail",
+    "error",
+    "scanned",
+)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slides (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    modality TEXT,
+    width INTEGER,
+    height INTEGER,
+    n_levels INTEGER,
+    dtype TEXT,
+    res_x REAL,
+    res_y REAL,
+    channels TEXT,
+    thumbnail BLOB,
+    error TEXT,
+    scanned REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slides_name ON slides (name);
+"""
+
+
+def library_path() -> pathlib.Path:
+    """Return where the slide library index is kept by default."""
+    return default_cache_dir() / "library.sqlite"
+
+
+class SlideLibrary:
+    """
+    SQLite index of slides.
+
+    Parameters:
+    path (Optional[str | pathlib.Path]): The index file, created if missing. Defaults to `library_path()`.
+    """
+
+    def __init__(self, path: Optional[str | pathlib.Path] = None):
+        self.path = library_path() if path is None else pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Queried from the Qt thread, scanned from a worker
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._db.execute(
+                "SELECT COUNT(*) FROM slides"
+            ).fetchone()
+        return count
+
+    def close(self) -> None:
+        self._db.close()
+
+    def scan(
+        self,
+        root: str | pathlib.Path,
+        n_workers: Optional[int] = None,
+        rescan: bool = False,
+    ) -> dict:
+        """
+        Index the slides of a directory tree.
+
+        Parameters:
+        root (str | pathlib.Path): The directory scanned recursively.
+        n_workers (Optional[int]): Number of processes reading slides. Defaults to the number of CPUs.
+        rescan (bool): Whether to read again the slides that did not change.
+
+        Returns:
+        dict: How many slides were "added", "updated", "unchanged", "removed" and "failed" (unreadable, kept with their error).
+        """
+        root = pathlib.Path(root).resolve()
+        found = {
+            str(path): path.stat()
+            for path in sorted(root.rglob("*"))
+            if path.suffix.lower() in LIBRARY_SUFFIXES and path.is_file()
+        }
+        with self._lock:
+            known = {
+                row["path"]: (row["size"], row["mtime_ns"])
+                for row in self._db.execute(
+                    "SELECT path, size, mtime_ns FROM slides "
+                    "WHERE path LIKE ? ESCAPE '\\'",
+                    (_like_prefix(root),),
+                )
+            }
+        todo = [
+            path
+            for path, stat in found.items()
+            if rescan or known.get(path) != (stat.st_size, stat.st_mtime_ns)
+        ]
+        counts = {
+            "added": sum(path not in known for path in todo),
+            "updated": sum(path in known for path in todo),
+            "unchanged": len(found) - len(todo),
+            "removed": len(set(known) - set(found)),
+            "failed": 0,
+        }
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM slides WHERE path = ?",
+                [(path,) for path in set(known) - set(found)],
+            )
+        rows = []
+        for row in _scan_slides(todo, n_workers):
+            counts["failed"] += row["error"] is not None
+            rows.append(row)
+            if len(rows) >= COMMIT_EVERY:
+                self._write(rows)
+                rows = []
+        self._write(rows)
+        logger.debug("Scanned %s: %s", root, counts)
+        return counts
+
+    def find(
+        self,
+        search: str = "",
+        modality: Optional[str] = None,
+        channel: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> list[dict]:
+        """
+        Query the readable slides of the index, without their thumbnails.
+
+        Parameters:
+        search (str): Only slides whose path contains this text (case insensitive).
+        modality (Optional[str]): Only slides of this modality, "BF" or "IF".
+        channel (Optional[str]): Only slides with a channel of this name (dye or biomarker).
+        limit (Optional[int]): Maximum number of slides returned.
+
+        Returns:
+        list[dict]: One dict per slide, by path, with its "channels" as a list and its "res_scale" in centimeters.
+        """
+        query = (
+            f"SELECT {', '.join(c for c in COLUMNS if c != 'thumbnail')} "
+            "FROM slides WHERE error IS NULL AND path LIKE ? ESCAPE '\\'"
+        )
+        params = [f"%{_escape_like(search)}%"]
+        if modality is not None:
+            query += " AND modality = ?"
+            params.append(modality)
+        if channel is not None:
+            query += " AND channels LIKE ? ESCAPE '\\'"
+            params.append(f"%{_escape_like(json.dumps(channel))}%")
+        query += " ORDER BY path"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        slides = []
+        for row in rows:
+            slide = dict(row)
+            slide["channels"] = json.loads(slide["channels"])
+            slide["res_scale"] = (slide.pop("res_x"), slide.pop("res_y"))
+            slides.append(slide)
+        return slides
+
+    def thumbnail(self, path: str | pathlib.Path) -> Optional[numpy.ndarray]:
+        """Return the RGB uint8 thumbnail of a slide, by its indexed path."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT thumbnail FROM slides WHERE path = ?",
+                (str(pathlib.Path(path)),),
+            ).fetchone()
+        if row is None or row["thumbnail"] is None:
+            return None
+        return imagecodecs.png_decode(row["thumbnail"])
+
+    def _write(self, rows):
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO slides ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(row[column] for column in COLUMNS) for row in rows],
+            )
+
+
+def scan_library(
+    root: str | pathlib.Path,
+    index: Optional[str | pathlib.Path] = None,
+    n_workers: Optional[int] = None,
+    rescan: bool = False,
+) -> dict:
+    """Index the slides of a directory tree, see `SlideLibrary.scan`."""
+    with SlideLibrary(index) as library:
+        return library.scan(root, n_workers, rescan)
+
+
+def _scan_slides(paths, n_workers):
+    if not paths:
+        return
+    n_workers = min(n_workers or os.cpu_count() or 1, len(paths))
+    if n_workers == 1:
+        yield from map(_scan_slide, paths)
+        return
+    # Spawned, not forked: the caller (napari, a pytest run) has threads
+    # whose locks a forked worker could inherit held
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(n_workers, mp_context=context) as pool:
+        for future in as_completed(
+            [pool.submit(_scan_slide, path) for path in paths]
+        ):
+            yield future.result()
+
+
+def _scan_slide(path):
+    # Runs in a worker process: the row of the index of one slide
+    from ._image import infer_img, open_img, read_md
+
+    path = pathlib.Path(path)
+    stat = path.stat()
+    row = dict.fromkeys(COLUMNS)
+    row.update(
+        path=str(path),
+        name=path.name,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        channels="[]",
+        scanned=time.time(),
+    )
+    try:
+        with tifffile.TiffFile(path) as tif:
+            levels = open_img(path, True, tif=tif)
+            modality = infer_img(path, levels, tif=tif)["modality"]
+            with warnings.catch_warnings():
+                # Slides without resolution are indexed as such
+                warnings.simplefilter("ignore", UserWarning)
+                md = read_md(path, modality, tif)
+            thumbnail = _thumbnail(levels[-1], md)
+    except SCAN_ERRORS as exc:
+        row["error"] = f"{type(exc).__name__}: {exc}"
+        return row
+
+    height, width = (
+        levels[0].shape[axis] for axis in get_yx_axes(levels[0].shape)
+    )
+    channels = []
+    if md.colmap_channels is not None:
+        channels = [
+            md.channel(index).biomarker or dye
+            for index, dye in enumerate(md.colmap_channels)
+        ]
+    row.update(
+        modality=modality,
+        width=width,
+        height=height,
+        n_levels=len(levels),
+        dtype=str(levels[0].dtype),
+        res_x=md.res_scale[0],
+        res_y=md.res_scale[1],
+        channels=json.dumps(channels),
+        thumbnail=imagecodecs.png_encode(thumbnail),
+    )
+    return row
+
+
+def _thumbnail(level, md, size=THUMBNAIL_SIZE):
+    # An RGB uint8 preview of a level, at most `size` pixels wide and high
+    yx_axes = get_yx_axes(level.shape)
+    # A slide without small enough level is previewed by its central
+    # window, as reading every tile of it to subsample would be slow
+    windows = {
+        axis: min(level.shape[axis], THUMBNAIL_WINDOW) for axis in yx_axes
+    }
+    step = max(1, math.ceil(max(windows.values()) / size))
+    index = [slice(None)] * level.ndim
+    for axis, window in windows.items():
+        start = (level.shape[axis] - window) // 2
+        index[axis] = slice(start, start + window, step)
+    data = numpy.asarray(level[tuple(index)])
+    if data.ndim == 3 and yx_axes == (0, 1):
+        if data.dtype == numpy.uint8:
+            return numpy.ascontiguousarray(data[..., :3])
+        channels = numpy.moveaxis(data[..., :3], -1, 0)
+        colors = numpy.eye(3)
+    else:
+        channels = data.reshape(-1, *data.shape[-2:])
+        colors = _channel_colors(md, len(channels))
+
+    # Every channel stretched to its percentiles, then blended additively
+    limits = numpy.asarray(channel_limits(channels, CONTRAST_PERCENTILES))
+    low, high = limits[:, :1, None], limits[:, 1:, None]
+    scaled = numpy.clip(
+        (channels - low) / numpy.maximum(high - low, 1e-12), 0, 1
+    )
+    rgb = numpy.clip(numpy.einsum("cyx,ck->yxk", scaled, colors), 0, 1)
+    return (rgb * 255).round().astype(numpy.uint8)
+
+
+def _channel_colors(md, n_channels):
+    if (
+        md.colmap_channels is not None
+        and len(md.colmap_channels) == n_channels
+    ):
+        return numpy.array(list(md.colmap_channels.values()), dtype=float)
+    if n_channels == 1:
+        return numpy.ones((1, 3))
+    from ._stack import STACK_COLORS
+
+    return numpy.array(
+        [STACK_COLORS[i % len(STACK_COLORS)] for i in range(n_channels)]
+    )
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_prefix(root):
+    return f"{_escape_like(str(root).rstrip(os.sep) + os.sep)}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="popidd-library",
+        description="Index the slides of directory trees, with their "
+        "metadata and a thumbnail, for the Slide Library widget.",
+    )
+    parser.add_argument("roots", nargs="+", type=pathlib.Path)
+    parser.add_argument(
+        "--index",
+        type=pathlib.Path,
+        default=None,
+        help="index file, defaults to the cache",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="read again the slides that did not change",
+    )
+    args = parser.parse_args(argv)
+
+    with SlideLibrary(args.index) as library:
+        for root in args.roots:
+            counts = library.scan(root, args.workers, args.rescan)
+            print(
+                f"{root}: "
+                + ", ".join(f"{count} {key}" for key, count in counts.items())
+            )
+        print(f"{len(library)} slides in {library.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Level-of-detail simplification of annotation outlines.
+
+QuPath tissue annotations carry hundreds of thousands of vertices, far more
+than a zoomed out view can show. Each displayed pyramid level gets a
+simplified copy of the outlines, with a tolerance of half a pixel of that
+level, so switching versions with the zoom is invisible while the number
+of vertices napari triangulates drops with the square of the downsample.
+"""
+
+from collections.abc import Sequence
+
+import numpy
+import shapely
+
+LOD_TOLERANCE = 0.5  # in pixels of the level a version is shown at
+
+
+def lod_tolerances(downsamples: Sequence[float]) -> list[float]:
+    """
+    Return the simplification tolerance of each pyramid level, in full
+    resolution pixels, 0 (no simplification) for full resolution.
+    """
+    return [
+        float(downsample) * LOD_TOLERANCE if downsample > 1 else 0.0
+        for downsample in downsamples
+    ]
+
+
+def lod_level(downsamples: Sequence[float], pixel_size: float) -> int:
+    """
+    Return the coarsest pyramid level whose pixels are no larger than a
+    screen pixel.
+
+    Parameters:
+    downsamples (Sequence[float]): The downsample of each pyramid level, increasing.
+    pixel_size (float): The size of a screen pixel in full resolution pixels, 1 / zoom.
+
+    Returns:
+    int: The level whose simplified outlines are indistinguishable from the full ones.
+    """
+    fine_enough = numpy.flatnonzero(numpy.asarray(downsamples) <= pixel_size)
+    return int(fine_enough[-1]) if len(fine_enough) else 0
+
+
+def simplify_shapes(
+    data: list, shape_type: Sequence[str], tolerance: float
+) -> list:
+    """
+    Simplify the vertex arrays of polygons and paths in bulk.
+
+    Outlines are simplified with Douglas-Peucker preserving topology, so
+    that rings stay valid and no ring collapses. Rings are simplified
+    independently: a hole may move by up to `tolerance` relative to its
+    exterior. Other shape types are returned as they are.
+
+    Parameters:
+    data (list[numpy.ndarray]): The (N, 2) vertex arrays of the shapes.
+    shape_type (Sequence[str]): The napari shape type of each of them.
+    tolerance (float): The maximum distance of a removed vertex from the simplified outline.
+
+    Returns:
+    list[numpy.ndarray]: The simplified vertex arrays, the given ones where nothing was simplified.
+    """
+    simplified = list(data)
+    if tolerance <= 0 or not len(data):
+        return simplified
+    shape_type = numpy.asarray(shape_type)
+    counts = numpy.array([len(vertices) for vertices in data])
+    for kind, min_vertices, closed in (
+        ("polygon", 4, True),
+        ("path", 3, False),
+    ):
+        selected = numpy.flatnonzero(
+            (shape_type == kind) & (counts >= min_vertices)
+        )
+        if not len(selected):
+            continue
+        vertices = [numpy.asarray(data[i], dtype=float) for i in selected]
+        if closed:
+            vertices = [
+                numpy.concatenate([ring, ring[:1]]) for ring in vertices
+            ]
+        lengths = numpy.array([len(ring) for ring in vertices])
+        indices = numpy.repeat(numpy.arange(len(vertices)), lengths)
+        build = shapely.linearrings if closed else shapely.linestrings
+        geoms = build(numpy.concatenate(vertices), indices=indices)
+        geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+        coords, index = shapely.get_coordinates(geoms, return_index=True)
+        # get_coordinates keeps the order, so every outline is one run
+        bounds = numpy.searchsorted(index, numpy.arange(len(selected) + 1))
+        stops = bounds[1:] - closed  # without the closing vertex
+        reduced = stops - bounds[:-1] < lengths - closed
+        for i, start, stop in zip(
+            selected[reduced], bounds[:-1][reduced], stops[reduced]
+        ):
+            simplified[i] = coords[start:stop]
+    return simplified
+
+
+def vertex_count(data: list) -> int:
+    """Return the total number of vertices of a list of vertex arrays."""
+    return int(sum(len(vertices) for vertices in data))
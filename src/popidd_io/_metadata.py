@@ -0,0 +1,266 @@
+"""
+Immutable, shared slide metadata.
+
+`read_md` used to copy every tag of the first page into a fresh dict and
+parse every channel description in full, and each channel layer of a slide
+got that dict, overwritten channel after channel. A `SlideMetadata` is
+built once per slide, holds only the fields loading needs, and converts
+the first page tags into a dict only if they are asked for. Layers get a
+`ChannelView` of it: a handful of references, not a copy.
+
+Both are read-only mappings with the keys of the former metadata dict
+("path", "modality", "res_scale", "colmap_channels", "dye", ... and the
+tag names), so `layer.metadata["res_scale"]` keeps working.
+"""
+
+import warnings
+from collections.abc import Mapping
+from typing import Any, Optional
+from xml.etree import ElementTree
+
+import numpy
+
+OFFSET_TAGS = (
+    "StripOffsets",
+    "StripByteCounts",
+    "TileOffsets",
+    "TileByteCounts",
+)
+XML_FEED_SIZE = 4096  # characters parsed before checking for the fields
+
+
+class SlideMetadata(Mapping):
+    """
+    Metadata of a slide, read-only.
+
+    Parameters:
+    path (pathlib.Path): The path to the slide.
+    modality (Optional[str]): "BF", "IF" or None if unknown.
+    res_scale (tuple[float, float]): Pixel size in centimeters, (1, 1) if unknown.
+    int_scale (Optional[int]): Maximum intensity, None until inferred.
+    fluor_to_marker (Optional[dict]): Biomarker of each dye, for fluorescence slides in the new format.
+    colmap_channels (Optional[dict]): RGB colour of each channel, by dye, for fluorescence slides.
+    new_format (Optional[bool]): Whether the channel descriptions are in the new format.
+    channel_limits (Optional[list]): Contrast limits of each channel.
+    tags (Optional[Mapping]): The tags of the first page, either as a dict of values or as the `tifffile.TiffTags` they are converted from on first use.
+    """
+
+    __slots__ = (
+        "path",
+        "modality",
+        "res_scale",
+        "int_scale",
+        "fluor_to_marker",
+        "colmap_channels",
+        "new_format",
+        "channel_limits",
+        "_tags",
+    )
+
+    def __init__(
+        self,
+        path,
+        modality: Optional[str] = None,
+        res_scale: tuple[float, float] = (1, 1),
+        int_scale: Optional[int] = None,
+        fluor_to_marker: Optional[dict] = None,
+        colmap_channels: Optional[dict] = None,
+        new_format: Optional[bool] = None,
+        channel_limits: Optional[list] = None,
+        tags: Optional[Mapping] = None,
+    ):
+        fields = {
+            "path": path,
+            "modality": modality,
+            "res_scale": tuple(res_scale),
+            "int_scale": int_scale,
+            "fluor_to_marker": fluor_to_marker,
+            "colmap_channels": colmap_channels,
+            "new_format": new_format,
+            "channel_limits": channel_limits,
+            "_tags": tags,
+        }
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    @property
+    def tags(self) -> dict:
+        """The tags of the first page, without strip and tile offsets."""
+        tags = self._tags
+        if tags is None:
+            tags = {}
+        elif not isinstance(tags, dict):
+            with warnings.catch_warnings():
+                # Values too large to be read with the page come from the
+                # file, reopened if the slide has been closed since
+                warnings.simplefilter("ignore", UserWarning)
+                tags = {
+                    tag.name: tag.value
+                    for tag in tags.values()
+                    if tag.name not in OFFSET_TAGS
+                }
+            tags = {
+                name: value
+                for name, value in tags.items()
+                if not isinstance(value, numpy.ndarray)
+            }
+        object.__setattr__(self, "_tags", tags)
+        return tags
+
+    def channel(self, index: int) -> "ChannelView":
+        """Return the view of one fluorescence channel, by position."""
+        return ChannelView(self, index)
+
+    def view(self) -> "ChannelView":
+        """Return the view given to a layer showing every channel."""
+        return ChannelView(self, None)
+
+    def _fields(self) -> dict:
+        fields = {
+            "path": self.path,
+            "ImagePath": self.path,
+            "modality": self.modality,
+            "res_scale": self.res_scale,
+        }
+        if self.int_scale is not None:
+            fields["int_scale"] = self.int_scale
+        if self.colmap_channels is not None:
+            fields.update(
+                fluor_to_marker=self.fluor_to_marker,
+                colmap_channels=self.colmap_channels,
+                new_format=self.new_format,
+            )
+        if self.channel_limits is not None:
+            fields["channel_limits"] = self.channel_limits
+        return fields
+
+    def __getitem__(self, key):
+        fields = self._fields()
+        if key in fields:
+            return fields[key]
+        return self.tags[key]
+
+    def __iter__(self):
+        fields = self._fields()
+        yield from fields
+        yield from (name for name in self.tags if name not in fields)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return (
+            f"SlideMetadata({self.path.name!r}, modality={self.modality!r}, "
+            f"res_scale={self.res_scale})"
+        )
+
+
+class ChannelView(Mapping):
+    """
+    What a layer needs to know about its slide and channel, read-only.
+
+    Keys are "path", "modality", "res_scale" and "slide" (the shared
+    `SlideMetadata`), plus "channel", "dye" and, for slides in the new
+    format, "biomarker" for fluorescence channels. Other keys of the slide
+    metadata are looked up on it.
+
+    Parameters:
+    slide (SlideMetadata): The metadata of the slide.
+    index (Optional[int]): The position of the channel, None for a layer showing every channel.
+    """
+
+    __slots__ = ("slide", "index")
+
+    def __init__(self, slide: SlideMetadata, index: Optional[int]):
+        object.__setattr__(self, "slide", slide)
+        object.__setattr__(self, "index", index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    @property
+    def dye(self) -> Optional[str]:
+        if self.index is None or not self.slide.colmap_channels:
+            return None
+        return list(self.slide.colmap_channels)[self.index]
+
+    @property
+    def biomarker(self) -> Optional[str]:
+        if not self.slide.new_format or self.dye is None:
+            return None
+        return self.slide.fluor_to_marker[self.dye]
+
+    @property
+    def color(self) -> Optional[tuple]:
+        dye = self.dye
+        return None if dye is None else self.slide.colmap_channels[dye]
+
+    def _keys(self):
+        keys = ["path", "modality", "res_scale", "slide"]
+        if self.dye is not None:
+            keys += ["channel", "dye"]
+            if self.biomarker is not None:
+                keys.append("biomarker")
+        return keys
+
+    def __getitem__(self, key) -> Any:
+        if key == "slide":
+            return self.slide
+        if key == "channel" and self.index is not None:
+            return self.index
+        if key in ("dye", "biomarker") and getattr(self, key) is not None:
+            return getattr(self, key)
+        return self.slide[key]
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __repr__(self):
+        return f"ChannelView({self.slide!r}, index={self.index})"
+
+
+def xml_fields(description, *paths: str) -> dict:
+    """
+    Extract the text of a few elements of an XML document, stopping as soon
+    as they are all found.
+
+    Parameters:
+    description (str | bytes): The XML, e.g. an ImageDescription tag.
+    *paths (str): Element paths, matched at any depth, e.g. ".//Band/Name".
+
+    Returns:
+    dict: The text of the first element matching each path, None if none does.
+
+    Raises:
+    xml.etree.ElementTree.ParseError: If the description is not XML.
+    """
+    # Fed as given: QPTIFF descriptions are str declaring encoding="utf-16",
+    # which the parser refuses once the str is encoded to UTF-8 bytes
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    wanted = {path: tuple(path.lstrip("./").split("/")) for path in paths}
+    found = {}
+    stack = []
+    for start in range(0, len(description), XML_FEED_SIZE):
+        parser.feed(description[start : start + XML_FEED_SIZE])
+        for event, element in parser.read_events():
+            if event == "start":
+                stack.append(element.tag)
+                continue
+            for path, parts in wanted.items():
+                if path not in found and tuple(stack[-len(parts) :]) == parts:
+                    found[path] = element.text
+            stack.pop()
+        if len(found) == len(wanted):
+            break
+    else:
+        parser.close()  # raises ParseError on a truncated document
+    return {path: found.get(path) for path in paths}
@@ -0,0 +1,225 @@
+"""
+Camera-driven tile prefetching.
+
+napari only reads the tiles of a slide once they come into view, so every
+pan stalls on decoding. `TilePrefetcher` follows the camera of a viewer and
+decodes, in a background pool, the tiles around the view at the displayed
+pyramid level (further ahead in the direction and speed of the pan) and
+the tiles of the view at the next finer level, into the shared tile cache
+layers opened with `tile_cache=True` read from. Requests for tiles the view
+has moved away from are cancelled.
+"""
+
+import logging
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy
+
+from ._culling import viewer_camera, view_box
+from ._image import open_img
+from ._infer import get_yx_axes
+from ._lod import lod_level
+from ._tiles import file_namespace, get_tile_cache
+from ._transcode import find_transcoded
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_RADIUS = 1  # tiles around the view
+PREFETCH_BYTES = 256 * 1024 * 1024
+LOOKAHEAD_SECONDS = 0.5  # how far ahead of a pan tiles are read
+
+_prefetchers = set()  # kept alive until their layer is removed
+
+
+class TilePrefetcher:
+    """
+    Reads ahead the tiles of a multiscale image layer around the view.
+
+    Parameters:
+    viewer (napari.Viewer): The viewer whose camera is followed.
+    layer (napari.layers.Image): A layer from `load_img`, whose metadata holds the slide "path".
+    radius (int): Number of tiles read around the view, on every side.
+    max_bytes (int): Maximum size of the tiles requested for one view.
+    n_workers (int): Number of decoding threads.
+    """
+
+    def __init__(
+        self,
+        viewer,
+        layer,
+        radius: int = PREFETCH_RADIUS,
+        max_bytes: int = PREFETCH_BYTES,
+        n_workers: int = 2,
+    ):
+        self.viewer = viewer
+        self.layer = layer
+        self.radius = radius
+        self.max_bytes = max_bytes
+        self.path = pathlib.Path(layer.metadata["path"])
+        self.cache = get_tile_cache()
+        self.namespace = file_namespace(self.path)
+        self.requested = 0
+        # Own handles on the slide, sharing the cache keys of the layers
+        self._levels = open_img(self.path, True, tile_cache=True)
+        self._yx_axes = get_yx_axes(self._levels[0].shape)
+        width = self._levels[0].shape[self._yx_axes[1]]
+        self.downsamples = [
+            width / level.shape[self._yx_axes[1]] for level in self._levels
+        ]
+        self._pool = ThreadPoolExecutor(n_workers)
+        self._pending = {}
+        self._last = None  # (time, center) of the previous update
+
+        camera = viewer_camera(viewer)
+        camera.events.center.connect(self.update)
+        camera.events.zoom.connect(self.update)
+        viewer.dims.events.current_step.connect(self.update)
+        viewer.layers.events.removed.connect(self._on_removed)
+        _prefetchers.add(self)
+
+    def update(self, event=None) -> None:
+        """Request the tiles around the current (and predicted) view."""
+        camera = viewer_camera(self.viewer)
+        center = numpy.asarray(camera.center[-2:], dtype=float)
+        now = time.perf_counter()
+        ahead = center
+        if self._last is not None and now > self._last[0]:
+            velocity = (center - self._last[1]) / (now - self._last[0])
+            ahead = center + velocity * LOOKAHEAD_SECONDS
+        self._last = (now, center)
+
+        zoom = camera.zoom * float(self.layer.scale[-1])
+        level = lod_level(self.downsamples, 1 / zoom)
+        wanted = self._tiles(level, view_box(self.viewer, self.layer, ahead))
+        wanted += self._tiles(level, view_box(self.viewer, self.layer))
+        if level > 0:
+            wanted += self._tiles(
+                level - 1, view_box(self.viewer, self.layer), radius=0
+            )
+        wanted = list(dict.fromkeys(wanted))
+
+        budget = self.max_bytes
+        keep = {}
+        for level_index, coords in wanted:
+            array = self._levels[level_index]
+            key = _chunk_key(array, coords)
+            tile_bytes = numpy.prod(array.chunks) * array.dtype.itemsize
+            if budget < tile_bytes:
+                break
+            budget -= tile_bytes
+            future = self._pending.pop(key, None)
+            if future is None:
+                if self._cached(key):
+                    continue
+                future = self._pool.submit(self._fetch, array, key)
+                self.requested += 1
+            keep[key] = future
+        # The view moved on: drop what was requested for the previous one
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = keep
+
+    def close(self) -> None:
+        """Stop following the viewer and cancel pending requests."""
+        camera = viewer_camera(self.viewer)
+        camera.events.center.disconnect(self.update)
+        camera.events.zoom.disconnect(self.update)
+        self.viewer.dims.events.current_step.disconnect(self.update)
+        self.viewer.layers.events.removed.disconnect(self._on_removed)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pending = {}
+        _prefetchers.discard(self)
+
+    def wait(self) -> None:
+        """Block until the pending requests are done."""
+        for future in list(self._pending.values()):
+            if not future.cancelled():
+                future.result()
+
+    def _tiles(self, level, box, radius=None):
+        # Chunks of a level covering a box (full resolution data
+        # coordinates) plus `radius` tiles, nearest to its center first
+        radius = self.radius if radius is None else radius
+        array = self._levels[level]
+        downsample = self.downsamples[level]
+        ranges = []
+        for axis, low, high in zip(self._yx_axes, box[:2], box[2:]):
+            chunk = array.chunks[axis]
+            n_chunks = -(-array.shape[axis] // chunk)
+            start = max(int(low / downsample // chunk) - radius, 0)
+            stop = min(int(high / downsample // chunk) + radius + 1, n_chunks)
+            ranges.append(numpy.arange(start, stop))
+        if not all(len(r) for r in ranges):
+            return []
+        grid = numpy.stack(
+            numpy.meshgrid(*ranges, indexing="ij"), axis=-1
+        ).reshape(-1, 2)
+        middle = (
+            numpy.add(box[:2], box[2:])
+            / 2
+            / downsample
+            / [array.chunks[axis] for axis in self._yx_axes]
+        )
+        grid = grid[numpy.argsort(((grid + 0.5 - middle) ** 2).sum(axis=1))]
+
+        # Every chunk along the channel (or sample) axes of each tile
+        others = [
+            range(-(-array.shape[axis] // array.chunks[axis]))
+            for axis in range(array.ndim)
+            if axis not in self._yx_axes
+        ]
+        tiles = []
+        for yx in grid:
+            for rest in numpy.ndindex(*(len(r) for r in others)):
+                coords = list(rest)
+                for axis, index in zip(self._yx_axes, yx):
+                    coords.insert(axis, int(index))
+                tiles.append((level, tuple(coords)))
+        return tiles
+
+    def _cached(self, key):
+        level, _, tile = key.rpartition("/")
+        return (self.namespace, level, tile) in self.cache
+
+    def _fetch(self, array, key):
+        # Goes through CachedTileStore, which decodes and caches the tile
+        array.store[key]
+
+    def _on_removed(self, event):
+        if event.value is self.layer:
+            self.close()
+
+
+def add_prefetcher(
+    viewer,
+    layer,
+    radius: int = PREFETCH_RADIUS,
+    max_bytes: int = PREFETCH_BYTES,
+) -> Optional[TilePrefetcher]:
+    """
+    Prefetch the tiles of a slide layer around the view of a viewer.
+
+    Layers of the same slide share their tiles, so one prefetcher per
+    slide is enough. It lives as long as the layer.
+
+    Returns:
+    Optional[TilePrefetcher]: The prefetcher, None for layers without a slide path or opened from a transcoded store.
+    """
+    if "path" not in layer.metadata:
+        return None
+    if find_transcoded(layer.metadata["path"]) is not None:
+        # Layers read the transcoded store, not the slide tiles
+        return None
+    prefetcher = TilePrefetcher(viewer, layer, radius, max_bytes)
+    prefetcher.update()
+    return prefetcher
+
+
+def _chunk_key(array, coords):
+    # The zarr v2 key of a chunk, e.g. "0/3.4.0"
+    separator = getattr(array, "_dimension_separator", None) or "."
+    key = separator.join(str(i) for i in coords)
+    return f"{array.path}/{key}" if array.path else key
@@ -0,0 +1,247 @@
+"""
+On-disk cache of slide profiles.
+
+A slide profile holds everything `load_img` infers from a slide that is
+expensive to recompute (modality, bit depth, resolution scale, channel
+colormaps, fluor-to-marker map, ...). Profiles are stored as small JSON
+files keyed by the slide path and validated against its size, mtime and a
+hash of its header, so a warm reopen needs neither pixel decoding nor XML
+parsing. The cache location, entry naming (`cache_key`) and `atomic_write`
+are shared with the transcoded stores and saved pyramids.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+from typing import Optional
+
+PROFILE_VERSION = 1
+HEADER_BYTES = 64 * 1024  # TIFF header plus, in practice, the first IFDs
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> pathlib.Path:
+    """
+    Return the root directory used for popidd-io caches.
+
+    Honours the POPIDD_CACHE_DIR environment variable, then XDG_CACHE_HOME,
+    and falls back to ~/.cache/popidd_io.
+    """
+    if os.environ.get("POPIDD_CACHE_DIR"):
+        return pathlib.Path(os.environ["POPIDD_CACHE_DIR"])
+    xdg = os.environ.get("XDG_CACHE_HOME")
+    base = pathlib.Path(xdg) if xdg else pathlib.Path.home() / ".cache"
+    return base / "popidd_io"
+
+
+def cache_disabled() -> bool:
+    """
+    Return whether slide profiles and tissue masks are neither read from
+    nor written to the cache, as set by the POPIDD_NO_CACHE environment
+    variable (to "1", "true" or "yes").
+    """
+    value = os.environ.get("POPIDD_NO_CACHE", "")
+    return value.lower() not in ("", "0", "false", "no")
+
+
+def cache_key(path: str | pathlib.Path) -> str:
+    """
+    Return the name under which the caches keep entries of a file: a digest
+    of its resolved path.
+    """
+    resolved = str(pathlib.Path(path).resolve())
+    return hashlib.sha1(resolved.encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_write(target: str | pathlib.Path):
+    """
+    Write a file or directory next to `target`, then move it into place.
+
+    Readers never see a partly written entry: the temporary path yielded
+    replaces `target` (and anything already there) only once the block
+    completes, and is removed if it raises.
+
+    Parameters:
+    target (str | pathlib.Path): The file or directory to write.
+
+    Yields:
+    pathlib.Path: The temporary path to write to.
+    """
+    target = pathlib.Path(target)
+    tmp = target.with_name(
+        f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    _remove(tmp)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        yield tmp
+        if target.is_dir():
+            shutil.rmtree(target)
+        os.replace(tmp, target)
+    finally:
+        _remove(tmp)
+
+
+def _remove(path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def slide_key(path: str | pathlib.Path) -> dict:
+    """
+    Build the validation key of a slide: resolved path, size, mtime and a
+    hash of the first HEADER_BYTES of the file.
+    """
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    with open(path, "rb") as fh:
+        header = hashlib.blake2b(fh.read(HEADER_BYTES), digest_size=16)
+    return {
+        "path": str(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "header": header.hexdigest(),
+    }
+
+
+class SlideProfileCache:
+    """
+    Size-bounded, on-disk store of slide profiles.
+
+    Each slide gets one `<digest>.json` entry, where the digest is derived
+    from its resolved path. Other stages may keep companion files named
+    `<digest>.<suffix>` next to it (see `entry_path`); they are evicted and
+    invalidated together with the profile. Least recently used entries are
+    evicted once the directory grows beyond `max_bytes`.
+
+    Parameters:
+    directory (Optional[str | pathlib.Path]): Where to store the profiles. Defaults to `default_cache_dir() / "profiles"`.
+    max_bytes (int): Size budget of the directory, in bytes.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str | pathlib.Path] = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        if directory is None:
+            directory = default_cache_dir() / "profiles"
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def entry_path(self, path: str | pathlib.Path, suffix: str = "json"):
+        """Return the cache file used for `path` with the given suffix."""
+        return self.directory / f"{cache_key(path)}.{suffix}"
+
+    def get(self, path: str | pathlib.Path) -> Optional[dict]:
+        """
+        Return the cached profile of `path`, or None if there is no valid
+        entry. Stale entries (slide changed on disk) are invalidated.
+        """
+        entry = self.entry_path(path)
+        try:
+            with open(entry) as fh:
+                record = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            key = slide_key(path)
+        except OSError:
+            return None
+        if record.get("version") != PROFILE_VERSION or record["key"] != key:
+            self.invalidate(path)
+            return None
+
+        with contextlib.suppress(OSError):
+            os.utime(entry)  # mark as recently used for eviction
+        return record["profile"]
+
+    def put(self, path: str | pathlib.Path, profile: dict) -> None:
+        """Store `profile` for `path` and evict old entries if needed."""
+        record = {
+            "version": PROFILE_VERSION,
+            "key": slide_key(path),
+            "profile": profile,
+        }
+        entry = self.entry_path(path)
+        with self._lock:
+            with atomic_write(entry) as tmp:
+                with open(tmp, "w") as fh:
+                    json.dump(record, fh)
+            self._evict()
+
+    def get_file(self, path: str | pathlib.Path, suffix: str):
+        """
+        Return the content of a companion file of `path`, or None. The
+        caller validates it, e.g. against a `slide_key` stored inside.
+        """
+        entry = self.entry_path(path, suffix)
+        try:
+            data = entry.read_bytes()
+        except OSError:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(entry)
+        return data
+
+    def put_file(self, path: str | pathlib.Path, suffix: str, data: bytes):
+        """Store a companion file of `path` and evict old entries if needed."""
+        entry = self.entry_path(path, suffix)
+        with self._lock:
+            with atomic_write(entry) as tmp:
+                tmp.write_bytes(data)
+            self._evict()
+
+    def invalidate(self, path: str | pathlib.Path) -> None:
+        """Drop the profile of `path` and any companion files."""
+        digest = cache_key(path)
+        with self._lock:
+            for file in self.directory.glob(f"{digest}.*"):
+                file.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        """Drop every cached profile."""
+        with self._lock:
+            if self.directory.is_dir():
+                for file in self.directory.iterdir():
+                    file.unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        entries = {}
+        for file in self.directory.iterdir():
+            stat = file.stat()
+            digest = file.name.split(".")[0]
+            size, last_used = entries.get(digest, (0, 0))
+            entries[digest] = (
+                size + stat.st_size,
+                max(last_used, stat.st_mtime),
+            )
+        total = sum(size for size, _ in entries.values())
+        for digest, (size, _) in sorted(
+            entries.items(), key=lambda item: item[1][1]
+        ):
+            if total <= self.max_bytes:
+                break
+            for file in self.directory.glob(f"{digest}.*"):
+                file.unlink(missing_ok=True)
+            total -= size
+
+
+_profile_cache = None
+
+
+def get_profile_cache() -> SlideProfileCache:
+    """Return the process-wide slide profile cache."""
+    global _profile_cache
+    if _profile_cache is None:
+        _profile_cache = SlideProfileCache()
+    return _profile_cache
@@ -0,0 +1,150 @@
+"""
+Lazy pyramid generation.
+
+Single-level TIFFs, and pyramids that stop early, force napari to read
+full-resolution data to render zoomed-out views. `complete_pyramid` adds
+the missing levels as dask arrays downsampled block by block from the
+level above, so each block is computed only when a view needs it.
+`save_pyramid` writes the generated levels to the cache, where
+`find_pyramid` picks them up on later opens.
+"""
+
+import os
+import pathlib
+from typing import Optional
+
+import numpy
+import zarr
+from dask import array as darray
+
+from ._infer import get_yx_axes
+from ._profile import atomic_write, cache_key, default_cache_dir
+
+METHODS = ("mean", "nearest")
+PYRAMID_MIN_SIZE = 512
+PYRAMID_CHUNK = 512
+
+
+def complete_pyramid(
+    levels: list,
+    method: str = "mean",
+    min_size: int = PYRAMID_MIN_SIZE,
+) -> list:
+    """
+    Append 2x downsampled levels until the smallest one fits in `min_size`.
+
+    Parameters:
+    levels (list): The pyramid levels, largest first (zarr or dask arrays).
+    method (str): "mean" to average 2x2 blocks, "nearest" to keep every other pixel.
+    min_size (int): Largest Y or X size of the smallest level.
+
+    Returns:
+    list: The given levels followed by the generated ones, lazy dask arrays in `PYRAMID_CHUNK` blocks.
+    """
+    if method not in METHODS:
+        raise ValueError(
+            f"Unknown method {method!r}, expected one of {METHODS}"
+        )
+    levels = list(levels)
+    yx_axes = get_yx_axes(levels[0].shape)
+    level = levels[-1]
+    if max(level.shape[axis] for axis in yx_axes) <= min_size:
+        return levels
+
+    level = _as_dask(level)
+    chunks = _chunks(level.shape, yx_axes)
+    while max(level.shape[axis] for axis in yx_axes) > min_size:
+        level = _downsample(level, yx_axes, method).rechunk(chunks)
+        levels.append(level)
+    return levels
+
+
+def pyramid_path(path: str | pathlib.Path) -> pathlib.Path:
+    """Return where the generated levels of a slide are saved."""
+    return default_cache_dir() / "pyramids" / f"{cache_key(path)}.zarr"
+
+
+def find_pyramid(
+    path: str | pathlib.Path, load_mem: bool = False
+) -> Optional[list]:
+    """
+    Return the saved generated levels of a slide if they are newer than the
+    slide, None otherwise.
+    """
+    store = pyramid_path(path)
+    attrs = store / ".zattrs"
+    if not attrs.is_file():
+        return None
+    if attrs.stat().st_mtime_ns <= os.stat(path).st_mtime_ns:
+        return None
+    group = zarr.open_group(str(store), "r")
+    levels = [group[str(i)] for i in range(group.attrs["levels"])]
+    if not load_mem:
+        levels = [darray.from_zarr(level) for level in levels]
+    return levels
+
+
+def save_pyramid(
+    path: str | pathlib.Path,
+    levels: list,
+    method: str = "mean",
+    min_size: int = PYRAMID_MIN_SIZE,
+    n_workers: Optional[int] = None,
+) -> pathlib.Path:
+    """
+    Compute the levels missing from a slide and save them to the cache.
+
+    Each level is downsampled from the one saved before it, so the slide is
+    read once. Takes the same arguments as `complete_pyramid`, with the
+    `path` of the slide first.
+    """
+    yx_axes = get_yx_axes(levels[0].shape)
+    level = _as_dask(levels[-1])
+    chunks = _chunks(level.shape, yx_axes)
+    out = pyramid_path(path)
+    with atomic_write(out) as tmp:
+        group = zarr.open_group(str(tmp), "w")
+        count = 0
+        while max(level.shape[axis] for axis in yx_axes) > min_size:
+            level = _downsample(level, yx_axes, method).rechunk(chunks)
+            saved = group.create_dataset(
+                str(count), shape=level.shape, chunks=chunks, dtype=level.dtype
+            )
+            level.store(saved, lock=False, num_workers=n_workers)
+            level = darray.from_zarr(saved)
+            count += 1
+        group.attrs["levels"] = count
+    return out
+
+
+def _downsample(level, yx_axes, method):
+    if method == "nearest":
+        index = tuple(
+            slice(None, None, 2) if axis in yx_axes else slice(None)
+            for axis in range(level.ndim)
+        )
+        return level[index]
+    return darray.coarsen(
+        numpy.mean, level, dict.fromkeys(yx_axes, 2), trim_excess=True
+    ).astype(level.dtype)
+
+
+def _as_dask(level):
+    if isinstance(level, darray.Array):
+        return level
+    if isinstance(level, zarr.Array):
+        return darray.from_zarr(level)
+    return darray.asarray(level)
+
+
+def _chunks(shape, yx_axes):
+    # Source chunks can be whole strips, generated levels use square blocks
+    # and one block per channel when channels come first
+    return tuple(
+        (
+            PYRAMID_CHUNK
+            if axis in yx_axes
+            else (1 if axis < yx_axes[0] else size)
+        )
+        for axis, size in enumerate(shape)
+    )
@@ -6,25 +6,47 @@ implement multiple readers or even other plugin contributions. see:
 https://napari.org/stable/plugins/guides.html?#readers
 """
 
-from ._image import load_img
-from ._anno import load_geojson
+import os
+
 from collections.abc import Sequence, Callable
 
+# Loaders are imported when a file is opened, not when napari discovers
+# the plugin
+
 
 def get_image_reader(path: str | Sequence[str]) -> Callable | None:
     img_formats = (".tiff", ".tif", ".svs", ".ndpi", ".qptiff") #Need to add these to yaml
-    if not isinstance(path, str):
-        return None
+    if not isinstance(path, str) or os.path.isdir(path):
+        # Several slides, or a directory of slides: one per channel. Left
+        # to other readers if there is no slide among them
+        paths = (
+            [entry.path for entry in os.scandir(path) if entry.is_file()]
+            if isinstance(path, str)
+            else path
+        )
+        if not any(
+            os.path.splitext(name)[1].lower() in img_formats for name in paths
+        ):
+            return None
+        from ._stack import load_channel_stack
+
+        return load_channel_stack
     else:
+        from ._image import load_img
+
         return load_img
 
 
 def get_anno_reader(path: str | Sequence[str]) -> Callable | None:
-    anno_formats = (".geojson") #parquet later too
+    anno_formats = {".geojson": "load_geojson", ".parquet": "load_parquet"}
     if not isinstance(path, str):
         return None
-    else:
-        return load_geojson
+    loader = anno_formats.get(os.path.splitext(path)[1].lower())
+    if loader is None:
+        return None
+    from . import _anno
+
+    return getattr(_anno, loader)
 
 # def napari_get_reader(path):
 #     """A basic implementation of a Reader contribution.
@@ -0,0 +1,239 @@
+"""
+Multi-file channel stacks.
+
+Cyclic fluorescence runs write one pyramidal TIFF per channel or per cycle.
+`load_channel_stack` opens such a list of files (or a directory of them) in
+parallel, checks that their pyramids line up and concatenates their levels
+along the channel axis as dask arrays, so no pixel is read until napari
+draws it. Every channel becomes an additive layer with its own colormap and
+name, like the channels of a single fluorescence slide (see `load_img`).
+"""
+
+import logging
+import os
+import pathlib
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy
+import tifffile
+from dask import array as darray
+from napari.types import LayerDataTuple
+from napari.utils import Colormap
+
+from ._image import open_img, read_md
+from ._infer import (
+    CONTRAST_PERCENTILES,
+    get_yx_axes,
+    channel_limits,
+    sample_level,
+)
+from ._instrument import span
+from ._pyramid import complete_pyramid
+
+logger = logging.getLogger(__name__)
+
+STACK_SUFFIXES = (".tiff", ".tif", ".qptiff", ".svs", ".ndpi")
+OPEN_WORKERS = 8
+# Colours of channels without a described one, in stack order
+STACK_COLORS = (
+    (0.0, 0.0, 1.0),
+    (0.0, 1.0, 0.0),
+    (1.0, 0.0, 0.0),
+    (1.0, 0.0, 1.0),
+    (0.0, 1.0, 1.0),
+    (1.0, 1.0, 0.0),
+    (1.0, 0.5, 0.0),
+    (1.0, 1.0, 1.0),
+)
+
+
+class _StackFile:
+    # One opened file of a stack: its CYX levels and channel metadata
+    def __init__(self, path, tile_cache):
+        self.path = path
+        # The levels read through this handle, it stays open with them
+        self.tif = tifffile.TiffFile(path)
+        levels = open_img(path, False, tile_cache, tif=self.tif)
+        if levels[0].ndim == 3 and get_yx_axes(levels[0].shape) == (0, 1):
+            raise ValueError(
+                f"{path.name} is an RGB image, only single channel or "
+                "channels first images can be stacked"
+            )
+        self.levels = [
+            level[None] if level.ndim == 2 else level for level in levels
+        ]
+        self.md = read_md(path, "IF" if self._described() else None, self.tif)
+
+    def __len__(self):
+        return self.levels[0].shape[0]
+
+    def names(self) -> list:
+        if self._colmap is not None:
+            return [
+                self.md.channel(index).biomarker or dye
+                for index, dye in enumerate(self._colmap)
+            ]
+        if len(self) == 1:
+            return [self.path.stem]
+        return [f"{self.path.stem}_{index}" for index in range(len(self))]
+
+    def colors(self) -> list:
+        if self._colmap is not None:
+            return list(self._colmap.values())
+        return [None] * len(self)
+
+    @property
+    def _colmap(self):
+        # The described channels, if there is one per channel of the file
+        colmap = self.md.colmap_channels
+        return (
+            colmap if colmap is not None and len(colmap) == len(self) else None
+        )
+
+    def _described(self):
+        # Channel pages described like those of a QPTIFF
+        description = (
+            self.tif.series[0].pages[0].tags.valueof("ImageDescription")
+        )
+        return isinstance(description, str) and "<Responsivity>" in (
+            description
+        )
+
+
+def load_channel_stack(
+    paths: str | pathlib.Path | Sequence[str | pathlib.Path],
+    tile_cache: bool = False,
+    pyramid: Optional[str] = "mean",
+    contrast_percentiles: Optional[tuple[float, float]] = CONTRAST_PERCENTILES,
+) -> list[LayerDataTuple]:
+    """
+    Load a list of single channel (or channels first) slides as the channels
+    of one image.
+
+    The slides must have the same pixel size, data type and level shapes;
+    levels only some of them have are dropped.
+
+    Parameters:
+    paths (str | pathlib.Path | Sequence[str | pathlib.Path]): The slides, in channel order, or a directory whose slides are stacked in file name order.
+    tile_cache (bool): Whether to serve decoded tiles through the process-wide tile cache.
+    pyramid (Optional[str]): How levels missing below the smallest common level are generated lazily, "mean" or "nearest". None keeps the levels of the slides.
+    contrast_percentiles (Optional[tuple[float, float]]): Percentiles of the smallest level used as contrast limits of each channel. None leaves them to napari.
+
+    Returns:
+    list[napari.types.LayerDataTuple]: One image layer per channel, all sharing the stacked levels.
+
+    Raises:
+    ValueError: If there is no slide to stack, or if the slides differ in pyramid shapes, resolution or data type.
+    """
+    paths = _stack_paths(paths)
+    if not paths:
+        raise ValueError("No slides to stack")
+    name = _stack_name(paths)
+
+    with span("open", slide=name, files=len(paths)):
+        with ThreadPoolExecutor(min(len(paths), OPEN_WORKERS)) as pool:
+            files = list(
+                pool.map(lambda path: _StackFile(path, tile_cache), paths)
+            )
+    _check_stack(files)
+
+    # Lazy concatenation: each chunk still reads from its own file
+    levels = [
+        darray.concatenate([file.levels[index] for file in files], axis=0)
+        for index in range(len(files[0].levels))
+    ]
+    limits = None
+    if contrast_percentiles is not None:
+        # From the levels of the files, before any is generated
+        with span("contrast_limits", slide=name):
+            limits = channel_limits(
+                sample_level(levels[-1]), contrast_percentiles
+            )
+    if pyramid is not None:
+        with span("pyramid", slide=name):
+            levels = complete_pyramid(levels, pyramid)
+
+    views = [
+        file.md.channel(index) for file in files for index in range(len(file))
+    ]
+    names = [channel for file in files for channel in file.names()]
+    colors = [
+        color if color is not None else STACK_COLORS[index % len(STACK_COLORS)]
+        for index, color in enumerate(
+            color for file in files for color in file.colors()
+        )
+    ]
+    logger.debug(
+        "Stacked %d channels of %d files as %s", len(names), len(files), name
+    )
+
+    layer_data = []
+    for index, (channel, color, view) in enumerate(zip(names, colors, views)):
+        kwargs = {
+            "name": f"{channel}_{name}",
+            "scale": files[0].md.res_scale,
+            "colormap": Colormap(
+                colors=numpy.array([(0, 0, 0, 1), (*color, 1)]), name=channel
+            ),
+            "blending": "additive",
+            "metadata": view,
+        }
+        if limits is not None:
+            kwargs["contrast_limits"] = limits[index]
+        layer_data.append(
+            ([level[index] for level in levels], kwargs, "image")
+        )
+    return layer_data
+
+
+def _stack_paths(paths):
+    if isinstance(paths, (str, os.PathLike)):
+        paths = pathlib.Path(paths)
+        if not paths.is_dir():
+            return [paths]
+        return sorted(
+            path
+            for path in paths.iterdir()
+            if path.is_file() and path.suffix.lower() in STACK_SUFFIXES
+        )
+    return [pathlib.Path(path) for path in paths]
+
+
+def _stack_name(paths):
+    # The directory of the slides, or the first slide if they are spread out
+    parents = {path.parent for path in paths}
+    if len(parents) == 1 and len(paths) > 1:
+        return parents.pop().name
+    return paths[0].stem
+
+
+def _check_stack(files):
+    # Levels past those all files have are left to `complete_pyramid`
+    n_levels = min(len(file.levels) for file in files)
+    for file in files:
+        file.levels = file.levels[:n_levels]
+    reference = files[0]
+    for file in files[1:]:
+        for index, (level, expected) in enumerate(
+            zip(file.levels, reference.levels)
+        ):
+            if level.shape[1:] != expected.shape[1:]:
+                raise ValueError(
+                    f"Level {index} of {file.path.name} is "
+                    f"{level.shape[1:]}, {expected.shape[1:]} in "
+                    f"{reference.path.name}"
+                )
+        if file.levels[0].dtype != reference.levels[0].dtype:
+            raise ValueError(
+                f"{file.path.name} is {file.levels[0].dtype}, "
+                f"{reference.path.name} is {reference.levels[0].dtype}"
+            )
+        if not numpy.allclose(
+            file.md.res_scale, reference.md.res_scale, rtol=1e-6, atol=0
+        ):
+            raise ValueError(
+                f"{file.path.name} has a pixel size of {file.md.res_scale} "
+                f"cm, {reference.path.name} of {reference.md.res_scale} cm"
+            )
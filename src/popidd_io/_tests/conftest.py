@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep transcoded stores and other caches out of the user cache
+    monkeypatch.setenv("POPIDD_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def feature(fid, geometry, **properties):
+    properties.setdefault("objectType", "annotation")
+    return {
+        "type": "Feature",
+        "id": fid,
+        "geometry": geometry,
+        "properties": properties,
+    }
+
+
+@pytest.fixture
+def qupath_geojson(tmp_path):
+    square = [[0, 0], [10, 0], [10, 20], [0, 20], [0, 0]]
+    hole = [[2, 2], [4, 2], [4, 4], [2, 2]]
+    features = [
+        feature(
+            "a1",
+            {"type": "Polygon", "coordinates": [square, hole]},
+            name="roi",
+            classification={"name": "Tumor", "color": [255, 0, 0]},
+        ),
+        feature(
+            "a2",
+            {"type": "MultiPolygon", "coordinates": [[square], [square]]},
+            classification={"name": "Tumor", "color": [255, 0, 0]},
+        ),
+        feature(
+            "a3",
+            {
+                "type": "GeometryCollection",
+                "geometries": [
+                    {"type": "Polygon", "coordinates": [square]},
+                    {"type": "LineString", "coordinates": [[0, 0], [5, 7]]},
+                    {"type": "Point", "coordinates": [3, 9]},
+                ],
+            },
+            name="mixed",
+        ),
+    ]
+    path = tmp_path / "annotations.geojson"
+    path.write_text(
+        json.dumps({"type": "FeatureCollection", "features": features})
+    )
+    return path
@@ -0,0 +1,140 @@
+import json
+
+import geopandas
+import numpy
+import pandas
+import pytest
+import shapely
+
+from popidd_io._anno import (
+    geoms_to_layers,
+    iter_geojson,
+    load_geojson,
+    load_parquet,
+    stream_geojson,
+)
+
+
+def test_load_geojson_groups_by_class(qupath_geojson):
+    layers = {
+        kwargs["name"]: (data, kwargs, layer_type)
+        for data, kwargs, layer_type in load_geojson(qupath_geojson)
+    }
+    assert set(layers) == {"Tumor", "mixed", "mixed points"}
+
+    data, kwargs, layer_type = layers["Tumor"]
+    assert layer_type == "shapes"
+    assert len(data) == 4  # exterior + hole of a1, two parts of a2
+    assert kwargs["features"]["id"].tolist() == ["a1", "a1", "a2", "a2"]
+    assert kwargs["features"]["ring"].tolist() == [0, 1, 0, 0]
+    assert kwargs["features"]["part"].tolist() == [0, 0, 0, 1]
+    numpy.testing.assert_array_equal(kwargs["edge_color"], [1, 0, 0])
+    # (x, y) -> (row, column), closing vertex dropped
+    numpy.testing.assert_array_equal(
+        data[0], [[0, 0], [0, 10], [20, 10], [20, 0]]
+    )
+
+    data, kwargs, _ = layers["mixed"]
+    assert kwargs["shape_type"] == ["polygon", "path"]
+    numpy.testing.assert_array_equal(data[1], [[0, 0], [7, 5]])
+
+    data, _, layer_type = layers["mixed points"]
+    assert layer_type == "points"
+    numpy.testing.assert_array_equal(data, [[9, 3]])
+
+
+def test_interleaved_classes_keep_their_order():
+    classes = ["Tumor", "Stroma", "Tumor", "Immune", "Stroma", "Tumor"]
+    geoms = shapely.buffer(shapely.points(numpy.arange(6), 0), 0.1)
+    geoms[3] = shapely.points(3, 0)
+    properties = pandas.DataFrame({"classification": classes})
+
+    layers = geoms_to_layers(geoms, properties)
+    assert [kwargs["name"] for _, kwargs, _ in layers] == [
+        "Tumor",
+        "Stroma",
+        "Immune points",
+    ]
+    assert layers[0][1]["features"]["id"].tolist() == [0, 2, 5]
+    assert layers[1][1]["features"]["id"].tolist() == [1, 4]
+    numpy.testing.assert_array_equal(layers[2][0], [[0, 3]])
+
+
+@pytest.fixture
+def cells_parquet(tmp_path):
+    centroids = numpy.stack(
+        numpy.meshgrid(numpy.arange(0, 1000, 50), numpy.arange(0, 500, 50)),
+        axis=-1,
+    ).reshape(-1, 2)
+    cells = geopandas.GeoDataFrame(
+        {
+            "classification": ["Tumor", "Stroma"] * (len(centroids) // 2),
+            "Area": numpy.arange(len(centroids), dtype=float),
+        },
+        geometry=shapely.buffer(shapely.points(centroids), 5),
+    )
+    path = tmp_path / "cells.parquet"
+    cells.to_parquet(path, write_covering_bbox=True, row_group_size=16)
+    return path, cells
+
+
+def test_load_parquet_centroids(cells_parquet):
+    path, cells = cells_parquet
+    ((data, kwargs, layer_type),) = load_parquet(path)
+    assert layer_type == "points"
+    assert kwargs["features"].columns.tolist() == ["classification", "Area"]
+    expected = shapely.get_coordinates(shapely.centroid(cells.geometry))
+    numpy.testing.assert_allclose(data, expected[:, ::-1])
+
+
+def test_load_parquet_filters(cells_parquet):
+    path, cells = cells_parquet
+    bbox = (100, 100, 300, 200)
+    layers = load_parquet(path, as_shapes=True, classes=["Tumor"], bbox=bbox)
+    assert [kwargs["name"] for _, kwargs, _ in layers] == ["Tumor"]
+
+    selected = cells[
+        (cells["classification"] == "Tumor")
+        & cells.intersects(shapely.box(*bbox))
+    ]
+    features = layers[0][1]["features"]
+    assert features["Area"].tolist() == selected["Area"].tolist()
+    assert len(layers[0][0]) == len(selected)
+
+
+def test_iter_geojson_reads_in_batches(qupath_geojson, tmp_path):
+    # Pretty printed, non ASCII and split over tiny reads
+    collection = json.loads(qupath_geojson.read_text())
+    collection["features"][0]["properties"]["name"] = "région"
+    collection["features"][2].pop("id")
+    path = tmp_path / "pretty.geojson"
+    path.write_text(json.dumps(collection, indent=2), encoding="utf-8")
+
+    batches = list(iter_geojson(path, batch_size=2, read_size=7))
+    assert [len(geoms) for geoms, _, _ in batches] == [2, 1]
+    assert batches[-1][2] == path.stat().st_size
+    properties = pandas.concat([batch for _, batch, _ in batches])
+    assert properties["id"].tolist() == ["a1", "a2", 2]
+    assert properties["name"].tolist()[0] == "région"
+    expected = geopandas.read_file(qupath_geojson).geometry
+    geoms = numpy.concatenate([geoms for geoms, _, _ in batches])
+    assert shapely.equals(geoms, expected.to_numpy()).all()
+
+    # A bare array of features and a single feature
+    path.write_text(json.dumps(collection["features"][1:]))
+    ((geoms, properties, _),) = iter_geojson(path, read_size=3)
+    assert properties["id"].tolist() == ["a2", 1]
+    path.write_text(json.dumps(collection["features"][0]))
+    ((geoms, properties, _),) = iter_geojson(path)
+    assert shapely.get_num_interior_rings(geoms).tolist() == [1]
+
+
+def test_stream_geojson_is_capped(qupath_geojson):
+    batches = list(stream_geojson(qupath_geojson, batch_size=1))
+    assert len(batches) == 3
+    assert [kwargs["name"] for _, kwargs, _ in batches[0][0]] == ["Tumor"]
+
+    streamed = stream_geojson(qupath_geojson, batch_size=1, max_bytes=400)
+    next(streamed)
+    with pytest.raises(MemoryError, match="exceed"):
+        list(streamed)
@@ -0,0 +1,161 @@
+import gc
+
+import numpy
+import pandas
+import pytest
+from napari.components import ViewerModel
+
+from popidd_io._culling import (
+    CulledShapes,
+    add_culled_shapes,
+    culled_shapes,
+)
+from popidd_io._writer import layers_to_geoms
+
+
+def grid_layer(n=100, spacing=100):
+    # n x n squares of side 10, one feature each
+    corners = numpy.stack(
+        numpy.meshgrid(numpy.arange(n), numpy.arange(n), indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 2)
+    square = numpy.array([[0, 0], [0, 10], [10, 10], [10, 0]], dtype=float)
+    data = [square + corner * spacing for corner in corners]
+    kwargs = {
+        "name": "Tumor",
+        "shape_type": ["polygon"] * len(data),
+        "features": pandas.DataFrame(
+            {"id": [f"cell_{i}" for i in range(len(data))]}
+        ),
+        "edge_color": "red",
+    }
+    return data, kwargs
+
+
+@pytest.fixture
+def culled():
+    viewer = ViewerModel()
+    data, kwargs = grid_layer()
+    (controller,) = add_culled_shapes(viewer, [(data, kwargs, "shapes")])
+    return viewer, controller
+
+
+def look_at(viewer, center, zoom):
+    camera = viewer.scene.camera
+    camera.zoom = zoom
+    camera.center = center
+
+
+def test_only_shapes_in_view_are_displayed(culled):
+    viewer, controller = culled
+    look_at(viewer, (500, 500), 8.0)  # 100 x 100 pixels in view
+
+    layer = controller.layer
+    assert len(controller) == 10000
+    assert 0 < layer.nshapes < 100
+    shown = numpy.concatenate(layer.data)
+    assert (abs(shown - 500) < 200).all()
+    assert list(layer.features["id"]) == [
+        f"cell_{i}" for i in controller.visible
+    ]
+
+    look_at(viewer, (5000, 5000), 8.0)
+    assert (abs(numpy.concatenate(layer.data) - 5000) < 200).all()
+
+
+def test_small_pans_reuse_the_fetched_shapes(culled):
+    viewer, controller = culled
+    look_at(viewer, (500, 500), 8.0)
+    before = controller.visible
+    refreshes = []
+    controller.layer.events.data.connect(refreshes.append)
+
+    look_at(viewer, (510, 510), 8.0)
+    assert controller.visible is before
+    assert not refreshes
+
+
+def test_visible_shapes_are_capped():
+    viewer = ViewerModel()
+    data, kwargs = grid_layer()
+    data[5] = data[5] * 3  # one large shape
+    controller = CulledShapes(viewer, data, kwargs, max_shapes=50)
+    viewer.add_layer(controller.layer)
+    look_at(viewer, (5000, 5000), 0.05)  # whole grid in view
+
+    assert controller.layer.nshapes == 50
+    assert 5 in controller.visible
+
+
+def test_edits_survive_leaving_the_view(culled):
+    viewer, controller = culled
+    look_at(viewer, (500, 500), 8.0)
+    layer = controller.layer
+
+    moved = layer.data[0] + 1
+    layer.data = [moved, *layer.data[1:]]
+    edited_id = layer.features["id"][0]
+    layer.selected_data = {1}
+    deleted_id = layer.features["id"][1]
+    layer.remove_selected()
+    layer.add(
+        numpy.array([[450, 450], [450, 460], [460, 455]]),
+        shape_type="polygon",
+    )
+
+    look_at(viewer, (5000, 5000), 8.0)
+    assert len(controller) == 10000
+    index = controller.feature(edited_id).index[0]
+    numpy.testing.assert_array_equal(controller.data[index], moved)
+    assert deleted_id not in set(controller.features["id"])
+
+    look_at(viewer, (500, 500), 8.0)
+    assert any(len(shape) == 3 for shape in layer.data)
+    assert deleted_id not in set(layer.features["id"])
+
+
+def test_feature_lookup_by_id(culled):
+    _, controller = culled
+    feature = controller.feature("cell_42")
+    assert len(feature) == 1
+    numpy.testing.assert_array_equal(
+        controller.data[feature.index[0]][0], (0, 4200)
+    )
+
+
+def test_writer_exports_all_shapes(culled):
+    viewer, controller = culled
+    look_at(viewer, (500, 500), 8.0)
+    layer = controller.layer
+    assert layer.nshapes < 100
+
+    geoms, properties = layers_to_geoms([layer.as_layer_data_tuple()])
+    assert len(geoms) == 10000
+    assert "_index" not in properties
+    assert properties["color"][9999] == [255, 0, 0]
+
+
+def test_controller_outlives_its_references():
+    viewer = ViewerModel()
+    data, kwargs = grid_layer()
+    add_culled_shapes(viewer, [(data, kwargs, "shapes")])
+    gc.collect()
+
+    layer = viewer.layers["Tumor"]
+    look_at(viewer, (5000, 5000), 8.0)
+    assert (abs(numpy.concatenate(layer.data) - 5000) < 200).all()
+    geoms, _ = layers_to_geoms([layer.as_layer_data_tuple()])
+    assert len(geoms) == 10000
+
+
+def test_controller_is_released_with_its_layer(culled):
+    viewer, controller = culled
+    look_at(viewer, (500, 500), 8.0)
+    layer = controller.layer
+    assert culled_shapes(layer.metadata) is controller
+    visible = controller.visible
+
+    viewer.layers.remove(layer)
+    assert culled_shapes(layer.metadata) is None
+    look_at(viewer, (5000, 5000), 8.0)
+    numpy.testing.assert_array_equal(controller.visible, visible)
@@ -0,0 +1,337 @@
+import math
+
+import numpy
+import pytest
+import tifffile
+
+from popidd_io import _decode, _image, _tiles
+from popidd_io._infer import (
+    SAMPLE_PIXEL_BUDGET,
+    channel_limits,
+    infer_intensity,
+)
+from popidd_io._profile import SlideProfileCache, atomic_write
+from popidd_io._tiles import TileCache
+
+
+def write_pyramid(path, data, levels=3, **kwargs):
+    """Write `data` (YX or YXS) as a tiled pyramidal TIFF with SubIFDs."""
+    with tifffile.TiffWriter(path) as tif:
+        tif.write(
+            data,
+            tile=(64, 64),
+            subifds=levels - 1,
+            resolution=(2e4, 2e4),
+            resolutionunit="CENTIMETER",
+            **kwargs,
+        )
+        for level in range(1, levels):
+            factor = 2**level
+            tif.write(
+                data[::factor, ::factor],
+                tile=(64, 64),
+                subfiletype=1,
+                **kwargs,
+            )
+    return path
+
+
+@pytest.fixture
+def profile_cache(tmp_path, monkeypatch):
+    cache = SlideProfileCache(tmp_path / "profiles")
+    monkeypatch.setattr(_image, "get_profile_cache", lambda: cache)
+    return cache
+
+
+@pytest.fixture
+def bf_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(120, 256, (512, 512, 3), dtype=numpy.uint8)
+    return write_pyramid(tmp_path / "bf.tif", data, photometric="rgb")
+
+
+def test_profile_cache_warm_reopen(bf_slide, profile_cache, monkeypatch):
+    cold = _image.load_img(bf_slide)
+    assert profile_cache.get(bf_slide)["modality"] == "BF"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("warm reopen should not decode or parse")
+
+    monkeypatch.setattr(_image, "infer_img", fail)
+    monkeypatch.setattr(_image, "read_md", fail)
+    warm = _image.load_img(bf_slide)
+
+    assert warm[0][1]["scale"] == cold[0][1]["scale"]
+    assert warm[0][1]["contrast_limits"] == cold[0][1]["contrast_limits"]
+    assert [a.shape for a in warm[0][0]] == [a.shape for a in cold[0][0]]
+
+
+def test_profile_cache_invalidation(bf_slide, profile_cache):
+    _image.load_img(bf_slide)
+    profile_cache.invalidate(bf_slide)
+    assert profile_cache.get(bf_slide) is None
+
+    _image.load_img(bf_slide)
+    with open(bf_slide, "ab") as fh:  # slide changed on disk
+        fh.write(b"\0")
+    assert profile_cache.get(bf_slide) is None
+
+
+def test_profile_cache_opt_out(bf_slide, profile_cache, monkeypatch):
+    _image.load_img(bf_slide, use_cache=False)
+    assert profile_cache.get(bf_slide) is None
+
+    monkeypatch.setenv("POPIDD_NO_CACHE", "1")
+    _image.load_img(bf_slide)
+    assert profile_cache.get(bf_slide) is None
+
+    monkeypatch.setenv("POPIDD_NO_CACHE", "0")
+    _image.load_img(bf_slide)
+    assert profile_cache.get(bf_slide)["modality"] == "BF"
+
+
+def test_profile_cache_eviction(tmp_path, bf_slide):
+    cache = SlideProfileCache(tmp_path / "small", max_bytes=1)
+    cache.put(bf_slide, {"modality": "BF"})
+    assert cache.get(bf_slide) is None
+
+
+def test_atomic_write_keeps_the_previous_entry(tmp_path):
+    store = tmp_path / "cache" / "slide.zarr"
+    with atomic_write(store) as tmp:
+        tmp.mkdir()
+        (tmp / "0").write_text("first")
+
+    with pytest.raises(RuntimeError), atomic_write(store) as tmp:
+        tmp.mkdir()
+        (tmp / "0").write_text("partial")
+        raise RuntimeError("interrupted")
+    assert (store / "0").read_text() == "first"
+    assert [path.name for path in store.parent.iterdir()] == ["slide.zarr"]
+
+    with atomic_write(store) as tmp:
+        tmp.mkdir()
+        (tmp / "1").write_text("second")
+    assert [path.name for path in store.iterdir()] == ["1"]
+
+
+@pytest.mark.parametrize(
+    "dtype, high, int_scale",
+    [
+        (numpy.uint8, 255, 255),
+        (numpy.uint16, 4095, 4095),
+        (numpy.uint16, 65535, 65535),
+    ],
+)
+def test_sampled_inference_matches_full(tmp_path, dtype, high, int_scale):
+    rng = numpy.random.default_rng(1)
+    data = rng.integers(0, high, (4, 1024, 1024), dtype=dtype, endpoint=True)
+    path = write_pyramid(
+        tmp_path / "if.tif", data, levels=1, photometric="minisblack"
+    )
+    levels = _image.open_img(path, load_mem=True)
+
+    full = infer_intensity(levels, strategy="full")
+    sampled = infer_intensity(levels, strategy="sample", pixel_budget=2**16)
+
+    assert full["decided_by"] == {"int_scale": "full", "modality": "full"}
+    assert sampled["decided_by"] == {
+        "int_scale": "sample",
+        "modality": "sample",
+    }
+    assert sampled["int_scale"] == full["int_scale"] == int_scale
+    assert sampled["modality"] == full["modality"]
+    assert sampled["mean"] == pytest.approx(full["mean"], rel=0.05)
+
+
+def test_blank_sample_falls_back_to_full_reduction(tmp_path):
+    # Mostly empty: the only signal is in a tile the sample skips
+    data = numpy.zeros((1024, 1024), dtype=numpy.uint16)
+    data[:8, :8] = 3000
+    path = write_pyramid(tmp_path / "empty.tif", data, levels=1)
+    levels = _image.open_img(path, load_mem=True)
+
+    inferred = infer_intensity(levels, strategy="sample", pixel_budget=2**16)
+
+    assert inferred["int_scale"] == 4095
+    assert inferred["decided_by"]["int_scale"] == "full"
+
+
+def test_tags_decide_8bit_rgb(bf_slide):
+    levels = _image.open_img(bf_slide, load_mem=True)
+    with tifffile.TiffFile(bf_slide) as tif:
+        inferred = infer_intensity(levels, tif)
+    assert inferred["decided_by"] == {"int_scale": "tags", "modality": "tags"}
+    assert inferred["int_scale"] == 255 and inferred["modality"] == "BF"
+    assert inferred["max"] is None
+
+
+def test_tile_cache_shared_across_opens(bf_slide, monkeypatch):
+    cache = TileCache()
+    monkeypatch.setattr(_tiles, "_tile_cache", cache)
+
+    first = _image.open_img(bf_slide, load_mem=False, tile_cache=True)
+    reference = first[0].compute()
+    assert cache.stats()["misses"] == 64 and cache.stats()["hits"] == 0
+
+    second = _image.open_img(bf_slide, load_mem=False, tile_cache=True)
+    numpy.testing.assert_array_equal(second[0].compute(), reference)
+    assert cache.stats()["hits"] == 64
+
+
+def test_tile_cache_byte_budget():
+    cache = TileCache(max_bytes=3 * 1024)
+    for tile in range(4):
+        cache.put(("slide", "0", f"{tile}.0"), numpy.zeros(1024, numpy.uint8))
+    assert cache.get(("slide", "0", "0.0")) is None
+    assert cache.get(("slide", "0", "3.0")) is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.nbytes == 3 * 1024
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_parallel_decoding_matches_shared_handle(bf_slide, executor):
+    reference = [level[:] for level in _image.open_img(bf_slide, True)]
+    levels = _image.open_img(
+        bf_slide, True, decode_workers=2, decode_executor=executor
+    )
+    for level, expected in zip(levels, reference):
+        numpy.testing.assert_array_equal(level[:], expected)
+    levels[0].store.close()
+
+
+def test_decoding_pools_are_shared(bf_slide):
+    _decode.shutdown_pools()
+    first = _image.open_img(bf_slide, True, decode_workers=2)
+    first[0][:64, :64]  # a single tile is read in the calling thread
+    assert not _decode._pools
+
+    second = _image.open_img(bf_slide, True, decode_workers=2)
+    first[0][:]
+    second[0][:]
+    assert list(_decode._pools) == [("thread", 2)]
+
+
+@pytest.fixture
+def single_level_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 256, (2048, 1536, 3), dtype=numpy.uint8)
+    return write_pyramid(tmp_path / "flat.tif", data, 1, photometric="rgb")
+
+
+@pytest.mark.parametrize("method", ["mean", "nearest"])
+def test_missing_levels_generated_lazily(single_level_slide, method):
+    ((levels, _, _),) = _image.load_img(single_level_slide, pyramid=method)
+
+    assert [level.shape[:2] for level in levels] == [
+        (2048, 1536),
+        (1024, 768),
+        (512, 384),
+    ]
+    above = numpy.asarray(levels[1][:2, :2])
+    block = levels[2][:1, :1].compute()
+    if method == "mean":
+        expected = above.mean(axis=(0, 1)).astype(numpy.uint8)
+    else:
+        expected = above[0, 0]
+    numpy.testing.assert_array_equal(block[0, 0], expected)
+
+
+def test_generated_levels_persisted(single_level_slide, monkeypatch):
+    lazy = _image.load_img(single_level_slide)
+    _image.load_img(single_level_slide, persist_pyramid=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("saved levels should be reused")
+
+    monkeypatch.setattr(_image, "complete_pyramid", fail)
+    ((levels, _, _),) = _image.load_img(single_level_slide)
+
+    assert len(levels) == 3
+    numpy.testing.assert_array_equal(levels[2], lazy[0][0][2])
+
+
+def write_qptiff(path, data, pyramid=True, tile=64):
+    """
+    Write CYX `data` with one QPI-described page (and pyramid) per channel,
+    declaring UTF-16 like the descriptions written by the scanners.
+    """
+    names = [("DAPI", "0,0,255"), ("FITC", "0,255,0"), ("Cy5", "255,0,0")]
+    with tifffile.TiffWriter(path) as tif:
+        for channel, (name, color) in zip(data, names):
+            description = (
+                '<?xml version="1.0" encoding="utf-16"?>'
+                "<PerkinElmer-QPI-ImageDescription><Responsivity><Filter>"
+                f"<Name>{name}</Name></Filter></Responsivity>"
+                f"<Color>{color}</Color></PerkinElmer-QPI-ImageDescription>"
+            )
+            options = {
+                "tile": (tile, tile),
+                "photometric": "minisblack",
+                "metadata": None,
+            }
+            tif.write(
+                channel,
+                subifds=int(pyramid),
+                description=description,
+                **options,
+            )
+            if pyramid:
+                tif.write(channel[::2, ::2], subfiletype=1, **options)
+    return path
+
+
+def test_channel_limits_match_percentiles():
+    rng = numpy.random.default_rng(0)
+    level = rng.integers(0, 4096, (3, 64, 64), dtype=numpy.uint16)
+    level[1] //= 16
+
+    limits = channel_limits(level, (0.5, 99.5))
+
+    expected = numpy.percentile(
+        level.reshape(3, -1), (0.5, 99.5), axis=1, method="inverted_cdf"
+    ).T
+    numpy.testing.assert_array_equal(limits, expected)
+
+
+def test_if_channel_contrast_limits(tmp_path, profile_cache, monkeypatch):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 50, (3, 256, 256), dtype=numpy.uint16)
+    data[0, :64] += 3000
+    data[2, :64] += 300
+    slide = write_qptiff(tmp_path / "if.qptiff", data)
+
+    layers = _image.load_img(slide, "IF")
+    limits = [kwargs["contrast_limits"] for _, kwargs, _ in layers]
+    assert [kwargs["name"] for _, kwargs, _ in layers] == [
+        "DAPI_if",
+        "FITC_if",
+        "Cy5_if",
+    ]
+    assert limits[0][1] > 3000 and limits[1][1] < 50 and limits[2][1] > 300
+
+    monkeypatch.setattr(_image, "channel_limits", None)  # must not be called
+    warm = _image.load_img(slide, "IF")
+    assert [kwargs["contrast_limits"] for _, kwargs, _ in warm] == limits
+
+
+def test_single_level_slide_is_sampled(tmp_path, profile_cache, monkeypatch):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 4000, (3, 2304, 2304), dtype=numpy.uint16)
+    slide = write_qptiff(tmp_path / "flat.qptiff", data, False, 256)
+    sampled = []
+
+    def spy_channel_limits(level, percentiles):
+        sampled.append(level.shape)
+        return channel_limits(level, percentiles)
+
+    monkeypatch.setattr(_image, "channel_limits", spy_channel_limits)
+    layers = _image.load_img(slide, "IF")
+
+    # Inferred from tiles of the slide, not from the generated levels
+    assert len(layers[0][0]) > 1
+    profile = profile_cache.get(slide)
+    assert profile["int_scale"] == 4095
+    assert profile["decided_by"]["int_scale"] == "sample"
+    ((channels, *yx),) = sampled
+    assert channels == 3 and math.prod(yx) <= SAMPLE_PIXEL_BUDGET
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = (
+    "napari",
+    "magicgui",
+    "numpy",
+    "pandas",
+    "geopandas",
+    "dask",
+    "zarr",
+    "tifffile",
+)
+# Generous for slow CI runners, the plugin imports in about 1 ms
+IMPORT_BUDGET_US = int(os.environ.get("POPIDD_IMPORT_BUDGET_US", 100_000))
+
+
+def test_import_is_fast():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import popidd_io"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, total, name = line.split("|")
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+
+    assert cumulative["popidd_io"] < IMPORT_BUDGET_US
+    assert not [name for name in HEAVY_MODULES if name in cumulative]
+
+
+def test_readers_resolve_loaders():
+    from popidd_io import get_anno_reader, get_image_reader
+    from popidd_io._anno import load_geojson, load_parquet
+    from popidd_io._image import load_img
+
+    assert get_image_reader("slide.svs") is load_img
+    assert get_anno_reader("cells.GeoJSON") is load_geojson
+    assert get_anno_reader("cells.parquet") is load_parquet
+    assert get_anno_reader("cells.csv") is None
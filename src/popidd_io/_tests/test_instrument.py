@@ -0,0 +1,58 @@
+import json
+
+import numpy
+import pytest
+
+from popidd_io import _instrument
+from popidd_io._anno import load_geojson
+from popidd_io._image import load_img
+
+from .test_image import write_pyramid
+
+
+@pytest.fixture
+def profiler():
+    yield _instrument.enable_profiling()
+    _instrument.disable_profiling()
+
+
+def test_spans_disabled_are_shared_noops():
+    assert _instrument.get_profiler() is None
+    assert _instrument.span("open") is _instrument.span("layers", slide="x")
+
+
+def test_load_img_report_and_trace(tmp_path, profiler):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 256, (512, 512, 3), dtype=numpy.uint8)
+    slide = write_pyramid(tmp_path / "bf.tif", data, photometric="rgb")
+
+    ((levels, _, _),) = load_img(slide, use_cache=False)
+    numpy.asarray(levels[-1])
+
+    report = profiler.report()["bf.tif"]
+    assert {"open", "profile_reduction", "tag_parse", "layers"} <= set(
+        report["stages"]
+    )
+    assert report["counters"]["tiles_decoded"] >= 4
+    assert report["counters"]["bytes_decoded"] >= 128 * 128 * 3
+
+    trace = tmp_path / "trace.json"
+    profiler.write_trace(trace)
+    events = json.loads(trace.read_text())["traceEvents"]
+    assert {event["ph"] for event in events} == {"X"}
+    assert "tag_parse" in profiler.format_report()
+
+
+def test_load_geojson_stages(qupath_geojson, profiler):
+    load_geojson(qupath_geojson)
+    stages = profiler.report()[qupath_geojson.name]["stages"]
+    assert set(stages) == {"read", "geometry"}
+
+
+def test_enabled_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv("POPIDD_PROFILE", "1")
+    _instrument._from_environment()
+    try:
+        assert _instrument.get_profiler() is not None
+    finally:
+        _instrument.disable_profiling()
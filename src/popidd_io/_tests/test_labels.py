@@ -0,0 +1,148 @@
+import geopandas
+import numpy
+import pytest
+import shapely
+
+from popidd_io import _labels
+from popidd_io._anno import iter_geojson
+from popidd_io._labels import CellRaster, load_cell_labels
+from popidd_io._tiles import get_tile_cache
+
+from .test_image import write_pyramid
+
+
+@pytest.fixture
+def slide(tmp_path):
+    data = numpy.zeros((600, 500), dtype=numpy.uint8)
+    return write_pyramid(tmp_path / "slide.tif", data)
+
+
+@pytest.fixture
+def cells(tmp_path):
+    # 10 x 10 grid of cells of radius 8, in QuPath (x, y) coordinates
+    centers = numpy.stack(
+        numpy.meshgrid(numpy.arange(25, 500, 50), numpy.arange(25, 500, 50)),
+        axis=-1,
+    ).reshape(-1, 2)
+    cells = geopandas.GeoDataFrame(
+        {"classification": ["Tumor", "Stroma"] * (len(centers) // 2)},
+        geometry=shapely.buffer(shapely.points(centers), 8),
+    )
+    path = tmp_path / "cells.parquet"
+    cells.to_parquet(path)
+    return path, centers
+
+
+def test_labels_match_the_image_pyramid(slide, cells):
+    path, centers = cells
+    ((levels, kwargs, layer_type),) = load_cell_labels(
+        path, slide, color_by="cell"
+    )
+
+    assert layer_type == "labels" and kwargs["multiscale"]
+    assert [level.shape for level in levels] == [
+        (600, 500),
+        (300, 250),
+        (150, 125),
+    ]
+    assert kwargs["scale"] == pytest.approx((5e-5, 5e-5))
+    full = levels[0].compute()
+    x, y = centers.T
+    numpy.testing.assert_array_equal(full[y, x], numpy.arange(1, 101))
+    # Cells are disks of radius 8, filled up to their outline
+    assert full[y + 7, x].all() and not full[y + 9, x].any()
+    assert (full > 0).sum() == pytest.approx(100 * numpy.pi * 64, rel=0.05)
+
+    features = kwargs["features"]
+    assert features["class"].tolist()[1:3] == ["Tumor", "Stroma"]
+
+    coarse = levels[2].compute()
+    numpy.testing.assert_array_equal(
+        coarse[y // 4, x // 4], numpy.arange(1, 101)
+    )
+
+
+def test_class_labels_and_colors(slide, cells, tmp_path):
+    path, centers = cells
+    qupath = geopandas.read_parquet(path)
+    qupath["classification"] = [
+        {
+            "name": name,
+            "color": [255, 0, 0] if name == "Tumor" else [0, 0, 255],
+        }
+        for name in qupath["classification"]
+    ]
+    geojson = tmp_path / "cells.geojson"
+    geojson.write_text(qupath.to_json())
+
+    ((levels, kwargs, _),) = load_cell_labels(
+        geojson, slide, classes=["Tumor"]
+    )
+
+    full = levels[0].compute()
+    x, y = centers.T
+    numpy.testing.assert_array_equal(full[y, x], [1, 0] * 50)
+    assert kwargs["features"]["class"].tolist()[1:] == ["Tumor"]
+    numpy.testing.assert_allclose(kwargs["colormap"].map(1), [1, 0, 0, 1])
+
+
+def test_geojson_cells_are_read_in_batches(
+    slide, cells, tmp_path, monkeypatch
+):
+    path, centers = cells
+    qupath = geopandas.read_parquet(path)
+    geojson = tmp_path / "cells.geojson"
+    geojson.write_text(qupath.to_json())
+    batches = []
+
+    def iter_batches(path):
+        for batch in iter_geojson(path, batch_size=16):
+            batches.append(batch[1])
+            yield batch
+
+    monkeypatch.setattr(_labels, "iter_geojson", iter_batches)
+    ((levels, kwargs, _),) = load_cell_labels(
+        geojson, slide, classes=["Tumor"], color_by="cell"
+    )
+
+    assert len(batches) == 7
+    assert kwargs["features"]["id"].tolist()[1:] == [
+        str(i) for i in range(0, 100, 2)
+    ]
+    full = levels[0].compute()
+    x, y = centers.T
+    numpy.testing.assert_array_equal(full[y[::2], x[::2]], range(1, 51))
+    assert not full[y[1::2], x[1::2]].any()
+
+
+def test_chunks_are_rasterized_once(slide, cells):
+    path, _ = cells
+    ((levels, _, _),) = load_cell_labels(path, slide)
+    cache = get_tile_cache()
+    cache.clear()
+
+    first = levels[0][:64, :64].compute()
+    misses = cache.misses
+    second = levels[0][:64, :64].compute()
+
+    numpy.testing.assert_array_equal(first, second)
+    assert cache.misses == misses and cache.hits >= 1
+
+
+def test_non_polygon_parts_are_skipped():
+    # A point or a line before a cell must not shift the labels
+    first = shapely.box(0, 0, 10, 10)
+    second = shapely.box(20, 0, 30, 10)
+    geoms = numpy.array(
+        [
+            shapely.GeometryCollection([shapely.Point(5, 5), first]),
+            shapely.LineString([(0, 20), (30, 20)]),
+            second,
+        ]
+    )
+    raster = CellRaster(geoms, [1, 2, 3], "mixed")
+
+    assert len(raster) == 2
+    labels = raster._rasterize((1, 1), (0, 0), (12, 32))
+    assert labels[5, 5] == 1 and labels[5, 25] == 3
+    assert set(numpy.unique(labels)) == {0, 1, 3}
@@ -0,0 +1,114 @@
+import os
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from popidd_io._library import (
+    THUMBNAIL_WINDOW,
+    SlideLibrary,
+    _thumbnail,
+    main,
+)
+
+from .test_image import write_pyramid, write_qptiff
+
+
+@pytest.fixture
+def library_dir(tmp_path):
+    rng = numpy.random.default_rng(0)
+    root = tmp_path / "slides"
+    (root / "if").mkdir(parents=True)
+    bf = rng.integers(120, 256, (512, 384, 3), dtype=numpy.uint8)
+    write_pyramid(root / "bf.tif", bf, photometric="rgb")
+    write_qptiff(
+        root / "if" / "panel.qptiff",
+        rng.integers(0, 50, (3, 256, 256), dtype=numpy.uint16),
+    )
+    (root / "notes.txt").write_text("not a slide")
+    (root / "broken.tif").write_bytes(b"not a tiff")
+    return root
+
+
+def test_scan_indexes_metadata_and_thumbnails(library_dir, tmp_path):
+    with SlideLibrary(tmp_path / "library.sqlite") as library:
+        counts = library.scan(library_dir, n_workers=2)
+        assert counts == {
+            "added": 3,
+            "updated": 0,
+            "unchanged": 0,
+            "removed": 0,
+            "failed": 1,
+        }
+
+        bf, panel = library.find()
+        assert bf["name"] == "bf.tif" and bf["modality"] == "BF"
+        assert (bf["width"], bf["height"], bf["n_levels"]) == (384, 512, 3)
+        assert bf["res_scale"] == pytest.approx((5e-5, 5e-5))
+        assert panel["modality"] == "IF" and panel["dtype"] == "uint16"
+        assert panel["channels"] == ["DAPI", "FITC", "Cy5"]
+
+        assert [s["name"] for s in library.find(modality="IF")] == [
+            "panel.qptiff"
+        ]
+        assert [s["name"] for s in library.find(channel="FITC")] == [
+            "panel.qptiff"
+        ]
+        assert [s["name"] for s in library.find("BF.")] == ["bf.tif"]
+
+        thumbnail = library.thumbnail(bf["path"])
+        assert thumbnail.dtype == numpy.uint8
+        assert thumbnail.shape == (128, 96, 3)
+        assert library.thumbnail(panel["path"]).shape == (128, 128, 3)
+
+
+def test_rescan_reads_only_changed_slides(library_dir, tmp_path):
+    index = tmp_path / "library.sqlite"
+    with SlideLibrary(index) as library:
+        library.scan(library_dir, n_workers=1)
+
+        slide = library_dir / "bf.tif"
+        stat = slide.stat()
+        os.utime(slide, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        (library_dir / "if" / "panel.qptiff").unlink()
+        counts = library.scan(library_dir, n_workers=1)
+
+        assert counts == {
+            "added": 0,
+            "updated": 1,
+            "unchanged": 1,
+            "removed": 1,
+            "failed": 0,
+        }
+        assert [s["name"] for s in library.find()] == ["bf.tif"]
+
+
+def test_command_line(library_dir, tmp_path, capsys):
+    index = tmp_path / "cli.sqlite"
+    main([str(library_dir), "--index", str(index), "--workers", "1"])
+
+    out = capsys.readouterr().out
+    assert "3 added" in out and "1 failed" in out
+    assert f"3 slides in {index}" in out
+
+
+def test_thumbnail_reads_a_window_of_large_levels():
+    class Level:
+        # A single level slide larger than the window, recording reads
+        shape = (3, 3 * THUMBNAIL_WINDOW, 2 * THUMBNAIL_WINDOW)
+        dtype = numpy.dtype(numpy.uint16)
+        ndim = 3
+        reads = []
+
+        def __getitem__(self, index):
+            self.reads.append(index)
+            sizes = [
+                len(range(*s.indices(n))) for s, n in zip(index, self.shape)
+            ]
+            return numpy.ones(sizes, dtype=self.dtype)
+
+    level = Level()
+    thumbnail = _thumbnail(level, SimpleNamespace(colmap_channels=None))
+    ((_, rows, cols),) = level.reads
+    assert rows.stop - rows.start == cols.stop - cols.start == THUMBNAIL_WINDOW
+    assert thumbnail.shape == (256, 256, 3)
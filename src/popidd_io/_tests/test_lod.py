@@ -0,0 +1,77 @@
+import numpy
+import pandas
+import shapely
+from napari.components import ViewerModel
+
+from popidd_io._culling import CulledShapes
+from popidd_io._lod import lod_level, lod_tolerances, simplify_shapes
+
+
+def wiggly_ring(n=20000, radius=1000.0):
+    # A circle with sub-pixel noise, like a traced tissue outline
+    angles = numpy.linspace(0, 2 * numpy.pi, n, endpoint=False)
+    noise = numpy.random.default_rng(0).uniform(-0.2, 0.2, n)
+    return numpy.stack(
+        [
+            (radius + noise) * numpy.cos(angles) + 2000,
+            (radius + noise) * numpy.sin(angles) + 2000,
+        ],
+        axis=1,
+    )
+
+
+def test_tolerances_follow_the_pyramid():
+    assert lod_tolerances([1, 4, 16]) == [0.0, 2.0, 8.0]
+    assert lod_level([1, 4, 16], 0.5) == 0
+    assert lod_level([1, 4, 16], 5) == 1
+    assert lod_level([1, 4, 16], 100) == 2
+
+
+def test_simplify_stays_within_tolerance():
+    ring = wiggly_ring()
+    line = ring[:5000]
+    square = numpy.array([[0, 0], [0, 10], [10, 10], [10, 0]], float)
+    polygon, path, kept = simplify_shapes(
+        [ring, line, square], ["polygon", "path", "rectangle"], 2.0
+    )
+
+    assert len(polygon) < len(ring) / 20
+    assert len(path) < len(line) / 20
+    assert kept is square
+    original = shapely.polygons(ring)
+    simplified = shapely.polygons(polygon)
+    assert simplified.is_valid
+    assert shapely.hausdorff_distance(original, simplified) <= 2.0 + 1e-9
+
+
+def test_level_of_detail_switches_with_zoom_and_editing():
+    viewer = ViewerModel()
+    ring = wiggly_ring(300)  # napari triangulates large outlines slowly
+    kwargs = {"shape_type": ["polygon"], "features": pandas.DataFrame()}
+    controller = CulledShapes(viewer, [ring], kwargs, downsamples=[1, 4, 16])
+    viewer.add_layer(controller.layer)
+    counts = controller.vertex_counts()
+    assert counts[0] == len(ring) and counts[0] > counts[1] > counts[2]
+
+    camera = viewer.scene.camera
+    camera.center = (2000, 2000)
+    camera.zoom = 0.05  # 20 slide pixels per screen pixel
+    assert controller.lod == 2
+    assert len(controller.layer.data[0]) == counts[2]
+
+    camera.zoom = 2.0
+    assert controller.lod == 0
+    assert len(controller.layer.data[0]) == len(ring)
+
+    camera.zoom = 0.05
+    controller.layer.mode = "direct"
+    assert controller.lod == 0
+    controller.layer.mode = "pan_zoom"
+    assert controller.lod == 2
+
+    # Simplified outlines are not written back unless edited
+    assert len(controller.data[0]) == len(ring)
+    edited = controller.layer.data[0] + 1
+    controller.layer.data = [edited]
+    controller.sync()
+    numpy.testing.assert_array_equal(controller.data[0], edited)
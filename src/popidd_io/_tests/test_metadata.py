@@ -0,0 +1,73 @@
+import numpy
+import pytest
+import tifffile
+
+from popidd_io import _image
+from popidd_io._metadata import SlideMetadata, xml_fields
+
+from .test_image import write_pyramid, write_qptiff
+
+
+@pytest.fixture
+def if_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 50, (3, 256, 256), dtype=numpy.uint16)
+    return write_qptiff(tmp_path / "if.qptiff", data)
+
+
+def test_one_parse_of_the_slide_per_load(if_slide, monkeypatch):
+    opened = []
+
+    class CountingTiffFile(tifffile.TiffFile):
+        def __init__(self, *args, **kwargs):
+            opened.append(args[0])
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(tifffile, "TiffFile", CountingTiffFile)
+    layers = _image.load_img(if_slide, "IF", use_cache=False)
+
+    assert opened == [if_slide]
+    numpy.asarray(layers[0][0][0])  # the levels reopen the slide
+
+
+def test_channels_share_the_slide_metadata(if_slide):
+    layers = _image.load_img(if_slide, "IF", use_cache=False)
+    views = [kwargs["metadata"] for _, kwargs, _ in layers]
+
+    assert [view["dye"] for view in views] == ["DAPI", "FITC", "Cy5"]
+    assert [view["channel"] for view in views] == [0, 1, 2]
+    slide = views[0]["slide"]
+    assert all(view["slide"] is slide for view in views)
+    assert views[2]["colmap_channels"]["Cy5"] == (1, 0, 0)
+
+    with pytest.raises(AttributeError):
+        slide.res_scale = (1, 1)
+    with pytest.raises(TypeError):
+        views[0]["dye"] = "Cy5"
+
+
+def test_tags_are_converted_on_first_use(tmp_path):
+    path = write_pyramid(tmp_path / "bf.tif", numpy.zeros((256, 256), "u1"))
+    md = _image.read_md(path, None)
+
+    assert isinstance(md, SlideMetadata)
+    assert md["res_scale"] == pytest.approx((5e-5, 5e-5))
+    assert not isinstance(md._tags, dict)
+    assert md["ImageWidth"] == 256
+    assert isinstance(md._tags, dict) and "TileOffsets" not in md
+    assert "path" in md and md["ImagePath"] == path
+
+
+def test_xml_fields_stop_once_found():
+    description = (
+        "<Root><Responsivity><Filter><Name>DAPI</Name></Filter>"
+        "</Responsivity><Color>0,0,255</Color><Unclosed>"
+    )
+    fields = xml_fields(description, ".//Filter/Name", ".//Color")
+    assert fields == {".//Filter/Name": "DAPI", ".//Color": "0,0,255"}
+
+    assert xml_fields("<Root/>", ".//Color") == {".//Color": None}
+
+    # QPTIFF descriptions are str declaring another encoding than UTF-8
+    declared = '<?xml version="1.0" encoding="utf-16"?>' + description
+    assert xml_fields(declared, ".//Color") == {".//Color": "0,0,255"}
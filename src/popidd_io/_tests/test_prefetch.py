@@ -0,0 +1,93 @@
+import napari.layers
+import numpy
+import pytest
+from napari.components import ViewerModel
+
+from popidd_io._image import load_img
+from popidd_io._prefetch import add_prefetcher
+from popidd_io._tiles import file_namespace, get_tile_cache
+
+from .test_image import write_pyramid
+
+SCALE = 5e-5  # cm per pixel, as written by write_pyramid
+
+
+@pytest.fixture
+def slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 256, (2048, 2048, 3), dtype=numpy.uint8)
+    return write_pyramid(tmp_path / "bf.tif", data, photometric="rgb")
+
+
+@pytest.fixture
+def viewer_layer(slide):
+    cache = get_tile_cache()
+    cache.clear()
+    viewer = ViewerModel()
+    ((data, kwargs, layer_type),) = load_img(slide, tile_cache=True)
+    layer = viewer.add_layer(napari.layers.Layer.create(data, kwargs, "image"))
+    return viewer, layer
+
+
+def look_at(viewer, row, col, zoom):
+    # Center in slide pixels, zoom in screen pixels per slide pixel
+    camera = viewer.scene.camera
+    camera.zoom = zoom / SCALE
+    camera.center = (row * SCALE, col * SCALE)
+
+
+def cached_tiles(slide, level):
+    namespace = file_namespace(slide)
+    return {
+        tuple(int(i) for i in key[2].split(".")[:2])
+        for key in get_tile_cache()._tiles
+        if key[0] == namespace and key[1] == str(level)
+    }
+
+
+def test_tiles_around_the_view_are_prefetched(slide, viewer_layer):
+    viewer, layer = viewer_layer
+    look_at(viewer, 1024, 1024, 4.0)  # 200 x 150 pixels in view
+    prefetcher = add_prefetcher(viewer, layer, radius=1)
+    prefetcher.wait()
+
+    # Tiles of 64 pixels: rows and columns 14..17 in view, plus one
+    tiles = cached_tiles(slide, 0)
+    assert tiles == {
+        (row, col) for row in range(13, 19) for col in range(13, 19)
+    }
+
+    # napari then finds the view in the cache
+    misses = get_tile_cache().misses
+    numpy.asarray(layer.data[0][924:1124, 949:1099])
+    assert get_tile_cache().misses == misses
+
+
+def test_finer_level_and_budget(slide, viewer_layer):
+    viewer, layer = viewer_layer
+    look_at(viewer, 1024, 1024, 0.3)  # level 1 displayed
+    tile_bytes = 64 * 64 * 3
+    prefetcher = add_prefetcher(
+        viewer, layer, radius=0, max_bytes=300 * tile_bytes
+    )
+    prefetcher.wait()
+
+    # The 256 tiles of level 1 come first, then those of level 0 in view
+    assert len(cached_tiles(slide, 1)) == 256
+    assert 0 < len(cached_tiles(slide, 0)) <= 44
+    assert prefetcher.requested <= 300
+
+
+def test_stale_requests_are_cancelled(slide, viewer_layer):
+    viewer, layer = viewer_layer
+    look_at(viewer, 200, 200, 4.0)
+    prefetcher = add_prefetcher(viewer, layer, radius=2)
+    before = set(prefetcher._pending)
+
+    look_at(viewer, 1800, 1800, 4.0)
+    assert not before & set(prefetcher._pending)
+    prefetcher.wait()
+
+    viewer.layers.remove(layer)
+    look_at(viewer, 200, 1800, 4.0)
+    assert not prefetcher._pending
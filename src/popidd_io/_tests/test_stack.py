@@ -0,0 +1,89 @@
+import numpy
+import pytest
+
+from popidd_io._reader import get_image_reader
+from popidd_io._stack import load_channel_stack
+
+from .test_image import write_pyramid, write_qptiff
+
+
+@pytest.fixture
+def channels(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 4096, (3, 256, 192), dtype=numpy.uint16)
+    run = tmp_path / "run"
+    run.mkdir()
+    paths = [
+        write_pyramid(run / f"c{index}_{marker}.tif", channel)
+        for index, (marker, channel) in enumerate(
+            zip(("DAPI", "CD8", "PanCK"), data)
+        )
+    ]
+    return run, paths, data
+
+
+def test_directory_is_stacked_lazily(channels):
+    run, paths, data = channels
+    assert get_image_reader(str(run)) is load_channel_stack
+    assert get_image_reader([str(path) for path in paths]) is (
+        load_channel_stack
+    )
+
+    layers = load_channel_stack(run)
+
+    assert [kwargs["name"] for _, kwargs, _ in layers] == [
+        "c0_DAPI_run",
+        "c1_CD8_run",
+        "c2_PanCK_run",
+    ]
+    colors = [kwargs["colormap"].colors[-1] for _, kwargs, _ in layers]
+    assert len({tuple(color) for color in colors}) == 3
+    for index, (levels, kwargs, layer_type) in enumerate(layers):
+        assert layer_type == "image" and kwargs["blending"] == "additive"
+        assert kwargs["scale"] == pytest.approx((5e-5, 5e-5))
+        assert kwargs["metadata"]["path"] == paths[index]
+        assert [level.shape for level in levels] == [
+            (256, 192),
+            (128, 96),
+            (64, 48),
+        ]
+        numpy.testing.assert_array_equal(levels[0], data[index])
+        numpy.testing.assert_array_equal(levels[2], data[index, ::4, ::4])
+
+
+def test_folders_without_slides_are_left_to_other_readers(tmp_path):
+    (tmp_path / "notes.txt").write_text("not a slide")
+    (tmp_path / "cells.geojson").write_text("{}")
+    assert get_image_reader(str(tmp_path)) is None
+    assert get_image_reader([str(tmp_path / "cells.geojson")]) is None
+
+
+def test_cycles_keep_their_described_channels(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 50, (2, 3, 128, 128), dtype=numpy.uint16)
+    paths = [
+        write_qptiff(tmp_path / f"cycle{index}.qptiff", cycle)
+        for index, cycle in enumerate(data)
+    ]
+
+    layers = load_channel_stack(paths, contrast_percentiles=None)
+
+    assert [kwargs["name"] for _, kwargs, _ in layers] == [
+        f"{dye}_{tmp_path.name}" for dye in ("DAPI", "FITC", "Cy5") * 2
+    ]
+    numpy.testing.assert_allclose(
+        layers[5][1]["colormap"].colors[-1], [1, 0, 0, 1]
+    )
+    assert "contrast_limits" not in layers[0][1]
+    numpy.testing.assert_array_equal(layers[4][0][0], data[1, 1])
+
+
+def test_mismatched_slides_are_refused(channels, tmp_path):
+    _, paths, data = channels
+    smaller = write_pyramid(tmp_path / "smaller.tif", data[0, :128])
+    with pytest.raises(ValueError, match="Level 0 of smaller.tif"):
+        load_channel_stack([paths[0], smaller])
+
+    unscaled = write_qptiff(tmp_path / "unscaled.qptiff", data[:1])
+    with pytest.raises(ValueError, match="pixel size"):
+        load_channel_stack([paths[0], unscaled])
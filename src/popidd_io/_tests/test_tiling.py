@@ -0,0 +1,59 @@
+import numpy
+import pytest
+
+from popidd_io._tiling import iter_tiles
+
+from .test_image import write_pyramid
+
+
+@pytest.fixture
+def bf_data():
+    rng = numpy.random.default_rng(0)
+    return rng.integers(0, 256, (600, 500, 3), dtype=numpy.uint8)
+
+
+@pytest.fixture
+def bf_slide(tmp_path, bf_data):
+    # 0.5 um pixels at full resolution
+    return write_pyramid(tmp_path / "bf.tif", bf_data, photometric="rgb")
+
+
+def test_tiles_cover_the_level(bf_slide, bf_data):
+    tiles = iter_tiles(bf_slide, tile_size=256, prefetch=3, n_workers=2)
+    mosaic = numpy.zeros((768, 768, 3), dtype=numpy.uint8)
+    for tile, (y, x) in tiles:
+        assert tile.shape == (256, 256, 3)
+        mosaic[y : y + 256, x : x + 256] = tile
+
+    assert tiles.tiles == len(tiles) == 6
+    assert tiles.tiles_per_second > 0
+    numpy.testing.assert_array_equal(mosaic[:600, :500], bf_data)
+    assert not mosaic[600:].any()
+
+
+def test_batches_and_stride(bf_slide, bf_data):
+    tiles = iter_tiles(
+        bf_slide,
+        tile_size=200,
+        stride=100,
+        channels=[2],
+        batch_size=4,
+        pad=False,
+    )
+    batches = list(tiles)
+
+    assert [len(coords) for _, coords in batches] == [4, 4, 4, 4, 4]
+    batch, coords = batches[1]
+    assert batch.flags["C_CONTIGUOUS"] and batch.shape == (4, 200, 200, 1)
+    y, x = coords[0]
+    numpy.testing.assert_array_equal(
+        batch[0, ..., 0], bf_data[y : y + 200, x : x + 200, 2]
+    )
+
+
+def test_level_from_resolution(bf_slide, bf_data):
+    tiles = iter_tiles(bf_slide, mpp=2.1, tile_size=64)
+    assert tiles.level == 2 and tiles.downsample == 4
+    assert tiles.mpp == pytest.approx(2.0)
+    tile, _ = next(iter(tiles))
+    numpy.testing.assert_array_equal(tile, bf_data[::4, ::4][:64, :64])
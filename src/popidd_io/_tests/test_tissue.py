@@ -0,0 +1,91 @@
+import numpy
+import pytest
+import tifffile
+
+from popidd_io import _tissue
+from popidd_io._profile import SlideProfileCache
+from popidd_io._tiling import iter_tiles
+
+from .test_image import write_pyramid
+
+
+@pytest.fixture
+def profile_cache(tmp_path, monkeypatch):
+    cache = SlideProfileCache(tmp_path / "profiles")
+    monkeypatch.setattr(_tissue, "get_profile_cache", lambda: cache)
+    return cache
+
+
+@pytest.fixture
+def bf_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    # Grey glass with stained tissue in the top left 256 x 384 pixels
+    data = rng.integers(225, 245, (1024, 1024, 3), dtype=numpy.uint8)
+    data[:256, :384] = (200, 90, 160)
+    return write_pyramid(tmp_path / "bf.tif", data, 4, photometric="rgb")
+
+
+@pytest.fixture
+def if_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 20, (3, 512, 512), dtype=numpy.uint16)
+    data[:, 300:, 300:] += 3000
+    path = tmp_path / "if.tif"
+    with tifffile.TiffWriter(path) as tif:
+        tif.write(data, tile=(64, 64), subifds=2, photometric="minisblack")
+        for factor in (2, 4):
+            tif.write(
+                data[:, ::factor, ::factor],
+                tile=(64, 64),
+                subfiletype=1,
+                photometric="minisblack",
+            )
+    return path
+
+
+def test_bf_occupancy_across_levels(bf_slide, profile_cache):
+    mask = _tissue.get_tissue_mask(bf_slide, modality="BF")
+
+    assert mask.shape == (1024, 1024)
+    expected = numpy.zeros((8, 8), dtype=bool)
+    expected[:2, :3] = True
+    occupancy = mask.occupancy((1024, 1024), 128)
+    # One mask pixel of dilation can reach into the neighbouring tiles
+    assert occupancy[expected].all()
+    assert occupancy.sum() <= 4 * 5
+    assert mask.occupancy((256, 256), 128).tolist() == [
+        [True, False],
+        [False, False],
+    ]
+
+
+def test_if_summed_channels(if_slide, profile_cache):
+    mask = _tissue.get_tissue_mask(if_slide, modality="IF")
+    assert mask.occupancy((512, 512), 256).tolist() == [
+        [False, False],
+        [False, True],
+    ]
+
+
+def test_mask_cached_with_profile(bf_slide, profile_cache, monkeypatch):
+    first = _tissue.get_tissue_mask(bf_slide, modality="BF")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached masks should not be recomputed")
+
+    monkeypatch.setattr(_tissue, "tissue_mask", fail)
+    cached = _tissue.get_tissue_mask(bf_slide, modality="BF")
+    numpy.testing.assert_array_equal(cached.mask, first.mask)
+
+    with open(bf_slide, "ab") as fh:  # slide changed on disk
+        fh.write(b"\0")
+    with pytest.raises(AssertionError):
+        _tissue.get_tissue_mask(bf_slide, modality="BF")
+
+
+def test_tile_iterator_skips_background(bf_slide, profile_cache):
+    tiles = iter_tiles(bf_slide, tile_size=256, tissue_only=True)
+    corners = [yx for _, yx in tiles]
+    assert (0, 0) in corners and (0, 256) in corners
+    assert all(y < 512 and x < 768 for y, x in corners)
+    assert len(corners) < 16
@@ -0,0 +1,66 @@
+import os
+
+import numpy
+import pytest
+import zarr
+
+from popidd_io import _image
+from popidd_io._transcode import find_transcoded, main, transcode
+
+from .test_image import write_pyramid
+
+
+@pytest.fixture
+def bf_slide(tmp_path):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 256, (1024, 768, 3), dtype=numpy.uint8)
+    # Only two levels, the smallest still spans several chunks
+    return write_pyramid(tmp_path / "bf.tif", data, 2, photometric="rgb")
+
+
+@pytest.mark.parametrize("codec", ["lz4", "zstd"])
+def test_transcode_completes_pyramid(bf_slide, codec):
+    store = transcode(bf_slide, chunk=128, codec=codec, n_workers=2)
+
+    group = zarr.open_group(str(store), "r")
+    shapes = [group[str(i)].shape for i in range(len(group))]
+    assert shapes == [
+        (1024, 768, 3),
+        (512, 384, 3),
+        (256, 192, 3),
+        (128, 96, 3),
+    ]
+    assert group["0"].chunks == (128, 128, 3)
+    assert group["0"].compressor.cname == codec
+    numpy.testing.assert_array_equal(
+        group["1"][:], _image.open_img(bf_slide, True)[1][:]
+    )
+    multiscales = group.attrs["multiscales"][0]
+    assert multiscales["datasets"][3]["coordinateTransformations"][0][
+        "scale"
+    ] == [8.0, 8.0, 1.0]
+    assert group.attrs["popidd"]["profile"]["modality"] == "BF"
+
+
+def test_load_img_prefers_fresh_transcoded_store(bf_slide, monkeypatch):
+    original = _image.load_img(bf_slide, use_cache=False)
+    main([str(bf_slide), "--chunk", "256"])
+    assert find_transcoded(bf_slide) is not None
+
+    def fail(*args, **kwargs):
+        raise AssertionError("transcoded slides need no inference or parsing")
+
+    monkeypatch.setattr(_image, "infer_img", fail)
+    monkeypatch.setattr(_image, "read_md", fail)
+    monkeypatch.setattr(_image, "open_img", fail)
+    ((data, kwargs, _),) = _image.load_img(bf_slide, use_cache=False)
+
+    assert len(data) == 3
+    numpy.testing.assert_array_equal(data[0], original[0][0][0])
+    assert kwargs["scale"] == original[0][1]["scale"]
+    assert kwargs["contrast_limits"] == original[0][1]["contrast_limits"]
+
+    # A slide modified after transcoding is read directly again
+    later = os.stat(bf_slide).st_mtime_ns + 10**9
+    os.utime(bf_slide, ns=(later, later))
+    assert find_transcoded(bf_slide) is None
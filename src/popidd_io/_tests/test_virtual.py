@@ -0,0 +1,77 @@
+import numpy
+import pytest
+import tifffile
+
+from popidd_io import _image
+from popidd_io._tiles import get_tile_cache
+from popidd_io._virtual import VirtualTileStore
+
+TILE = 64
+
+
+@pytest.fixture
+def cache():
+    cache = get_tile_cache()
+    cache.clear()
+    return cache
+
+
+@pytest.fixture
+def data():
+    rng = numpy.random.default_rng(0)
+    return rng.integers(0, 4096, (300, 200), dtype=numpy.uint16)
+
+
+def source_chunks(cache):
+    return [key for key in cache._tiles if key[2].startswith("source:")]
+
+
+def test_strips_are_decoded_once(tmp_path, data, cache):
+    path = tmp_path / "striped.tif"
+    tifffile.imwrite(path, data, rowsperstrip=16, compression="zlib")
+
+    (level,) = _image.open_img(path, True, virtual_tile=TILE)
+    assert level.chunks == (TILE, TILE)
+    numpy.testing.assert_array_equal(level[:], data)
+    numpy.testing.assert_array_equal(level[100:130, 150:], data[100:130, 150:])
+
+    # 19 strips of 16 rows, each decoded once for the 5 x 4 virtual chunks
+    assert len(source_chunks(cache)) == 19
+    misses = cache.misses
+    level[:]
+    assert cache.misses == misses
+
+
+def test_huge_tiles_are_split(tmp_path, cache):
+    rng = numpy.random.default_rng(1)
+    data = rng.integers(0, 256, (300, 260, 3), dtype=numpy.uint8)
+    path = tmp_path / "tiled.tif"
+    tifffile.imwrite(
+        path, data, tile=(256, 256), photometric="rgb", compression="zlib"
+    )
+
+    (level,) = _image.open_img(path, False, virtual_tile=TILE)
+    assert level.chunksize == (TILE, TILE, 3)
+    numpy.testing.assert_array_equal(level.compute(), data)
+    assert len(source_chunks(cache)) == 4
+
+
+def test_uncompressed_levels_are_memory_mapped(tmp_path, data, cache):
+    path = tmp_path / "raw.tif"
+    # One big-endian strip, as some exports write them
+    tifffile.imwrite(path, data, byteorder=">")
+
+    (level,) = _image.open_img(path, True, virtual_tile=TILE)
+    assert level.chunks == (TILE, TILE)
+    assert "raw.tif" in str(level.store._memmaps[""].filename)
+    numpy.testing.assert_array_equal(level[:], data)
+    numpy.testing.assert_array_equal(level[70:250, 5:199], data[70:250, 5:199])
+    assert not source_chunks(cache)
+
+
+def test_regular_tiles_are_left_alone(tmp_path, data):
+    path = tmp_path / "regular.tif"
+    tifffile.imwrite(path, data, tile=(TILE, TILE))
+
+    (level,) = _image.open_img(path, True, virtual_tile=TILE)
+    assert not isinstance(level.store, VirtualTileStore)
@@ -1,66 +1,73 @@
-# import numpy as np
-
-# from popidd_io._widget import (
-#     ExampleQWidget,
-#     ImageThreshold,
-#     threshold_autogenerate_widget,
-#     threshold_magic_widget,
-# )
-
-
-# def test_threshold_autogenerate_widget():
-#     # because our "widget" is a pure function, we can call it and
-#     # test it independently of napari
-#     im_data = np.random.random((100, 100))
-#     thresholded = threshold_autogenerate_widget(im_data, 0.5)
-#     assert thresholded.shape == im_data.shape
-#     # etc.
-
-
-# # make_napari_viewer is a pytest fixture that returns a napari viewer object
-# # you don't need to import it, as long as napari is installed
-# # in your testing environment
-# def test_threshold_magic_widget(make_napari_viewer):
-#     viewer = make_napari_viewer()
-#     layer = viewer.add_image(np.random.random((100, 100)))
-
-#     # our widget will be a MagicFactory or FunctionGui instance
-#     my_widget = threshold_magic_widget()
-
-#     # if we "call" this object, it'll execute our function
-#     thresholded = my_widget(viewer.layers[0], 0.5)
-#     assert thresholded.shape == layer.data.shape
-#     # etc.
-
-
-# def test_image_threshold_widget(make_napari_viewer):
-#     viewer = make_napari_viewer()
-#     layer = viewer.add_image(np.random.random((100, 100)))
-#     my_widget = ImageThreshold(viewer)
-
-#     # because we saved our widgets as attributes of the container
-#     # we can set their values without having to "interact" with the viewer
-#     my_widget._image_layer_combo.value = layer
-#     my_widget._threshold_slider.value = 0.5
-
-#     # this allows us to run our functions directly and ensure
-#     # correct results
-#     my_widget._threshold_im()
-#     assert len(viewer.layers) == 2
-
-
-# # capsys is a pytest fixture that captures stdout and stderr output streams
-# def test_example_q_widget(make_napari_viewer, capsys):
-#     # make viewer and add an image layer using our fixture
-#     viewer = make_napari_viewer()
-#     viewer.add_image(np.random.random((100, 100)))
-
-#     # create our widget, passing in the viewer
-#     my_widget = ExampleQWidget(viewer)
-
-#     # call our widget method
-#     my_widget._on_click()
-
-#     # read captured output and check that it's as we expected
-#     captured = capsys.readouterr()
-#     assert captured.out == "napari has 1 layers\n"
+import time
+from pathlib import Path
+
+import numpy
+import pytest
+from napari.components import ViewerModel
+
+from popidd_io import _widget
+from popidd_io._anno import stream_geojson
+from popidd_io._culling import CulledShapes
+
+
+def test_iter_load_img_runs_in_parallel(monkeypatch):
+    def slow_load_img(
+        img, modality=None, load_mem=False, tile_cache=False, use_cache=True
+    ):
+        time.sleep(0.2)
+        return [(img, {"name": img.stem, "modality": modality}, "image")]
+
+    monkeypatch.setattr(_widget, "load_img", slow_load_img)
+    jobs = [(Path(f"slide_{i}.tif"), "BF") for i in range(8)]
+
+    start = time.perf_counter()
+    loaded = list(_widget.iter_load_img(jobs, n_workers=8))
+    elapsed = time.perf_counter() - start
+
+    assert sorted(layers[0][1]["name"] for layers in loaded) == sorted(
+        img.stem for img, _ in jobs
+    )
+    assert elapsed < 0.2 * len(jobs) / 2
+
+
+def test_iter_load_img_cancels_pending(monkeypatch):
+    started = []
+
+    def slow_load_img(
+        img, modality=None, load_mem=False, tile_cache=False, use_cache=True
+    ):
+        started.append(img)
+        time.sleep(0.1)
+        return [(img, {}, "image")]
+
+    monkeypatch.setattr(_widget, "load_img", slow_load_img)
+    jobs = [(Path(f"slide_{i}.tif"), "IF") for i in range(10)]
+
+    loader = _widget.iter_load_img(jobs, n_workers=2)
+    next(loader)
+    loader.close()  # what quitting the thread_worker does
+    time.sleep(0.3)
+
+    assert len(started) < len(jobs)
+
+
+@pytest.mark.parametrize("max_shapes", [0, 100])
+def test_streamed_batches_are_appended(qupath_geojson, max_shapes):
+    viewer = ViewerModel()
+    layers = {}
+    for layer_data, _ in stream_geojson(qupath_geojson, batch_size=1):
+        _widget.add_anno_batch(
+            viewer, layers, qupath_geojson, layer_data, max_shapes
+        )
+
+    assert [layer.name for layer in viewer.layers] == [
+        "Tumor",
+        "mixed",
+        "mixed points",
+    ]
+    tumor = layers[(qupath_geojson, "Tumor")]
+    if max_shapes:
+        assert isinstance(tumor, CulledShapes)
+        assert len(tumor) == 4 and tumor.layer.nshapes == 4
+    assert tumor.features["id"].tolist() == ["a1", "a1", "a2", "a2"]
+    numpy.testing.assert_allclose(tumor.edge_color[:, :3], [[1, 0, 0]] * 4)
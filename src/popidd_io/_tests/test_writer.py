@@ -0,0 +1,155 @@
+import gc
+
+import geopandas
+import napari.layers
+import numpy
+import pytest
+import shapely
+from napari.components import ViewerModel
+
+from popidd_io._anno import load_geojson, load_parquet
+from popidd_io._culling import add_culled_shapes
+from popidd_io._writer import write_geojson, write_parquet
+
+
+def as_writer_data(layer_data):
+    # What napari hands to writer contributions
+    layers = [napari.layers.Layer.create(*i) for i in layer_data]
+    return [
+        (layer.data, layer._get_state(), layer._type_string)
+        for layer in layers
+    ]
+
+
+def without_points(geom):
+    if isinstance(geom, shapely.GeometryCollection):
+        parts = [part for part in geom.geoms if part.geom_type != "Point"]
+        return shapely.GeometryCollection(parts)
+    return geom
+
+
+@pytest.mark.parametrize("writer", [write_geojson, write_parquet])
+def test_round_trip_geometry(qupath_geojson, tmp_path, writer):
+    suffix = ".geojson" if writer is write_geojson else ".parquet"
+    out = tmp_path / f"written{suffix}"
+    writer(str(out), as_writer_data(load_geojson(qupath_geojson)))
+
+    read = (
+        geopandas.read_file if suffix == ".geojson" else geopandas.read_parquet
+    )
+    original = geopandas.read_file(qupath_geojson).set_index("id")
+    written = read(out)
+    shapes = written[written.geom_type != "Point"].set_index("id")
+
+    assert sorted(shapes.index) == sorted(original.index)
+    for fid, geom in original.geometry.items():
+        assert shapely.equals_exact(shapes.geometry[fid], without_points(geom))
+    assert shapes.loc["a1", "name"] == "roi"
+    classification = shapes.loc["a2", "classification"]
+    if suffix == ".geojson":
+        assert classification == {"name": "Tumor", "color": [255, 0, 0]}
+    else:
+        assert classification == "Tumor"
+
+
+def test_round_trip_through_loaders(qupath_geojson, tmp_path):
+    out = tmp_path / "written.geojson"
+    loaded = load_geojson(qupath_geojson)
+    write_geojson(str(out), as_writer_data(loaded))
+
+    for (data, kwargs, _), (data_again, kwargs_again, _) in zip(
+        loaded, load_geojson(out)
+    ):
+        assert kwargs["name"] == kwargs_again["name"]
+        for vertices, vertices_again in zip(data, data_again):
+            numpy.testing.assert_array_equal(vertices, vertices_again)
+
+
+def test_write_drawn_shapes(tmp_path):
+    layer = napari.layers.Shapes(
+        [
+            [[0, 0], [0, 10], [5, 10], [5, 0]],
+            [[20, 20], [20, 30], [30, 30], [30, 20]],
+            [[0, 0], [8, 3], [9, 9]],
+        ],
+        shape_type=["rectangle", "ellipse", "path"],
+        name="Necrosis",
+    )
+    points = napari.layers.Points([[4, 2], [6, 1]], name="Nuclei")
+    out = tmp_path / "drawn.parquet"
+    write_parquet(
+        str(out),
+        [
+            (layer.data, layer._get_state(), "shapes"),
+            (points.data, points._get_state(), "points"),
+        ],
+    )
+
+    written = geopandas.read_parquet(out)
+    assert written.geom_type.tolist() == [
+        "Polygon",
+        "Polygon",
+        "LineString",
+        "Point",
+        "Point",
+    ]
+    assert (
+        written["classification"].tolist() == ["Necrosis"] * 3 + ["Nuclei"] * 2
+    )
+    numpy.testing.assert_array_equal(
+        shapely.get_coordinates(written.geometry.iloc[3]), [[2, 4]]
+    )
+    ((_, kwargs, _),) = load_parquet(out, classes=["Nuclei"])
+    assert len(kwargs["features"]) == 2
+
+
+@pytest.mark.parametrize("defaults", ["loader", "napari", "culled"])
+def test_shapes_drawn_into_loaded_layers(qupath_geojson, tmp_path, defaults):
+    (data, kwargs, _), *_ = load_geojson(qupath_geojson)  # Tumor
+    if defaults == "napari":
+        # As napari sets them: the features of the last row, "a2"
+        kwargs.pop("feature_defaults")
+    if defaults == "culled":
+        viewer = ViewerModel()
+        (controller,) = add_culled_shapes(viewer, [(data, kwargs, "shapes")])
+        layer = controller.layer
+    else:
+        layer = napari.layers.Shapes(data, **kwargs)
+    triangle = numpy.array([[100, 100], [100, 120], [120, 100]])
+    layer.add([triangle], shape_type="polygon")
+    if defaults == "culled":
+        data = [controller.layer_data()]
+    else:
+        data = [(layer.data, layer._get_state(), "shapes")]
+
+    out = tmp_path / "drawn.geojson"
+    write_geojson(str(out), data)
+
+    written = geopandas.read_file(out)
+    original = geopandas.read_file(qupath_geojson).set_index("id")
+    assert written["id"].tolist()[:2] == ["a1", "a2"]
+    for fid, geom in written.geometry.iloc[:2].items():
+        assert shapely.equals_exact(geom, original.geometry.iloc[fid])
+    assert written["id"].isna().tolist()[2:] == [True]
+    numpy.testing.assert_array_equal(
+        shapely.get_coordinates(written.geometry.iloc[2]),
+        [[100, 100], [120, 100], [100, 120], [100, 100]],
+    )
+
+
+def test_culled_layers_are_written_in_full(qupath_geojson, tmp_path):
+    viewer = ViewerModel()
+    data, kwargs, _ = load_geojson(qupath_geojson)[0]  # Tumor
+    add_culled_shapes(viewer, [(data, kwargs, "shapes")], max_shapes=1)
+    gc.collect()
+    layer = viewer.layers["Tumor"]
+    assert layer.nshapes == 1
+
+    out = tmp_path / "culled.geojson"
+    write_geojson(str(out), [layer.as_layer_data_tuple()])
+    assert geopandas.read_file(out)["id"].tolist() == ["a1", "a2"]
+
+    # Without its controller only the displayed shapes are left
+    viewer.layers.remove(layer)
+    with pytest.raises(ValueError, match="culled"):
+        write_geojson(str(out), [layer.as_layer_data_tuple()])
@@ -0,0 +1,231 @@
+"""
+Process-wide cache of decoded tiles.
+
+The tifffile `aszarr` store decodes a JPEG/JPEG2000 tile every time zarr
+asks for a chunk, so every pan or zoom (and every channel layer slicing
+the same IF store) decodes the same tiles again. `CachedTileStore` wraps a
+store so that decoded chunks go through a shared, byte-budgeted LRU
+`TileCache`, keyed by (file, level, tile).
+"""
+
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Optional
+
+from zarr.storage import Store
+
+DEFAULT_TILE_CACHE_BYTES = 512 * 1024 * 1024
+METADATA_KEYS = (".zarray", ".zgroup", ".zattrs")
+
+
+class TileCache:
+    """
+    Thread-safe LRU cache of decoded tiles with a byte budget.
+
+    Parameters:
+    max_bytes (int): The byte budget. Least recently used tiles are evicted beyond it.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_TILE_CACHE_BYTES):
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int):
+        with self._lock:
+            self._max_bytes = value
+            self._evict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._tiles
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+    def get(self, key, default=None):
+        """Return the tile stored under `key`, counting a hit or a miss."""
+        with self._lock:
+            try:
+                tile = self._tiles[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile) -> None:
+        """Store `tile` under `key`, evicting old tiles beyond the budget."""
+        size = _nbytes(tile)
+        with self._lock:
+            if key in self._tiles:
+                self.nbytes -= _nbytes(self._tiles.pop(key))
+            if size > self._max_bytes:
+                return
+            self._tiles[key] = tile
+            self.nbytes += size
+            self._evict()
+
+    def clear(self) -> None:
+        """Drop every tile and reset the counters."""
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        """Return the hit/miss/eviction counters and the current size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "tiles": len(self._tiles),
+                "nbytes": self.nbytes,
+                "max_bytes": self._max_bytes,
+            }
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes and self._tiles:
+            _, tile = self._tiles.popitem(last=False)
+            self.nbytes -= _nbytes(tile)
+            self.evictions += 1
+
+
+class ReadOnlyStore(Store):
+    """
+    Read-only zarr store wrapping another store.
+
+    Keys, metadata and chunks are served by the wrapped store as they are;
+    subclasses override `__getitem__` (and `getitems`) to change how chunks
+    are read.
+
+    Parameters:
+    store (MutableMapping): The store to wrap.
+    """
+
+    _readable = True
+    _writeable = False
+    _erasable = False
+    _listable = True
+
+    def __init__(self, store: MutableMapping):
+        self.store = store
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __setitem__(self, key, value):
+        raise PermissionError(f"{type(self).__name__} is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError(f"{type(self).__name__} is read-only")
+
+    def close(self):
+        if hasattr(self.store, "close"):
+            self.store.close()
+
+    def _read_many(self, keys, contexts=None):
+        # Chunks of the wrapped store, in one call if it can decode several
+        # chunks at once
+        if hasattr(self.store, "getitems"):
+            return self.store.getitems(keys, contexts=contexts)
+        return {key: self.store[key] for key in keys if key in self.store}
+
+
+class CachedTileStore(ReadOnlyStore):
+    """
+    Read-only zarr store serving decoded chunks through a `TileCache`.
+
+    Parameters:
+    store (MutableMapping): The store to wrap, e.g. a tifffile ZarrTiffStore.
+    namespace (str): Identifies the file in the cache keys. Stores opened on the same file share their cached tiles.
+    cache (Optional[TileCache]): The cache to use, the process-wide one by default.
+    """
+
+    def __init__(
+        self,
+        store: MutableMapping,
+        namespace: str,
+        cache: Optional[TileCache] = None,
+    ):
+        super().__init__(store)
+        self.namespace = namespace
+        self.cache = get_tile_cache() if cache is None else cache
+
+    def __getitem__(self, key):
+        if key.endswith(METADATA_KEYS):
+            return self.store[key]
+        level, _, tile = key.rpartition("/")
+        cache_key = (self.namespace, level, tile)
+        chunk = self.cache.get(cache_key)
+        if chunk is None:
+            chunk = self.store[key]
+            self.cache.put(cache_key, chunk)
+        return chunk
+
+    def getitems(self, keys, *, contexts=None):
+        """Serve cached chunks, fetching the others in one call if the
+        wrapped store can decode several chunks at once."""
+        chunks, missing = {}, []
+        for key in keys:
+            if key.endswith(METADATA_KEYS):
+                missing.append(key)
+                continue
+            level, _, tile = key.rpartition("/")
+            chunk = self.cache.get((self.namespace, level, tile))
+            if chunk is None:
+                missing.append(key)
+            else:
+                chunks[key] = chunk
+        fetched = self._read_many(missing, contexts)
+        for key, chunk in fetched.items():
+            if not key.endswith(METADATA_KEYS):
+                level, _, tile = key.rpartition("/")
+                self.cache.put((self.namespace, level, tile), chunk)
+        chunks.update(fetched)
+        return chunks
+
+
+def file_namespace(path: str | pathlib.Path) -> str:
+    """
+    Cache namespace of a file: its resolved path and modification time, so
+    tiles of a rewritten file are never served.
+    """
+    path = pathlib.Path(path).resolve()
+    return f"{path}:{os.stat(path).st_mtime_ns}"
+
+
+def _nbytes(tile) -> int:
+    return getattr(tile, "nbytes", None) or len(tile)
+
+
+_tile_cache = None
+
+
+def get_tile_cache() -> TileCache:
+    """Return the process-wide tile cache."""
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = TileCache()
+    return _tile_cache
@@ -0,0 +1,297 @@
+"""
+Headless tile access for batch and machine learning pipelines.
+
+`iter_tiles` walks a slide level on a regular grid without a viewer,
+reading tiles ahead of the consumer in a thread pool (each thread with its
+own file handle, see `ParallelTiffStore`) and optionally stacking them into
+contiguous batches.
+"""
+
+import functools
+import logging
+import math
+import pathlib
+import time
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy
+
+from ._image import open_img, read_md
+from ._infer import get_yx_axes
+from ._tissue import get_tissue_mask
+
+logger = logging.getLogger(__name__)
+
+
+class TileIterator:
+    """
+    Iterable over the tiles of a slide level.
+
+    Iterating yields `(tile, (y, x))` pairs, or `(tiles, coords)` batches
+    if `batch_size` is set, with `tiles` a contiguous (N, ...) array and
+    `coords` an (N, 2) array. Coordinates are the top left corner of each
+    tile in pixels of the chosen level; multiply by `downsample` for full
+    resolution pixels. Tiles keep the axis order of the slide, YXS for
+    brightfield and CYX for fluorescence.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the slide.
+    level (Optional[int]): The pyramid level to read, 0 being full resolution.
+    mpp (Optional[float]): Target microns per pixel, the closest level is read instead of `level`. Tiles are not resampled, see `mpp` for the resolution actually read.
+    tile_size (int): Tile height and width.
+    stride (Optional[int]): Step between tiles, `tile_size` by default. Smaller strides give overlapping tiles.
+    channels (Optional[Sequence[int | str]]): Channels (or samples) to read, by index or, for fluorescence slides, by dye or biomarker name. All of them if None.
+    batch_size (Optional[int]): Stack tiles into batches of this size.
+    pad (bool): Zero-pad the tiles crossing the right and bottom edges. If False, only tiles fully inside the level are read.
+    tissue_only (bool): Skip tiles without tissue, according to the tissue mask of the slide (see `get_tissue_mask`).
+    prefetch (int): Maximum number of tiles read ahead of the consumer.
+    n_workers (int): Number of reading threads.
+    """
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        level: Optional[int] = None,
+        mpp: Optional[float] = None,
+        tile_size: int = 512,
+        stride: Optional[int] = None,
+        channels: Optional[Sequence[int | str]] = None,
+        batch_size: Optional[int] = None,
+        pad: bool = True,
+        tissue_only: bool = False,
+        prefetch: int = 16,
+        n_workers: int = 4,
+    ):
+        self.path = pathlib.Path(path)
+        self.tile_size = tile_size
+        self.stride = stride or tile_size
+        self.batch_size = batch_size
+        self.pad = pad
+        self.prefetch = max(prefetch, 1)
+        self.n_workers = n_workers
+        self.tiles = 0
+        self.seconds = 0.0
+
+        self._levels = open_img(self.path, True, decode_workers=n_workers)
+        self._yx_axes = get_yx_axes(self._levels[0].shape)
+        if mpp is not None:
+            level = self._closest_level(mpp)
+        self.level = level or 0
+        self._level = self._levels[self.level]
+        self.downsample = (
+            self._levels[0].shape[self._yx_axes[1]]
+            / self._level.shape[self._yx_axes[1]]
+        )
+        self._channels = self._channel_indices(channels)
+        self._channel_axis = next(
+            axis
+            for axis in range(self._level.ndim + 1)
+            if axis not in self._yx_axes
+        )
+        self.tissue = (
+            get_tissue_mask(self.path, self._levels) if tissue_only else None
+        )
+
+    @functools.cached_property
+    def mpp(self) -> Optional[float]:
+        """Microns per pixel of the level read, None if unknown."""
+        base = _base_mpp(self.path)
+        return None if base is None else base * self.downsample
+
+    @property
+    def tiles_per_second(self) -> float:
+        """Throughput of the tiles yielded so far."""
+        return self.tiles / self.seconds if self.seconds else 0.0
+
+    @property
+    def tile_shape(self) -> tuple:
+        """Shape of every tile yielded."""
+        shape = list(self._level.shape)
+        for axis in self._yx_axes:
+            shape[axis] = self.tile_size
+        if self._channels is not None and self._level.ndim > 2:
+            shape[self._channel_axis] = len(self._channels)
+        return tuple(shape)
+
+    def grid(self) -> numpy.ndarray:
+        """Return the (y, x) corner of every tile, row by row."""
+        height, width = (self._level.shape[axis] for axis in self._yx_axes)
+        if self.pad:
+            ys = range(0, height, self.stride)
+            xs = range(0, width, self.stride)
+        else:
+            ys = range(0, height - self.tile_size + 1, self.stride)
+            xs = range(0, width - self.tile_size + 1, self.stride)
+        grid = numpy.empty((len(ys), len(xs), 2), dtype=numpy.int64)
+        grid[..., 0] = numpy.asarray(ys)[:, None]
+        grid[..., 1] = numpy.asarray(xs)[None, :]
+        grid = grid.reshape(-1, 2)
+        if self.tissue is not None:
+            grid = grid[
+                self.tissue.occupied(grid, self.tile_size, (height, width))
+            ]
+        return grid
+
+    def __len__(self):
+        n_tiles = len(self.grid())
+        if self.batch_size is None:
+            return n_tiles
+        return math.ceil(n_tiles / self.batch_size)
+
+    def __iter__(self):
+        coords = iter(self.grid())
+        pool = ThreadPoolExecutor(self.n_workers)
+        pending = deque()
+        start = time.perf_counter()
+        try:
+            # Bounded read-ahead: at most `prefetch` tiles in flight
+            for yx in coords:
+                pending.append((yx, pool.submit(self._read, yx)))
+                if len(pending) >= self.prefetch:
+                    break
+            batch = batch_coords = None
+            filled = 0
+            while pending:
+                yx, future = pending.popleft()
+                following = next(coords, None)
+                if following is not None:
+                    pending.append(
+                        (following, pool.submit(self._read, following))
+                    )
+                tile = future.result()
+                self.tiles += 1
+                if self.batch_size is None:
+                    self.seconds = time.perf_counter() - start
+                    yield tile, tuple(int(i) for i in yx)
+                    continue
+                if batch is None:
+                    batch = numpy.empty(
+                        (self.batch_size, *tile.shape), dtype=tile.dtype
+                    )
+                    batch_coords = numpy.empty(
+                        (self.batch_size, 2), dtype=numpy.int64
+                    )
+                batch[filled] = tile
+                batch_coords[filled] = yx
+                filled += 1
+                if filled == self.batch_size or not pending:
+                    self.seconds = time.perf_counter() - start
+                    yield batch[:filled], batch_coords[:filled]
+                    batch, filled = None, 0
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            logger.info(
+                "Read %d tiles of %s at %.1f tiles/s",
+                self.tiles,
+                self.path.name,
+                self.tiles_per_second,
+            )
+
+    def close(self):
+        """Release the file handles of the slide."""
+        store = self._levels[0].store
+        if hasattr(store, "close"):
+            store.close()
+
+    def _read(self, yx):
+        y, x = (int(i) for i in yx)
+        window = [slice(None)] * self._level.ndim
+        window[self._yx_axes[0]] = slice(y, y + self.tile_size)
+        window[self._yx_axes[1]] = slice(x, x + self.tile_size)
+        if self._channels is not None and self._level.ndim > 2:
+            window[self._channel_axis] = self._channels
+        tile = self._level.get_orthogonal_selection(tuple(window))
+        if tile.shape == self.tile_shape:
+            return tile
+        padded = numpy.zeros(self.tile_shape, dtype=tile.dtype)
+        padded[tuple(slice(0, size) for size in tile.shape)] = tile
+        return padded
+
+    def _closest_level(self, mpp):
+        base = _base_mpp(self.path)
+        if base is None:
+            raise ValueError(
+                f"{self.path.name} has no resolution metadata, "
+                "select a level instead of a resolution"
+            )
+        x_axis = self._yx_axes[1]
+        mpps = [
+            base * self._levels[0].shape[x_axis] / level.shape[x_axis]
+            for level in self._levels
+        ]
+        return int(numpy.argmin([abs(math.log(i / mpp)) for i in mpps]))
+
+    def _channel_indices(self, channels):
+        if channels is None:
+            return None
+        if all(isinstance(channel, int) for channel in channels):
+            return list(channels)
+        md = read_md(self.path, "IF")
+        dyes = list(md["colmap_channels"])
+        markers = md["fluor_to_marker"] or {}
+        indices = []
+        for channel in channels:
+            if isinstance(channel, int):
+                indices.append(channel)
+            elif channel in dyes:
+                indices.append(dyes.index(channel))
+            elif channel in markers.values():
+                dye = next(d for d, m in markers.items() if m == channel)
+                indices.append(dyes.index(dye))
+            else:
+                raise ValueError(
+                    f"Unknown channel {channel!r}, expected one of {dyes}"
+                )
+        return indices
+
+
+def iter_tiles(
+    path: str | pathlib.Path,
+    level: Optional[int] = None,
+    mpp: Optional[float] = None,
+    tile_size: int = 512,
+    stride: Optional[int] = None,
+    channels: Optional[Sequence[int | str]] = None,
+    batch_size: Optional[int] = None,
+    pad: bool = True,
+    tissue_only: bool = False,
+    prefetch: int = 16,
+    n_workers: int = 4,
+) -> TileIterator:
+    """
+    Iterate over the tiles of a slide without a viewer.
+
+        tiles = iter_tiles("slide.svs", mpp=1.0, tile_size=256, batch_size=32)
+        for batch, coords in tiles:
+            ...
+        print(tiles.tiles_per_second)
+
+    See `TileIterator` for the parameters.
+
+    Returns:
+    TileIterator: An iterable of tiles (or batches) and their coordinates, which keeps count of the throughput.
+    """
+    return TileIterator(
+        path,
+        level,
+        mpp,
+        tile_size,
+        stride,
+        channels,
+        batch_size,
+        pad,
+        tissue_only,
+        prefetch,
+        n_workers,
+    )
+
+
+def _base_mpp(path):
+    # read_md gives the pixel size in centimeters, (1, 1) when unknown
+    res_scale = read_md(path, None)["res_scale"]
+    if tuple(res_scale) == (1, 1):
+        return None
+    return res_scale[0] * 1e4
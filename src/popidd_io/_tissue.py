@@ -0,0 +1,204 @@
+"""
+Tissue detection on the smallest pyramid level.
+
+Most of a whole-slide image is background glass. `get_tissue_mask`
+thresholds the smallest level (Otsu on saturation for brightfield, on the
+summed channel intensity for fluorescence) into a `TissueMask`, which
+answers, for any level and tile grid, which tiles hold tissue. Masks are
+cached next to the slide profile.
+"""
+
+import io
+import json
+import logging
+import pathlib
+from typing import Optional
+
+import numpy
+from scipy.ndimage import binary_dilation
+from skimage.filters import threshold_otsu
+
+from ._infer import get_yx_axes
+from ._instrument import span
+from ._profile import cache_disabled, get_profile_cache, slide_key
+
+logger = logging.getLogger(__name__)
+
+MASK_MAX_SIZE = 2048
+MASK_SUFFIX = "mask.npz"
+
+
+class TissueMask:
+    """
+    Low resolution tissue mask of a slide and its tile-occupancy index.
+
+    Parameters:
+    mask (numpy.ndarray): Boolean YX mask, True on tissue.
+    shape (tuple[int, int]): Full resolution YX shape of the slide.
+    """
+
+    def __init__(self, mask: numpy.ndarray, shape: tuple[int, int]):
+        self.mask = numpy.asarray(mask, dtype=bool)
+        self.shape = tuple(int(size) for size in shape)
+        # Integral image, so that any box is checked in constant time
+        self._integral = numpy.pad(
+            self.mask.cumsum(0).cumsum(1), ((1, 0), (1, 0))
+        )
+
+    @property
+    def fraction(self) -> float:
+        """Fraction of the slide covered by tissue."""
+        return float(self.mask.mean()) if self.mask.size else 0.0
+
+    def occupied(
+        self,
+        corners: numpy.ndarray,
+        tile_size: int,
+        level_shape: tuple[int, int],
+    ) -> numpy.ndarray:
+        """
+        Tell which tiles hold tissue.
+
+        Parameters:
+        corners (numpy.ndarray): (N, 2) top left (y, x) corners of the tiles, in pixels of the level.
+        tile_size (int): Tile height and width, in pixels of the level.
+        level_shape (tuple[int, int]): YX shape of the level.
+
+        Returns:
+        numpy.ndarray: (N,) booleans, True for tiles overlapping tissue.
+        """
+        corners = numpy.asarray(corners, dtype=numpy.float64).reshape(-1, 2)
+        scale = numpy.divide(self.mask.shape, level_shape)
+        # Conservative: every mask pixel a tile touches counts
+        start = numpy.floor(corners * scale).astype(numpy.int64)
+        stop = numpy.ceil((corners + tile_size) * scale).astype(numpy.int64)
+        start = numpy.clip(start, 0, self.mask.shape)
+        stop = numpy.clip(numpy.maximum(stop, start + 1), 0, self.mask.shape)
+        integral = self._integral
+        counts = (
+            integral[stop[:, 0], stop[:, 1]]
+            - integral[start[:, 0], stop[:, 1]]
+            - integral[stop[:, 0], start[:, 1]]
+            + integral[start[:, 0], start[:, 1]]
+        )
+        return counts > 0
+
+    def occupancy(
+        self, level_shape: tuple[int, int], tile_size: int
+    ) -> numpy.ndarray:
+        """
+        Return the (rows, cols) tile-occupancy grid of a level tiled
+        without overlap, True for tiles holding tissue.
+        """
+        n_y, n_x = (-(-size // tile_size) for size in level_shape)
+        corners = numpy.stack(
+            numpy.meshgrid(
+                numpy.arange(n_y) * tile_size,
+                numpy.arange(n_x) * tile_size,
+                indexing="ij",
+            ),
+            axis=-1,
+        )
+        return self.occupied(corners, tile_size, level_shape).reshape(n_y, n_x)
+
+
+def tissue_mask(level, modality: str) -> numpy.ndarray:
+    """
+    Threshold a low resolution level into a boolean tissue mask.
+
+    Brightfield tissue is stained, so more saturated than glass (or darker,
+    for grayscale slides); fluorescence tissue is brighter than background
+    in the (log) sum of its channels. The mask is dilated by one pixel to keep
+    tissue borders.
+    """
+    level = numpy.asarray(level)
+    yx_axes = get_yx_axes(level.shape)
+    if modality == "BF" and level.ndim == 3 and yx_axes == (0, 1):
+        rgb = level[..., :3].astype(numpy.float32)
+        brightest = rgb.max(axis=-1)
+        signal = (brightest - rgb.min(axis=-1)) / numpy.maximum(brightest, 1)
+    elif modality == "BF":
+        signal = -level.astype(numpy.float32)
+    else:
+        channel_axes = tuple(
+            axis for axis in range(level.ndim) if axis not in yx_axes
+        )
+        # Fluorescence spans decades, threshold on a log scale
+        signal = numpy.log1p(
+            level.astype(numpy.float32).sum(axis=channel_axes)
+        )
+
+    if signal.min() == signal.max():
+        # Nothing to tell tissue from background with, keep everything
+        return numpy.ones(signal.shape, dtype=bool)
+    mask = signal > threshold_otsu(signal)
+    return binary_dilation(mask)
+
+
+def get_tissue_mask(
+    path: str | pathlib.Path,
+    levels: Optional[list] = None,
+    modality: Optional[str] = None,
+    use_cache: bool = True,
+) -> TissueMask:
+    """
+    Return the tissue mask of a slide, computing it on its smallest level.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the slide.
+    levels (Optional[list]): Its opened pyramid levels, opened here if None.
+    modality (Optional[str]): "BF" or "IF", taken from the slide profile or inferred if None.
+    use_cache (bool): Whether to reuse (and store) the mask kept next to the slide profile. Also turned off by the POPIDD_NO_CACHE environment variable.
+
+    Returns:
+    TissueMask: The mask and its tile-occupancy index.
+    """
+    from ._image import infer_img, open_img
+    from ._pyramid import complete_pyramid
+
+    path = pathlib.Path(path)
+    cache = get_profile_cache() if use_cache and not cache_disabled() else None
+    if cache is not None:
+        cached = _load_mask(cache.get_file(path, MASK_SUFFIX), path)
+        if cached is not None:
+            return cached
+
+    with span("tissue_mask", slide=path.name):
+        if levels is None:
+            levels = open_img(path, True)
+        if modality is None:
+            profile = cache.get(path) if cache is not None else None
+            if profile is None:
+                profile = infer_img(path, levels)
+            modality = profile["modality"]
+        # Slides without a small enough level get one, read with strides
+        smallest = complete_pyramid(levels, "nearest", MASK_MAX_SIZE)[-1]
+        yx_axes = get_yx_axes(levels[0].shape)
+        mask = TissueMask(
+            tissue_mask(smallest, modality),
+            tuple(levels[0].shape[axis] for axis in yx_axes),
+        )
+    logger.debug("%s: %.0f%% tissue", path.name, 100 * mask.fraction)
+
+    if cache is not None:
+        buffer = io.BytesIO()
+        numpy.savez_compressed(
+            buffer,
+            mask=mask.mask,
+            shape=numpy.asarray(mask.shape),
+            key=json.dumps(slide_key(path)),
+        )
+        cache.put_file(path, MASK_SUFFIX, buffer.getvalue())
+    return mask
+
+
+def _load_mask(data, path):
+    if data is None:
+        return None
+    try:
+        with numpy.load(io.BytesIO(data)) as stored:
+            if json.loads(str(stored["key"])) != slide_key(path):
+                return None
+            return TissueMask(stored["mask"], tuple(stored["shape"]))
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,234 @@
+"""
+Transcode slides to local multiscale Zarr stores.
+
+Vendor formats (.svs, .ndpi, .qptiff) come with tile sizes and codecs that
+do not suit interactive viewing, and some lack a full pyramid. `transcode`
+streams a slide into an OME-Zarr style multiscale group with viewer
+friendly chunks and a fast Blosc codec, completes its pyramid, and keeps
+the slide profile (everything `read_md` extracts) in the group attributes.
+`load_img` then opens the transcoded store instead of the slide whenever
+one exists and is newer than the slide.
+
+Command line usage:
+
+    popidd-transcode slide.svs [slide2.qptiff ...] [--chunk 512] [--codec lz4]
+"""
+
+import argparse
+import os
+import pathlib
+from typing import Optional
+
+import numcodecs
+import numpy
+import zarr
+from dask import array as darray
+
+from ._infer import get_yx_axes
+from ._profile import atomic_write, cache_key, default_cache_dir
+
+DEFAULT_CHUNK = 512
+CODECS = ("lz4", "zstd")
+
+
+def transcoded_path(path: str | pathlib.Path) -> pathlib.Path:
+    """Return where the transcoded store of a slide is kept by default."""
+    return default_cache_dir() / "zarr" / f"{cache_key(path)}.zarr"
+
+
+def find_transcoded(path: str | pathlib.Path) -> Optional[pathlib.Path]:
+    """
+    Return the transcoded store of a slide if there is one newer than the
+    slide, None otherwise.
+    """
+    store = transcoded_path(path)
+    attrs = store / ".zattrs"
+    if not attrs.is_file():
+        return None
+    if attrs.stat().st_mtime_ns <= os.stat(path).st_mtime_ns:
+        return None
+    return store
+
+
+def open_transcoded(store: str | pathlib.Path, load_mem: bool = False):
+    """
+    Open the levels and the stored slide profile of a transcoded slide.
+
+    Returns:
+    tuple[list, dict]: The pyramid levels (dask arrays, or zarr arrays if `load_mem` is set) and the slide profile.
+    """
+    group = zarr.open_group(str(store), "r")
+    datasets = group.attrs["multiscales"][0]["datasets"]
+    zarray = [group[dataset["path"]] for dataset in datasets]
+    if not load_mem:
+        zarray = [darray.from_zarr(array) for array in zarray]
+    return zarray, dict(group.attrs["popidd"]["profile"])
+
+
+def transcode(
+    path: str | pathlib.Path,
+    out: Optional[str | pathlib.Path] = None,
+    chunk: int = DEFAULT_CHUNK,
+    codec: str = "lz4",
+    n_workers: Optional[int] = None,
+    overwrite: bool = False,
+) -> pathlib.Path:
+    """
+    Convert a slide to a chunked multiscale Zarr store.
+
+    Levels are streamed chunk by chunk with dask, so the slide never has to
+    fit in memory, and written in parallel. Levels below the smallest one of
+    the slide are generated by 2x2 mean downsampling until a level fits in
+    one chunk.
+
+    Parameters:
+    path (str | pathlib.Path): The path to the slide.
+    out (Optional[str | pathlib.Path]): Where to write the store. Defaults to `transcoded_path(path)`, where `load_img` looks for it.
+    chunk (int): Chunk size along Y and X.
+    codec (str): Blosc compressor, "lz4" (fastest) or "zstd" (smaller).
+    n_workers (Optional[int]): Number of threads reading and writing chunks. Defaults to the number of CPUs.
+    overwrite (bool): Whether to replace an existing store.
+
+    Returns:
+    pathlib.Path: The path to the transcoded store.
+    """
+    from ._image import profile_from_md, infer_img, open_img, read_md
+
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+    path = pathlib.Path(path)
+    out = transcoded_path(path) if out is None else pathlib.Path(out)
+    if out.exists() and not overwrite:
+        raise FileExistsError(f"{out} already exists")
+
+    levels = open_img(path, load_mem=True)
+    profile = infer_img(path, levels)
+    profile.update(profile_from_md(read_md(path, profile["modality"])))
+
+    yx_axes = get_yx_axes(levels[0].shape)
+    compressor = numcodecs.Blosc(
+        cname=codec, clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE
+    )
+
+    # Written next to the final location, then moved into place, so an
+    # interrupted conversion is never picked up by load_img
+    with atomic_write(out) as tmp:
+        group = zarr.open_group(str(tmp), "w")
+        scales = []
+        level = darray.from_zarr(levels[0])
+        index = 0
+        while True:
+            chunks = tuple(
+                chunk if axis in yx_axes else (1 if size > 4 else size)
+                for axis, size in enumerate(level.shape)
+            )
+            target = group.create_dataset(
+                str(index),
+                shape=level.shape,
+                chunks=chunks,
+                dtype=level.dtype,
+                compressor=compressor,
+            )
+            level.rechunk(chunks).store(
+                target, lock=False, num_workers=n_workers
+            )
+            scales.append(
+                [
+                    (
+                        levels[0].shape[axis] / level.shape[axis]
+                        if axis in yx_axes
+                        else 1.0
+                    )
+                    for axis in range(level.ndim)
+                ]
+            )
+
+            index += 1
+            if index < len(levels):
+                level = darray.from_zarr(levels[index])
+            elif max(level.shape[axis] for axis in yx_axes) > chunk:
+                # Downsample the level just written, not the source
+                written = darray.from_zarr(target)
+                level = darray.coarsen(
+                    numpy.mean,
+                    written,
+                    dict.fromkeys(yx_axes, 2),
+                    trim_excess=True,
+                ).astype(written.dtype)
+            else:
+                break
+
+        group.attrs["multiscales"] = [
+            {
+                "version": "0.4",
+                "name": path.stem,
+                "axes": _axes(levels[0].shape, yx_axes),
+                "datasets": [
+                    {
+                        "path": str(i),
+                        "coordinateTransformations": [
+                            {"type": "scale", "scale": scale}
+                        ],
+                    }
+                    for i, scale in enumerate(scales)
+                ],
+            }
+        ]
+        stat = path.stat()
+        group.attrs["popidd"] = {
+            "source": {
+                "path": str(path.resolve()),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            },
+            "profile": profile,
+        }
+    return out
+
+
+def _axes(shape, yx_axes):
+    names = iter("cz" if len(shape) > 3 else "c")
+    return [
+        (
+            {"name": "yx"[yx_axes.index(axis)], "type": "space"}
+            if axis in yx_axes
+            else {"name": next(names), "type": "channel"}
+        )
+        for axis in range(len(shape))
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="popidd-transcode",
+        description="Convert slides to chunked multiscale Zarr stores "
+        "that load_img opens instead of the slides.",
+    )
+    parser.add_argument("paths", nargs="+", type=pathlib.Path)
+    parser.add_argument(
+        "--out",
+        type=pathlib.Path,
+        help="output store (single slide only), defaults to the cache",
+    )
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK)
+    parser.add_argument("--codec", choices=CODECS, default="lz4")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args(argv)
+    if args.out is not None and len(args.paths) > 1:
+        parser.error("--out can only be used with a single slide")
+
+    for path in args.paths:
+        out = transcode(
+            path,
+            args.out,
+            chunk=args.chunk,
+            codec=args.codec,
+            n_workers=args.workers,
+            overwrite=args.overwrite,
+        )
+        print(f"{path} -> {out}")
+
+
+if __name__ == "__main__":
+    main()
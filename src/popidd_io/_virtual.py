@@ -0,0 +1,230 @@
+"""
+Virtual tiling of striped and huge-tile TIFFs.
+
+Through the tifffile `aszarr` store a chunk is a TIFF strip or tile, so a
+striped slide has chunks one band of rows high and the whole slide wide,
+and an export with 4096 pixel tiles has chunks of 4096 x 4096: napari then
+decodes megabytes to draw a few hundred pixels. `VirtualTileStore`
+presents such levels with viewer-sized chunks instead. Each strip or tile
+is decoded once into the tile cache and virtual chunks are cut from it;
+levels stored uncompressed and contiguous are cut straight from a memory
+map of the file, without decoding or caching anything.
+"""
+
+import itertools
+import json
+import logging
+import threading
+from collections.abc import MutableMapping
+from typing import Optional
+
+import numpy
+
+from ._infer import get_yx_axes
+from ._tiles import METADATA_KEYS, ReadOnlyStore, TileCache, get_tile_cache
+
+logger = logging.getLogger(__name__)
+
+VIRTUAL_TILE = 512
+N_LOCKS = 64  # source chunks decoded at the same time, at most
+
+
+class VirtualTileStore(ReadOnlyStore):
+    """
+    Read-only zarr store re-chunking oversized TIFF chunks.
+
+    Levels whose strips or tiles exceed `tile` along Y or X get chunks of
+    `tile` x `tile` pixels (other axes keep their chunking); other levels
+    are served from the wrapped store as they are.
+
+    Parameters:
+    store (MutableMapping): The store to wrap, e.g. a tifffile ZarrTiffStore.
+    namespace (str): Identifies the file in the cache keys, see `file_namespace`.
+    tile (int): Chunk size along Y and X of the virtual levels.
+    tif (Optional[tifffile.TiffFile]): The opened TIFF, whose uncompressed contiguous levels are memory mapped (see `level_memmaps`) if any level is re-chunked.
+    cache (Optional[TileCache]): Where decoded strips and tiles are kept, the process-wide tile cache by default.
+    """
+
+    def __init__(
+        self,
+        store: MutableMapping,
+        namespace: str,
+        tile: int = VIRTUAL_TILE,
+        tif=None,
+        cache: Optional[TileCache] = None,
+    ):
+        super().__init__(store)
+        self.namespace = namespace
+        self.tile = tile
+        self.cache = get_tile_cache() if cache is None else cache
+        self._levels = {}  # path prefix -> (source metadata, virtual chunks)
+        self._memmaps = {}
+        self._locks = [threading.Lock() for _ in range(N_LOCKS)]
+        prefixes = _level_prefixes(store)
+        for prefix in prefixes:
+            meta = json.loads(store[f"{prefix}.zarray"])
+            chunks = _virtual_chunks(meta["shape"], meta["chunks"], tile)
+            if chunks is not None:
+                self._levels[prefix] = (meta, chunks)
+        if self._levels and tif is not None:
+            for index, memmap in level_memmaps(tif).items():
+                prefix = prefixes[index] if index < len(prefixes) else None
+                if prefix in self._levels and memmap.shape == tuple(
+                    self._levels[prefix][0]["shape"]
+                ):
+                    self._memmaps[prefix] = memmap
+        logger.debug(
+            "%s: virtual %d x %d chunks on levels %s",
+            namespace,
+            tile,
+            tile,
+            sorted(self._levels),
+        )
+
+    @property
+    def virtual(self) -> bool:
+        """Whether any level is re-chunked."""
+        return bool(self._levels)
+
+    def __getitem__(self, key):
+        prefix, _, name = key.rpartition("/")
+        prefix = f"{prefix}/" if prefix else ""
+        if prefix not in self._levels:
+            return self.store[key]
+        meta, chunks = self._levels[prefix]
+        if name == ".zarray":
+            return json.dumps({**meta, "chunks": chunks}).encode()
+        if key.endswith(METADATA_KEYS):
+            return self.store[key]
+        coords = _chunk_coords(name, meta, chunks)
+        if coords is None:
+            raise KeyError(key)
+        return self._virtual_chunk(prefix, coords)
+
+    def __contains__(self, key):
+        prefix, _, name = key.rpartition("/")
+        prefix = f"{prefix}/" if prefix else ""
+        if prefix not in self._levels or key.endswith(METADATA_KEYS):
+            return key in self.store
+        meta, chunks = self._levels[prefix]
+        return _chunk_coords(name, meta, chunks) is not None
+
+    def _virtual_chunk(self, prefix, coords):
+        meta, chunks = self._levels[prefix]
+        dtype = numpy.dtype(meta["dtype"])
+        window = tuple(
+            slice(i * size, min((i + 1) * size, total))
+            for i, size, total in zip(coords, chunks, meta["shape"])
+        )
+        memmap = self._memmaps.get(prefix)
+        if memmap is not None:
+            view = memmap[window]
+            if view.shape == tuple(chunks) and view.dtype == dtype:
+                return view  # zarr copies it once, into the output
+            out = numpy.full(chunks, meta["fill_value"] or 0, dtype=dtype)
+            out[tuple(slice(0, s) for s in view.shape)] = view
+            return out
+
+        out = numpy.full(chunks, meta["fill_value"] or 0, dtype=dtype)
+        source = meta["chunks"]
+        ranges = [
+            range(w.start // size, (w.stop - 1) // size + 1)
+            for w, size in zip(window, source)
+        ]
+        for source_coords in itertools.product(*ranges):
+            chunk = self._source_chunk(prefix, source_coords)
+            if chunk is None:
+                continue
+            # Intersection of the source chunk and the virtual chunk
+            target, origin = [], []
+            for w, i, size in zip(window, source_coords, source):
+                start = max(w.start, i * size)
+                stop = min(w.stop, (i + 1) * size)
+                target.append(slice(start - w.start, stop - w.start))
+                origin.append(slice(start - i * size, stop - i * size))
+            out[tuple(target)] = chunk[tuple(origin)]
+        return out
+
+    def _source_chunk(self, prefix, coords):
+        meta, _ = self._levels[prefix]
+        separator = meta.get("dimension_separator") or "."
+        key = prefix + separator.join(str(i) for i in coords)
+        cache_key = (self.namespace, prefix.rstrip("/"), f"source:{key}")
+        chunk = self.cache.get(cache_key)
+        if chunk is not None:
+            return chunk
+        # Virtual chunks sharing a strip wait for it to be decoded once
+        with self._locks[hash(key) % N_LOCKS]:
+            chunk = self.cache.get(cache_key)
+            if chunk is not None:
+                return chunk
+            try:
+                chunk = self.store[key]
+            except KeyError:
+                return None
+            dtype = numpy.dtype(meta["dtype"])
+            if isinstance(chunk, numpy.ndarray):
+                chunk = chunk.astype(dtype, copy=False)
+            else:
+                chunk = numpy.frombuffer(chunk, dtype=dtype)
+            chunk = chunk.reshape(meta["chunks"])
+            self.cache.put(cache_key, chunk)
+        return chunk
+
+
+def level_memmaps(tif) -> dict:
+    """
+    Memory map the uncompressed, contiguous levels of a TIFF.
+
+    Parameters:
+    tif (tifffile.TiffFile): The opened TIFF.
+
+    Returns:
+    dict: Read-only `numpy.memmap` of each such level of the first series, by level index.
+    """
+    memmaps = {}
+    for index, level in enumerate(tif.series[0].levels):
+        if level.dataoffset is None or not all(
+            page is not None and page.is_memmappable for page in level.pages
+        ):
+            continue
+        # Contiguous, so this maps the file and copies nothing
+        memmaps[index] = level.asarray(out="memmap")
+    return memmaps
+
+
+def _level_prefixes(store):
+    # "" for a single level store, "0/", "1/", ... for a multiscale group
+    if ".zarray" in store:
+        return [""]
+    attrs = json.loads(store[".zattrs"]) if ".zattrs" in store else {}
+    datasets = attrs.get("multiscales", [{}])[0].get("datasets", [])
+    return [f"{dataset['path']}/" for dataset in datasets]
+
+
+def _virtual_chunks(shape, chunks, tile):
+    # Viewer-sized chunks if a strip or tile exceeds `tile`, None otherwise
+    yx_axes = get_yx_axes(shape)
+    if all(chunks[axis] <= tile for axis in yx_axes):
+        return None
+    return [
+        min(tile, size) if axis in yx_axes else chunk
+        for axis, (size, chunk) in enumerate(zip(shape, chunks))
+    ]
+
+
+def _chunk_coords(name, meta, chunks):
+    # Chunk indices of a key, None if it is not a chunk of the level
+    separator = meta.get("dimension_separator") or "."
+    try:
+        coords = tuple(int(i) for i in name.split(separator))
+    except ValueError:
+        return None
+    n_chunks = [
+        -(-size // chunk) for size, chunk in zip(meta["shape"], chunks)
+    ]
+    if len(coords) != len(n_chunks) or not all(
+        0 <= i < n for i, n in zip(coords, n_chunks)
+    ):
+        return None
+    return coords
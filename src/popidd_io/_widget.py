@@ -33,14 +33,20 @@ from typing import TYPE_CHECKING
 import warnings
 from napari.utils.notifications import WarningNotification
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from magicgui import magic_factory
+from magicgui.widgets import PushButton
 import napari.layers
-
-import numpy
+import pandas
 
 from ._image import load_img
-from ._anno import load_geojson
+from ._tiles import get_tile_cache
+from ._anno import GEOJSON_MAX_BYTES, load_parquet, stream_geojson
+from ._culling import MAX_VISIBLE_SHAPES, CulledShapes, add_culled_shapes
+from ._labels import load_cell_labels
+from ._prefetch import PREFETCH_BYTES, add_prefetcher
+from ._library import SlideLibrary, library_path
 
 if TYPE_CHECKING:
     import napari
@@ -50,25 +56,137 @@ def image_reader(
     viewer: "napari.Viewer",
     bf_imgs = Path(""),
     if_imgs = Path(""),
-    load_mem = bool
+    load_mem = bool,
+    n_workers = 4,
+    tile_cache_mb = 0,
+    prefetch_radius = 0,
+    prefetch_mb = PREFETCH_BYTES // (1024 * 1024),
+    use_cache = True,
 ):
-    empty_flag = True
-    for img in bf_imgs:
-        if img.is_file():
-            img_layer_data = load_img(img, modality="BF", load_mem=load_mem)
-            for i in img_layer_data: #unpacking list of tuples even if BF images should only have 1 layer per image
-                viewer.add_layer(napari.layers.Layer.create(*i)) #unpack tuple as func uses positional args
-                # viewer._add_layer_from_data(*i) #use this one if channel_axis present
-            empty_flag = False
-    for img in if_imgs:
-        if img.is_file():
-            img_layer_data = load_img(img, modality="IF", load_mem=load_mem)
-            for i in img_layer_data:
-                viewer.add_layer(napari.layers.Layer.create(*i))
-            empty_flag = False
-    if empty_flag is True: # Should the selection be empty it will return a warning on the GUI
+    jobs = [(img, "BF") for img in bf_imgs if img.is_file()]
+    jobs += [(img, "IF") for img in if_imgs if img.is_file()]
+    if not jobs: # Should the selection be empty it will return a warning on the GUI
         warning_empty = warnings.warn("No image(s) selected for loading.")
         WarningNotification(warning_empty)
+        return None
+
+    tile_cache = tile_cache_mb > 0
+    if tile_cache:
+        get_tile_cache().max_bytes = tile_cache_mb * 1024 * 1024
+    return _start_loading(
+        viewer,
+        jobs,
+        load_mem=load_mem,
+        n_workers=n_workers,
+        tile_cache=tile_cache,
+        prefetch_radius=prefetch_radius,
+        prefetch_mb=prefetch_mb,
+        use_cache=use_cache,
+    )
+
+
+def _start_loading(
+    viewer,
+    jobs,
+    load_mem=False,
+    n_workers=4,
+    tile_cache=False,
+    prefetch_radius=0,
+    prefetch_mb=PREFETCH_BYTES // (1024 * 1024),
+    use_cache=True,
+):
+    # Prefetched tiles are only seen by layers reading through the cache
+    tile_cache = tile_cache or prefetch_radius > 0
+
+    from napari.qt.threading import thread_worker
+
+    # Slides are opened and profiled off the Qt thread, layers are added
+    # on it as each slide becomes ready
+    worker = thread_worker(
+        iter_load_img,
+        progress={"total": len(jobs), "desc": "Loading image(s)"},
+    )(
+        jobs,
+        load_mem=load_mem,
+        n_workers=n_workers,
+        tile_cache=tile_cache,
+        use_cache=use_cache,
+    )
+
+    def _add_layers(img_layer_data):
+        layers = []
+        for i in img_layer_data: #unpacking list of tuples even if BF images should only have 1 layer per image
+            layers.append(viewer.add_layer(napari.layers.Layer.create(*i))) #unpack tuple as func uses positional args
+            # viewer._add_layer_from_data(*i) #use this one if channel_axis present
+        if prefetch_radius > 0 and layers:
+            # Channel layers share the tiles of their slide, one is enough
+            add_prefetcher(
+                viewer, layers[0], prefetch_radius, prefetch_mb * 1024 * 1024
+            )
+
+    def _warn_failed(exc):
+        warning_failed = warnings.warn(
+            f"Image loading failed: {exc}", stacklevel=2
+        )
+        WarningNotification(warning_failed)
+
+    worker.yielded.connect(_add_layers)
+    worker.errored.connect(_warn_failed)
+    worker.start()
+    return worker
+
+
+def iter_load_img(
+    jobs, load_mem=False, n_workers=4, tile_cache=False, use_cache=True
+):
+    """
+    Load several images in a bounded thread pool.
+
+    Parameters:
+    jobs (list[tuple[pathlib.Path, str]]): The images to load and their modality.
+    load_mem (bool): Whether to load the images into memory.
+    n_workers (int): Maximum number of images opened at the same time.
+    tile_cache (bool): Whether to serve decoded tiles through the process-wide tile cache.
+    use_cache (bool): Whether to reuse (and store) the slide profiles kept in the on-disk cache.
+
+    Yields:
+    list[napari.types.LayerDataTuple]: The layers of each image, in the order they finish loading.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, n_workers))
+    try:
+        futures = [
+            executor.submit(
+                load_img,
+                img,
+                modality=modality,
+                load_mem=load_mem,
+                tile_cache=tile_cache,
+                use_cache=use_cache,
+            )
+            for img, modality in jobs
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Reached on completion, on error and when the worker is quit
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_cancel_button(widget):
+    # Adds a button quitting the load started by the last call
+    cancel_button = PushButton(text="Cancel loading")
+
+    def _remember_worker(worker):
+        widget._worker = worker
+
+    def _cancel():
+        worker = getattr(widget, "_worker", None)
+        if worker is not None:
+            worker.quit()
+
+    widget.called.connect(_remember_worker)
+    cancel_button.changed.connect(_cancel)
+    widget.append(cancel_button)
 
 #Test magic factory usage directly (not as decorator)
 wLoadImage = magic_factory(function=image_reader,
@@ -86,28 +204,287 @@ wLoadImage = magic_factory(function=image_reader,
             "widget_type": "CheckBox", "value": False, 
             "text": "Load full image(s) into memory"
             },
-        call_button = "Load image(s)")
+        n_workers = {
+            "label": "Parallel loads",
+            "widget_type": "SpinBox", "min": 1, "max": 32,
+            },
+        tile_cache_mb = {
+            "label": "Tile cache (MB, 0 = off)",
+            "widget_type": "SpinBox", "min": 0, "max": 65536, "step": 256,
+            },
+        prefetch_radius = {
+            "label": "Prefetch radius (tiles, 0 = off)",
+            "widget_type": "SpinBox", "min": 0, "max": 8,
+            },
+        prefetch_mb = {
+            "label": "Prefetch budget (MB)",
+            "widget_type": "SpinBox", "min": 16, "max": 16384, "step": 64,
+            },
+        use_cache = {
+            "widget_type": "CheckBox",
+            "text": "Reuse slide profiles cached on disk",
+            },
+        call_button = "Load image(s)",
+        widget_init = _init_cancel_button)
+
+
+SLIDE_LIST_LIMIT = 1000  # slides listed by the library widget
+
+
+def slide_library(
+    viewer: "napari.Viewer",
+    library_index = Path(""),
+    search = "",
+    modality = "any",
+    slides = (),
+    n_workers = 4,
+):
+    # Choices are (path, modality) pairs of the index, see _init_slide_library
+    jobs = [(Path(path), slide_modality) for path, slide_modality in slides]
+    if not jobs:
+        warning_empty = warnings.warn(
+            "No slide(s) selected for loading.", stacklevel=2
+        )
+        WarningNotification(warning_empty)
+        return None
+    return _start_loading(viewer, jobs, n_workers=n_workers)
+
+
+def _init_slide_library(widget):
+    # The default index, resolved when the widget is made, not on import
+    if not str(widget.library_index.value).strip("."):
+        widget.library_index.value = library_path()
+
+    # Lists the slides of the index matching the search, on every change
+    def _refresh(*_):
+        index = Path(widget.library_index.value)
+        entries = []
+        modality = widget.modality.value
+        if index.is_file():
+            with SlideLibrary(index) as library:
+                entries = library.find(
+                    widget.search.value,
+                    None if modality == "any" else modality,
+                    limit=SLIDE_LIST_LIMIT,
+                )
+        widget.slides.choices = [
+            (_slide_label(entry), (entry["path"], entry["modality"]))
+            for entry in entries
+        ]
+
+    widget.library_index.changed.connect(_refresh)
+    widget.search.changed.connect(_refresh)
+    widget.modality.changed.connect(_refresh)
+    _refresh()
+
+
+def _slide_label(entry):
+    # e.g. "slide.qptiff  IF  20000 x 15000  DAPI, CD8"
+    label = (
+        f"{entry['name']}  {entry['modality']}  "
+        f"{entry['width']} x {entry['height']}"
+    )
+    if entry["channels"]:
+        label += "  " + ", ".join(entry["channels"])
+    return label
+
+
+wSlideLibrary = magic_factory(function=slide_library,
+        library_index = {
+            "label": "Library index",
+            "widget_type": "FileEdit", "mode": "r",
+            "filter": "*.sqlite",
+            },
+        search = {"label": "Search"},
+        modality = {
+            "label": "Modality",
+            "widget_type": "ComboBox", "choices": ["any", "BF", "IF"],
+            },
+        slides = {
+            "label": "Slides",
+            "widget_type": "Select", "choices": [],
+            },
+        n_workers = {
+            "label": "Parallel loads",
+            "widget_type": "SpinBox", "min": 1, "max": 32,
+            },
+        call_button = "Open selected",
+        widget_init = _init_slide_library)
 
 
 def anno_reader(
         viewer: "napari.Viewer",
         image: "napari.layers.Image",
         anno_paths = Path(""),
+        max_shapes = MAX_VISIBLE_SHAPES,
+        cells_as_labels = False,
+        max_anno_mb = GEOJSON_MAX_BYTES // (1024 * 1024),
 ):
+    # Outlines are simplified to the displayed image level when culled
+    downsamples = [i[-1] for i in image.downsample_factors]
+    geojsons = []
     for anno in anno_paths:
-        shape_layer_data = load_geojson(anno)
+        if cells_as_labels:
+            # Rasterized on demand, chunk by chunk, at the image levels
+            for i in load_cell_labels(
+                anno, image.metadata["path"], scale=image.scale
+            ):
+                viewer.add_layer(napari.layers.Layer.create(*i))
+            continue
+        if anno.suffix.lower() != ".parquet":
+            geojsons.append(anno) # streamed below, batch by batch
+            continue
+        shape_layer_data = load_parquet(anno)
+        for i in shape_layer_data:
+            i[1]["scale"] = image.scale # vertices are already in image pixel (row, column) coordinates
+        if max_shapes > 0:
+            # Only the shapes around the view are handed to napari
+            add_culled_shapes(
+                viewer, shape_layer_data, max_shapes, downsamples
+            )
+            continue
         for i in shape_layer_data:
-            i[1]["scale"] = image.scale*numpy.array([-1,1])
             viewer.add_layer(napari.layers.Layer.create(*i))
+    if not geojsons:
+        return None
+
+    from napari.qt.threading import thread_worker
+    from napari.utils import progress
+
+    # Features are parsed off the Qt thread and their shapes appended to
+    # the layers of their class on it, as each batch is ready
+    pbar = progress(
+        total=sum(anno.stat().st_size for anno in geojsons),
+        desc="Loading annotation(s)",
+    )
+    worker = thread_worker(iter_stream_geojson)(
+        geojsons, max_bytes=max_anno_mb * 1024 * 1024
+    )
+    layers = {}
+
+    def _add_batch(batch):
+        anno, layer_data, bytes_read = batch
+        for i in layer_data:
+            i[1]["scale"] = image.scale
+        add_anno_batch(
+            viewer, layers, anno, layer_data, max_shapes, downsamples
+        )
+        pbar.update(bytes_read - pbar.n)
+
+    def _warn_failed(exc):
+        warning_failed = warnings.warn(
+            f"Annotation loading stopped: {exc}", stacklevel=2
+        )
+        WarningNotification(warning_failed)
+
+    worker.yielded.connect(_add_batch)
+    worker.errored.connect(_warn_failed)
+    worker.finished.connect(pbar.close)
+    worker.start()
+    return worker
+
+
+def iter_stream_geojson(annos, max_bytes=GEOJSON_MAX_BYTES):
+    """
+    Stream the layers of several GeoJSON files, batch by batch.
+
+    Parameters:
+    annos (list[pathlib.Path]): The GeoJSON files, read one after the other.
+    max_bytes (Optional[int]): Maximum size of the vertices and features streamed from each file, see `stream_geojson`.
+
+    Yields:
+    tuple[pathlib.Path, list[napari.types.LayerDataTuple], int]: The file, the layers of a batch of its features, and the number of bytes of all files read so far.
+    """
+    done = 0
+    for anno in annos:
+        for layer_data, bytes_read in stream_geojson(
+            anno, max_bytes=max_bytes
+        ):
+            yield anno, layer_data, done + bytes_read
+        done += anno.stat().st_size
+
+
+def add_anno_batch(
+    viewer,
+    layers,
+    anno,
+    layer_data,
+    max_shapes=MAX_VISIBLE_SHAPES,
+    downsamples=None,
+):
+    """
+    Add a batch of streamed annotation layers to a viewer, appending each
+    to the layer of the same name already added from that file, if any.
+
+    Parameters:
+    viewer (napari.Viewer): The viewer.
+    layers (dict): The layers (or CulledShapes) added so far by (file, name), updated in place.
+    anno (pathlib.Path): The file the batch comes from.
+    layer_data (list[napari.types.LayerDataTuple]): The layers of the batch, from `stream_geojson`.
+    max_shapes (int): Maximum number of shapes displayed at once per layer, all of them if 0.
+    downsamples (Optional[Sequence[float]]): Downsample of each level of the annotated image pyramid, to simplify outlines with.
+    """
+    for data, kwargs, layer_type in layer_data:
+        key = (anno, kwargs["name"])
+        target = layers.get(key)
+        if target is None:
+            if max_shapes > 0 and layer_type == "shapes":
+                (layers[key],) = add_culled_shapes(
+                    viewer,
+                    [(data, kwargs, layer_type)],
+                    max_shapes,
+                    downsamples,
+                )
+            else:
+                layers[key] = viewer.add_layer(
+                    napari.layers.Layer.create(data, kwargs, layer_type)
+                )
+        elif isinstance(target, CulledShapes):
+            target.extend(data, kwargs)
+        else:
+            _append_layer(target, data, kwargs, layer_type)
+
+
+def _append_layer(layer, data, kwargs, layer_type):
+    # Adds the shapes or points of a later batch and their features
+    n_known = len(layer.data)
+    if layer_type == "shapes":
+        layer.add(
+            data,
+            shape_type=kwargs["shape_type"],
+            edge_color=kwargs.get("edge_color", layer.current_edge_color),
+        )
+    else:
+        if "face_color" in kwargs:
+            layer.current_face_color = kwargs["face_color"]
+        layer.add(data)
+    layer.features = pandas.concat(
+        [layer.features.iloc[:n_known], kwargs["features"]],
+        ignore_index=True,
+    )
+
+
 wLoadAnno = magic_factory(function=anno_reader,
         image = {"label":"Image layer"},
         anno_paths = {
-            "label":"Annotation GEOJSON",
+            "label":"Annotation GEOJSON/parquet",
             "widget_type": "FileEdit", "mode": "rm", 
-            "filter":"*.geojson"
+            "filter":"*.geojson;*.parquet"
             },
-        call_button="Load Annotation"
-        )
+        max_shapes = {
+            "label": "Shapes in view (0 = all)",
+            "widget_type": "SpinBox", "min": 0, "max": 1000000, "step": 1000,
+            },
+        cells_as_labels = {
+            "widget_type": "CheckBox", "value": False,
+            "text": "Cell detections as labels",
+            },
+        max_anno_mb = {
+            "label": "Annotation memory cap (MB)",
+            "widget_type": "SpinBox", "min": 64, "max": 262144, "step": 512,
+            },
+        call_button="Load Annotation",
+        widget_init = _init_cancel_button)
 
 
 # from qtpy.QtWidgets import QHBoxLayout, QPushButton, QWidget
@@ -1 +1,364 @@
-# For now I will only add here support for geojson and parquet writing of shapes/points/labels layers
\ No newline at end of file
+"""
+Writers exporting Shapes and Points layers as QuPath compatible GeoJSON
+and GeoParquet.
+
+Vertices are taken to be image pixel (row, column) coordinates, as given
+by `load_geojson`/`load_parquet` (and by any layer sharing the scale of the
+image it annotates), and are swapped back to QuPath (x, y) in one step for
+all layers. Shapes that `load_geojson` split out of one feature (its
+"id", "part" and "ring" features) are reassembled into that feature's
+polygons, holes, multi-part geometries and collections. Layers culled
+to the view (see `CulledShapes`) are written with all their shapes.
+"""
+
+import json
+import pathlib
+from typing import Any
+
+import geopandas
+import numpy
+import pandas
+import shapely
+
+from ._culling import culled_shapes
+
+FullLayerData = tuple[Any, dict, str]
+
+POLYGON_TYPES = ("polygon", "rectangle", "ellipse")
+ELLIPSE_VERTICES = 64
+GEOJSON_CHUNK = 10000  # features serialised at a time
+
+
+def write_geojson(path: str, data: list[FullLayerData]) -> list[str]:
+    """
+    Write Shapes and Points layers to a GeoJSON FeatureCollection.
+
+    Features are streamed to the file in chunks rather than built into one
+    FeatureCollection dict.
+
+    Parameters:
+    path (str): The path of the GeoJSON file.
+    data (list[FullLayerData]): The (data, meta, layer_type) tuples of the layers.
+
+    Returns:
+    list[str]: The written path.
+    """
+    geoms, properties = layers_to_geoms(data)
+    properties["classification"] = [
+        _qupath_class(name, color)
+        for name, color in zip(
+            properties.pop("classification"), properties.pop("color")
+        )
+    ]
+    ids = properties.pop("id").tolist()
+
+    with open(path, "w") as fh:
+        fh.write('{"type": "FeatureCollection", "features": [')
+        for start in range(0, len(properties), GEOJSON_CHUNK):
+            chunk = properties.iloc[start : start + GEOJSON_CHUNK]
+            geometry_json = shapely.to_geojson(
+                geoms[start : start + GEOJSON_CHUNK]
+            )
+            for offset, record in enumerate(chunk.to_dict("records")):
+                index = start + offset
+                fid = ids[index]
+                fid = (
+                    ""
+                    if _isnull(fid)
+                    else f'"id": {json.dumps(fid, default=_json_default)}, '
+                )
+                properties_json = json.dumps(
+                    {
+                        key: value
+                        for key, value in record.items()
+                        if not _isnull(value)
+                    },
+                    default=_json_default,
+                )
+                fh.write(
+                    f'{"," if index else ""}\n{{"type": "Feature", {fid}'
+                    f'"geometry": {geometry_json[offset]}, '
+                    f'"properties": {properties_json}}}'
+                )
+        fh.write("\n]}\n")
+    return [path]
+
+
+def write_parquet(path: str, data: list[FullLayerData]) -> list[str]:
+    """
+    Write Shapes and Points layers to a zstd compressed GeoParquet file.
+
+    Classifications are stored as plain names, so `load_parquet` can push
+    class filters down to the reader, and a bbox covering column is added
+    for bounding box filters.
+
+    Parameters:
+    path (str): The path of the parquet file.
+    data (list[FullLayerData]): The (data, meta, layer_type) tuples of the layers.
+
+    Returns:
+    list[str]: The written path.
+    """
+    geoms, properties = layers_to_geoms(data)
+    properties = properties.drop(columns="color")
+    geopandas.GeoDataFrame(properties, geometry=geoms).to_parquet(
+        path, compression="zstd", write_covering_bbox=True
+    )
+    return [path]
+
+
+def layers_to_geoms(
+    data: list[FullLayerData],
+) -> tuple[numpy.ndarray, pandas.DataFrame]:
+    """
+    Build shapely geometries in bulk from the vertex arrays of layers.
+
+    Parameters:
+    data (list[FullLayerData]): The (data, meta, layer_type) tuples of Shapes and Points layers.
+
+    Returns:
+    tuple[numpy.ndarray, pandas.DataFrame]: One geometry per feature, in QuPath (x, y) coordinates, and its properties, including "id", "objectType", "classification" and "color".
+    """
+    data = [_uncull(layer) for layer in data]
+    shapes = [layer for layer in data if layer[2] == "shapes"]
+    points = [layer for layer in data if layer[2] == "points"]
+    geoms, properties = [], []
+    if shapes:
+        layer_geoms, layer_properties = _shapes_to_geoms(shapes)
+        geoms.append(layer_geoms)
+        properties.append(layer_properties)
+    for layer_data, meta, _ in points:
+        coords = numpy.asarray(layer_data, dtype=float)[:, -2:]
+        geoms.append(shapely.points(coords[:, ::-1]))
+        properties.append(
+            _layer_properties(meta, numpy.arange(len(coords)), "face_color")
+        )
+    if not geoms:
+        return numpy.empty(0, dtype=object), _layer_properties({}, [], None)
+    return numpy.concatenate(geoms), pandas.concat(
+        properties, ignore_index=True
+    )
+
+
+def _shapes_to_geoms(layers):
+    # Shape level arrays across all layers
+    vertices, is_polygon, feature, part, ring = [], [], [], [], []
+    properties = []
+    n_features = 0
+    for layer_data, meta, _ in layers:
+        shape_types = meta.get("shape_type", ["polygon"] * len(layer_data))
+        if isinstance(shape_types, str):
+            shape_types = [shape_types] * len(layer_data)
+        features = meta.get("features", pandas.DataFrame())
+        vertices += [
+            (
+                _ellipse_to_polygon(numpy.asarray(shape, dtype=float))
+                if shape_type == "ellipse"
+                else numpy.asarray(shape, dtype=float)[:, -2:]
+            )
+            for shape, shape_type in zip(layer_data, shape_types)
+        ]
+        is_polygon.append(numpy.isin(shape_types, POLYGON_TYPES))
+
+        # Shapes split out of one feature by load_geojson are grouped back,
+        # others (drawn in napari) are features of their own
+        loaded = _loaded_rows(features, len(layer_data))
+        layer_feature = numpy.empty(len(layer_data), dtype=int)
+        layer_part = numpy.zeros(len(layer_data), dtype=int)
+        layer_ring = numpy.zeros(len(layer_data), dtype=int)
+        n_loaded = 0
+        if loaded.any():
+            layer_feature[loaded], ids = pandas.factorize(
+                features["id"][loaded]
+            )
+            n_loaded = len(ids)
+            layer_part[loaded] = features["part"][loaded].to_numpy(dtype=int)
+            layer_ring[loaded] = features["ring"][loaded].to_numpy(dtype=int)
+        layer_feature[~loaded] = n_loaded + numpy.arange((~loaded).sum())
+        first = numpy.unique(layer_feature, return_index=True)[1]
+        part.append(layer_part)
+        ring.append(layer_ring)
+        feature.append(layer_feature + n_features)
+        n_features += len(first)
+        layer_properties = _layer_properties(meta, first, "edge_color")
+        if "part" in features:
+            # The IDs napari copied onto drawn shapes are not theirs
+            layer_properties.loc[~loaded[first], "id"] = None
+        properties.append(layer_properties)
+
+    if not vertices:
+        return numpy.empty(0, dtype=object), pandas.concat(
+            properties, ignore_index=True
+        )
+    is_polygon = numpy.concatenate(is_polygon)
+    feature = numpy.concatenate(feature)
+    part = numpy.concatenate(part)
+    ring = numpy.concatenate(ring)
+    counts = numpy.array([len(shape) for shape in vertices])
+    # napari (row, column) -> QuPath (x, y), once for every vertex
+    coords = numpy.concatenate(vertices)[:, ::-1]
+    shape_of_vertex = numpy.repeat(numpy.arange(len(vertices)), counts)
+
+    # Polygons: rings sorted so that each exterior comes before its holes
+    polygon_shapes = numpy.flatnonzero(is_polygon)
+    polygon_shapes = polygon_shapes[
+        numpy.lexsort(
+            (
+                ring[polygon_shapes],
+                part[polygon_shapes],
+                feature[polygon_shapes],
+            )
+        )
+    ]
+    rings = _from_vertices(
+        shapely.linearrings, coords, shape_of_vertex, polygon_shapes
+    )
+    polygon_keys, polygon_of_ring = numpy.unique(
+        numpy.stack([feature[polygon_shapes], part[polygon_shapes]], axis=1),
+        axis=0,
+        return_inverse=True,
+    )
+    polygons = shapely.polygons(rings, indices=polygon_of_ring.ravel())
+
+    line_shapes = numpy.flatnonzero(~is_polygon)
+    lines = _from_vertices(
+        shapely.linestrings, coords, shape_of_vertex, line_shapes
+    )
+
+    # Parts of every feature, in feature then part order
+    parts = numpy.concatenate([polygons, lines])
+    part_feature = numpy.concatenate(
+        [polygon_keys[:, 0], feature[line_shapes]]
+    ).astype(int)
+    part_number = numpy.concatenate([polygon_keys[:, 1], part[line_shapes]])
+    order = numpy.lexsort((part_number, part_feature))
+    parts, part_feature = parts[order], part_feature[order]
+    part_is_polygon = numpy.arange(len(parts)) < len(polygons)
+    part_is_polygon = part_is_polygon[order]
+
+    n_parts = numpy.bincount(part_feature, minlength=n_features)
+    n_polygons = numpy.bincount(
+        part_feature, weights=part_is_polygon, minlength=n_features
+    )
+    geoms = numpy.empty(n_features, dtype=object)
+    single = n_parts[part_feature] == 1
+    geoms[part_feature[single]] = parts[single]
+    for constructor, selected in (
+        (shapely.multipolygons, n_polygons == n_parts),
+        (shapely.multilinestrings, n_polygons == 0),
+        (
+            shapely.geometrycollections,
+            (n_polygons > 0) & (n_polygons < n_parts),
+        ),
+    ):
+        selected &= n_parts > 1
+        features = numpy.flatnonzero(selected)
+        in_features = selected[part_feature]
+        geoms[features] = constructor(
+            parts[in_features],
+            indices=numpy.searchsorted(features, part_feature[in_features]),
+        )
+    return geoms, pandas.concat(properties, ignore_index=True)
+
+
+def _loaded_rows(features, n_shapes):
+    # Rows with the feature ID, part and ring set by load_geojson. napari
+    # gives drawn shapes those of the last row (unless feature_defaults
+    # were cleared), so only the first row of each is trusted
+    if not {"id", "part", "ring"} <= set(features.columns):
+        return numpy.zeros(n_shapes, dtype=bool)
+    keys = features[["id", "part", "ring"]]
+    return (keys.notna().all(axis=1) & ~keys.duplicated()).to_numpy()
+
+
+def _from_vertices(constructor, coords, shape_of_vertex, shapes):
+    # One geometry per shape, all built in one call
+    if len(shapes) == 0:
+        return numpy.empty(0, dtype=object)
+    selected = numpy.isin(shape_of_vertex, shapes)
+    order = numpy.argsort(shapes)
+    geoms = constructor(
+        coords[selected],
+        indices=numpy.searchsorted(shapes[order], shape_of_vertex[selected]),
+    )
+    # Back to the order of `shapes`
+    return geoms[numpy.argsort(order)]
+
+
+def _uncull(layer):
+    # Layers culled to the view only hold the shapes in view
+    metadata = layer[1].get("metadata") or {}
+    controller = culled_shapes(metadata)
+    if controller is not None:
+        return controller.layer_data()
+    if "culled_shapes" in metadata:
+        raise ValueError(
+            f"Layer {layer[1].get('name')!r} is culled to the view and its "
+            "full set of shapes is no longer available"
+        )
+    return layer
+
+
+def _layer_properties(meta, rows, color_key):
+    # Properties of the features of a layer, one row per feature
+    features = meta.get("features", pandas.DataFrame())
+    if len(features.columns):
+        properties = features.iloc[rows].reset_index(drop=True)
+        properties = properties.drop(columns=["part", "ring"], errors="ignore")
+    else:
+        properties = pandas.DataFrame(index=range(len(rows)))
+    if "id" not in properties:
+        properties.insert(0, "id", None)
+    if "objectType" not in properties:
+        properties["objectType"] = "annotation"
+    if "classification" not in properties:
+        # Layers drawn in napari are classified by their name
+        named = "name" in properties or not meta.get("name")
+        properties["classification"] = None if named else meta["name"]
+
+    colors = numpy.asarray(meta.get(color_key, numpy.empty((0, 4))))
+    if colors.ndim == 2 and len(colors) > 0 and len(rows):
+        colors = numpy.round(colors[numpy.asarray(rows), :3] * 255)
+        properties["color"] = colors.astype(int).tolist()
+    else:
+        properties["color"] = None
+    return properties
+
+
+def _ellipse_to_polygon(corners):
+    # napari ellipses are given by the 4 corners of their bounding box
+    corners = corners[:, -2:]
+    center = corners.mean(axis=0)
+    half_a = (corners[1] - corners[0]) / 2
+    half_b = (corners[3] - corners[0]) / 2
+    angles = numpy.linspace(0, 2 * numpy.pi, ELLIPSE_VERTICES, endpoint=False)
+    return (
+        center
+        + numpy.cos(angles)[:, None] * half_a
+        + numpy.sin(angles)[:, None] * half_b
+    )
+
+
+def _qupath_class(name, color):
+    if _isnull(name):
+        return None
+    if isinstance(name, dict):
+        return name
+    classification = {"name": str(name)}
+    if color is not None and not _isnull(color):
+        classification["color"] = color
+    return classification
+
+
+def _isnull(value):
+    return value is None or (isinstance(value, float) and numpy.isnan(value))
+
+
+def _json_default(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, pathlib.Path):
+        return str(value)
+    raise TypeError(f"{type(value)} is not JSON serializable")